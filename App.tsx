@@ -1,10 +1,10 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { 
   Menu, Search, Plus, Heart, User, Gamepad2, Users, CheckCircle2, Send, Settings, ShoppingBag, Trophy 
 } from 'lucide-react';
 import { AnimatePresence, motion } from 'framer-motion';
 import { GAMES, AVAILABLE_AVATARS } from './constants';
-import { Game, FilterType, UserProfile } from './types';
+import { Game, FilterType, UserProfile, ShopItem } from './types';
 import GameCard from './components/GameCard';
 import Drawer from './components/Drawer';
 import GamePage from './components/GamePage';
@@ -43,6 +43,24 @@ const App: React.FC = () => {
   const [filter, setFilter] = useState<FilterType>('all');
   const [showSearchResults, setShowSearchResults] = useState(false);
   const [selectedGame, setSelectedGame] = useState<Game | null>(null);
+  // Время открытия игры: сервер сверяет очки с длительностью игры
+  const gameOpenedAt = useRef(Date.now());
+  // Подписанная сервером метка начала игры; длительность по ней сервер считает сам
+  const playToken = useRef<string | null>(null);
+
+  const startGame = (gameId: string) => {
+      gameOpenedAt.current = Date.now();
+      playToken.current = null;
+      const sessionId = localStorage.getItem('session_id');
+      if (!sessionId) return;
+      fetch("/api/game/start", {
+          method: "POST", headers: { "Content-Type": "application/json" },
+          body: JSON.stringify({ session: sessionId, game_id: gameId })
+      })
+          .then(res => res.json())
+          .then(data => { if (data.success) playToken.current = data.play_token; })
+          .catch(() => {});
+  };
 
   // --- API HELPER ---
   const callUpdateApi = async (action: string, payload: any) => {
@@ -55,9 +73,12 @@ const App: React.FC = () => {
               body: JSON.stringify({ session: sessionId, action, payload })
           });
           const data = await res.json();
-          if (data.success && data.coins !== undefined) {
+          if (data.coins !== undefined && data.coins !== null) {
               setCoins(data.coins);
           }
+          if (Array.isArray(data.inventory)) {
+              setUser(prev => ({ ...prev, inventory: data.inventory }));
+          }
           return data.success;
       } catch (e) {
           console.error("Sync error:", e);
@@ -65,10 +86,50 @@ const App: React.FC = () => {
       }
   };
 
+  // --- ОФЛАЙН-ОЧЕРЕДЬ РЕЗУЛЬТАТОВ ---
+  const PENDING_SCORES_KEY = 'pending_scores';
+
+  const queueScore = (gameId: string, score: number, duration: number, token: string | null) => {
+      const pending = JSON.parse(localStorage.getItem(PENDING_SCORES_KEY) || '[]');
+      pending.push({ game_id: gameId, score, duration, play_token: token, played_at: new Date().toISOString() });
+      localStorage.setItem(PENDING_SCORES_KEY, JSON.stringify(pending.slice(-200)));
+  };
+
+  const flushPendingScores = async (sessionId: string) => {
+      const pending = JSON.parse(localStorage.getItem(PENDING_SCORES_KEY) || '[]');
+      if (pending.length === 0) return;
+      try {
+          const res = await fetch("/api/game/scores/batch", {
+              method: "POST", headers: { "Content-Type": "application/json" },
+              body: JSON.stringify({ session: sessionId, scores: pending })
+          });
+          const data = await res.json();
+          // Сервер сохраняет пачку, отбросив неправдоподобные партии (их индексы в rejected): отправленное
+          // убираем из очереди целиком, а партии, добавленные за время запроса, остаются до следующей отправки
+          if (data.success || res.status === 400) {
+              const rest = JSON.parse(localStorage.getItem(PENDING_SCORES_KEY) || '[]').slice(pending.length);
+              if (rest.length) localStorage.setItem(PENDING_SCORES_KEY, JSON.stringify(rest));
+              else localStorage.removeItem(PENDING_SCORES_KEY);
+          }
+          if (data.rejected?.length) console.warn("Implausible scores dropped:", data.rejected);
+          if (data.success) {
+              if (data.earned_coins) setCoins(prev => prev + data.earned_coins);
+              setUser(prev => ({
+                  ...prev,
+                  xp: data.current_xp,
+                  level: data.new_level || prev.level,
+                  achievements: [...(prev.achievements || []), ...(data.new_achievements || []).map((a: any) => a.id)]
+              }));
+          }
+      } catch (e) {
+          console.error("Error flushing scores:", e);
+      }
+  };
+
   useEffect(() => {
     const sessionId = localStorage.getItem('session_id');
     if (sessionId) {
-      fetch(`/api/user?session=${sessionId}`)
+      fetch(`/api/bootstrap?session=${sessionId}`)
         .then(res => res.json())
         .then(data => {
           if (data.success) {
@@ -86,6 +147,7 @@ const App: React.FC = () => {
               hasChangedName: data.has_changed_name || false
             }));
             if (data.coins !== undefined) setCoins(data.coins);
+            flushPendingScores(sessionId);
           }
         });
     }
@@ -110,6 +172,39 @@ const App: React.FC = () => {
     }
   }, []);
 
+  // --- ЖИВЫЕ ОБНОВЛЕНИЯ (SSE) ---
+  // Изменения из других вкладок и от бота; свои события уже учтены по ответу API и пропускаются
+  useEffect(() => {
+    const sessionId = localStorage.getItem('session_id');
+    if (!sessionId || !user.tgId || typeof EventSource === 'undefined') return;
+    let origin = '';
+    const source = new EventSource(`/api/events?session=${sessionId}`);
+    source.addEventListener('hello', (e) => { origin = JSON.parse((e as MessageEvent).data).origin; });
+    source.addEventListener('progress', (e) => {
+      const data = JSON.parse((e as MessageEvent).data);
+      if (data.origin === origin) return;
+      if (data.coins_delta) setCoins(prev => prev + data.coins_delta);
+      setUser(prev => ({
+        ...prev,
+        xp: data.xp,
+        level: data.level,
+        achievements: Array.from(new Set([...(prev.achievements || []), ...(data.achievements || [])]))
+      }));
+    });
+    source.addEventListener('shop', (e) => {
+      const data = JSON.parse((e as MessageEvent).data);
+      if (data.origin === origin) return;
+      setCoins(data.coins);
+      setUser(prev => ({
+        ...prev,
+        ...(data.inventory ? { inventory: data.inventory } : {}),
+        ...(data.active_theme ? { activeTheme: data.active_theme } : {}),
+        ...(data.display_name ? { displayName: data.display_name, hasChangedName: true } : {})
+      }));
+    });
+    return () => source.close();
+  }, [user.tgId]);
+
   const filteredGames = GAMES.filter(game => {
     const matchesSearch = game.name.toLowerCase().includes(searchQuery.toLowerCase());
     const matchesFilter = filter === 'all' ? true : filter === 'single' ? game.category === 'single' : filter === 'multi' ? game.category === 'multi' : favorites.has(game.id);
@@ -140,13 +235,25 @@ const App: React.FC = () => {
     return true;
   };
 
+  // Несколько товаров одним запросом: сервер списывает сумму атомарно или не покупает ничего
+  const handleBuyItems = async (items: ShopItem[]): Promise<boolean> => {
+    const total = items.reduce((sum, item) => sum + item.price, 0);
+    if (items.length === 0 || coins < total) {
+        if(window.Telegram?.WebApp?.HapticFeedback) window.Telegram.WebApp.HapticFeedback.notificationOccurred('error');
+        return false;
+    }
+    const success = await callUpdateApi('buy_many', { items: items.map(item => ({ item_id: item.id, price: item.price })) });
+    if (success && window.Telegram?.WebApp?.HapticFeedback) window.Telegram.WebApp.HapticFeedback.notificationOccurred('success');
+    return success;
+  };
+
   const handleUpdateUserWrapper = (updates: Partial<UserProfile>) => {
       if (updates.activeTheme) callUpdateApi('set_theme', { theme: updates.activeTheme });
       setUser(prev => ({ ...prev, ...updates }));
   };
 
   const handleFilterChange = (newFilter: FilterType) => { setFilter(newFilter); setIsMenuOpen(false); };
-  const handleGameSelect = (game: Game) => { setSelectedGame(game); setShowSearchResults(false); setSearchQuery(''); window.scrollTo({ top: 0, behavior: 'smooth' }); };
+  const handleGameSelect = (game: Game) => { startGame(game.id); setSelectedGame(game); setShowSearchResults(false); setSearchQuery(''); window.scrollTo({ top: 0, behavior: 'smooth' }); };
   const handleBackToGrid = () => { setSelectedGame(null); };
   const toggleFavorite = (e: React.MouseEvent, gameId: string) => {
     e.stopPropagation();
@@ -160,12 +267,21 @@ const App: React.FC = () => {
   const handleSaveScore = async (gameId: string, score: number) => {
     const sessionId = localStorage.getItem('session_id');
     if (!sessionId || !user.tgId) return;
+    const duration = Math.round((Date.now() - gameOpenedAt.current) / 1000);
+    const token = playToken.current;
+    // Сервер гасит метку с результатом: следующая партия получает свою
+    startGame(gameId);
 
     try {
         const res = await fetch("/api/game/score", {
             method: "POST", headers: { "Content-Type": "application/json" },
-            body: JSON.stringify({ session: sessionId, game_id: gameId, score: score })
+            body: JSON.stringify({ session: sessionId, game_id: gameId, score: score, duration, play_token: token })
         });
+        // Сервер перегружен или лимит исчерпан — отправим позже пачкой
+        if (res.status === 429) {
+            queueScore(gameId, score, duration, token);
+            return;
+        }
         const data = await res.json();
         if (data.success) {
             // Обновляем монеты
@@ -193,7 +309,10 @@ const App: React.FC = () => {
                 setTimeout(() => setAchievementNotification(null), 4000);
             }
         }
-    } catch (err) { console.error("Error saving score:", err); }
+    } catch (err) {
+        console.error("Error saving score:", err);
+        queueScore(gameId, score, duration, token);
+    }
   };
 
   return (
@@ -289,6 +408,7 @@ const App: React.FC = () => {
           <Shop 
              user={user} coins={coins}
              onSpendCoins={(amount, itemId) => handleSpendCoins(amount, itemId, 'item')}
+             onBuyItems={handleBuyItems}
              onUpdateUser={handleUpdateUserWrapper}
              onBack={() => setIsShopMode(false)}
           />
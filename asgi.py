@@ -0,0 +1,813 @@
+# Асинхронный режим: те же /api/* маршруты и JSON-контракты, что у Flask-приложения в server.py,
+# но на ASGI (Starlette) и asyncpg. Медленный запрос к БД не занимает поток-обработчик.
+#
+# Запуск:  python asgi.py  или  uvicorn asgi:app --host 0.0.0.0 --port $PORT [--workers N]
+# (при нескольких воркерах Telegram опрашивает только выбранный лидер, как и под gunicorn).
+# Flask-режим (python server.py) остаётся как был — для сравнения на одном железе.
+#
+# Кэши, лидерборды, бот и фоновые воркеры общие с server.py; сами воркеры
+# по-прежнему ходят в БД через пул psycopg2.
+import asyncio
+import functools
+import json
+import os
+import re
+import sys
+import time
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+
+import asyncpg
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+from telebot import types
+
+
+def configured_workers():
+    """Число процессов uvicorn: --workers N в командной строке или WEB_CONCURRENCY."""
+    for i, arg in enumerate(sys.argv):
+        if arg == "--workers" and i + 1 < len(sys.argv):
+            return int(sys.argv[i + 1])
+        if arg.startswith("--workers="):
+            return int(arg.split("=", 1)[1])
+    return int(os.getenv("WEB_CONCURRENCY", 1))
+
+# Решается до импорта server.py: SCORE_BUFFER создаётся при импорте
+if configured_workers() > 1 and os.getenv("SCORE_WRITE_BEHIND") == "1":
+    print("WARNING: SCORE_WRITE_BEHIND держит xp/level в памяти процесса и несовместим с несколькими воркерами — отключён.")
+    os.environ["SCORE_WRITE_BEHIND"] = "0"
+if configured_workers() > 1 and os.getenv("RATE_LIMIT_BACKEND", "memory") == "memory":
+    print(f"WARNING: RATE_LIMIT_BACKEND=memory считает лимиты очков в каждом воркере отдельно — "
+          f"фактический лимит в {configured_workers()} раз выше; общий даёт RATE_LIMIT_BACKEND=postgres.")
+
+from server import (
+    DATABASE_URL, DB_SSLMODE, PORT, GAME_NAMES, STATIC_ASSETS, SESSION_TTL, SESSION_CACHE, IDENTITY_CACHE, SCORE_BATCH_MAX,
+    LEADERBOARD_PAGE_MAX, LEADERBOARDS, AVATARS, AVATAR_TTL, ACHIEVEMENTS, OUTBOX, OUTBOX_MAX_ATTEMPTS,
+    SESSION_JANITOR, SCORE_BUFFER, BOT_DISPATCHER, BOT_LEADER, BOT_MODE, BOT_WEBHOOK_PATH, webhook_secret_ok, BUMP_COUNTERS_SQL, counter_changes, score_rewards, level_up,
+    parse_score_entries, aggregate_plays, record_scores_buffered, user_response, start_background_workers,
+    BOOTSTRAP_SQL, bootstrap_response, shop_statement, shop_response,
+    METRICS_ENABLED, METRIC_GAUGES, HTTP_LATENCY, HTTP_REQUESTS, DB_QUERY_LATENCY, DB_QUERY_ERRORS,
+    render_metrics, metrics_allowed, statement_name, SCHEMA_VERSION_SQL, readiness_payload,
+    INVALIDATION_CHANNEL, invalidation_payloads, LISTENER, RATE_LIMIT_BACKEND, SCORE_GATE, admit_scores,
+    EVENTS, EVENTS_CHANNEL, EVENT_QUEUE_MAX, EVENT_HEARTBEAT, EVENT_STREAM_MAX_AGE, EVENT_RETRY_MS,
+    event_origin, user_event_payload, progress_event, shop_event, sse_message,
+    ANALYTICS, ANALYTICS_SQL, ANALYTICS_DAYS_MAX, analytics_row, analytics_summary, admin_allowed,
+    LEADERBOARD_CHANNEL, score_notification_payload, issue_play_token, split_plausible,
+)
+
+ASYNC_DB_POOL_MIN = int(os.getenv("ASYNC_DB_POOL_MIN", os.getenv("DB_POOL_MIN", 1)))
+ASYNC_DB_POOL_MAX = int(os.getenv("ASYNC_DB_POOL_MAX", os.getenv("DB_POOL_MAX", 10)))
+# Сколько ждать свободное соединение, прежде чем отвечать ошибкой
+ASYNC_DB_POOL_TIMEOUT = float(os.getenv("ASYNC_DB_POOL_TIMEOUT", os.getenv("DB_POOL_TIMEOUT", 5)))
+
+
+# =============== DB HELPER ===============
+_pool = None
+
+@asynccontextmanager
+async def db_connection():
+    """Асинхронный аналог server.db_connection: соединение из пула asyncpg или None."""
+    conn = None
+    if _pool is not None:
+        try:
+            conn = await _pool.acquire(timeout=ASYNC_DB_POOL_TIMEOUT)
+        except Exception as e:
+            print(f"DB Connection Error: {e}")
+    try:
+        yield conn
+    finally:
+        if conn is not None:
+            await _pool.release(conn)
+
+def numbered(statement):
+    """SQL с плейсхолдерами psycopg2 (%s) -> плейсхолдеры asyncpg ($1, $2, ...) в том же порядке."""
+    counter = iter(range(1, statement.count("%s") + 1))
+    return re.sub(r"%s", lambda _: f"${next(counter)}", statement)
+
+def utc_naive(created_at):
+    """ISO-строка или aware datetime -> naive UTC для колонок TIMESTAMP (так их пишет и psycopg2)."""
+    if isinstance(created_at, str):
+        created_at = datetime.fromisoformat(created_at)
+    if created_at.tzinfo is not None:
+        created_at = created_at.astimezone(timezone.utc).replace(tzinfo=None)
+    return created_at
+
+
+# =============== QUERIES ===============
+# Повторяют одноимённые функции server.py; вместо execute_values — массивы и unnest.
+async def publish_invalidation(conn, cache, keys=None):
+    for payload in invalidation_payloads(cache, keys):
+        await conn.execute("SELECT pg_notify($1, $2)", INVALIDATION_CHANNEL, payload)
+
+async def publish_user_event(conn, user_id, event, session_id=None):
+    await conn.execute("SELECT pg_notify($1, $2)", EVENTS_CHANNEL, user_event_payload(user_id, event, session_id))
+
+async def publish_scores(conn, user_id, rows):
+    await conn.execute("SELECT pg_notify($1, $2)", LEADERBOARD_CHANNEL, score_notification_payload(user_id, rows))
+
+async def resolve_session(conn, session_id):
+    identity = SESSION_CACHE.get(session_id)
+    if identity:
+        if identity["expires_at"] > time.time():
+            return identity
+        SESSION_CACHE.invalidate(session_id)
+    row = await conn.fetchrow("""
+        UPDATE sessions ses SET expires_at = NOW() + make_interval(secs => $1)
+        FROM users u
+        WHERE u.id = ses.user_id AND ses.session_id=$2 AND ses.expires_at > NOW()
+        RETURNING u.id, u.tg_id
+    """, float(SESSION_TTL), session_id)
+    if not row:
+        return None
+    identity = {"user_id": row['id'], "tg_id": row['tg_id'], "expires_at": time.time() + SESSION_TTL}
+    SESSION_CACHE.set(session_id, identity)
+    return identity
+
+async def add_progress(conn, user_id, earned_coins, earned_xp):
+    row = await conn.fetchrow("""
+        UPDATE stats
+        SET coins = coins + $1, xp = xp + $2
+        WHERE user_id = $3
+        RETURNING xp, level
+    """, earned_coins, earned_xp, user_id)
+    if not row:
+        return level_up(earned_xp, 1)
+    new_level, new_xp = level_up(row['xp'], row['level'])
+    if new_level != row['level']:
+        await conn.execute("UPDATE stats SET xp = $1, level = $2 WHERE user_id = $3", new_xp, new_level, user_id)
+    return new_level, new_xp
+
+async def insert_scores(conn, user_id, rows):
+    """Партии [(game_id, score, created_at)] в game_scores и user_best_scores одним запросом на таблицу."""
+    game_ids = [str(game_id) for game_id, _, _ in rows]
+    scores = [score_val for _, score_val, _ in rows]
+    times = [utc_naive(created_at) for _, _, created_at in rows]
+    await conn.execute("""
+        INSERT INTO game_scores (user_id, game_id, score, created_at)
+        SELECT $1::int, * FROM unnest($2::text[], $3::int[], $4::timestamp[])
+    """, user_id, game_ids, scores, times)
+    # DISTINCT ON оставляет по одной строке на игру, иначе ON CONFLICT заденет строку дважды
+    await conn.execute("""
+        INSERT INTO user_best_scores (user_id, game_id, score, achieved_at)
+        SELECT DISTINCT ON (game_id) $1::int, game_id, score, achieved_at
+        FROM unnest($2::text[], $3::int[], $4::timestamp[]) AS v (game_id, score, achieved_at)
+        ORDER BY game_id, score DESC, achieved_at
+        ON CONFLICT (user_id, game_id) DO UPDATE
+        SET score = EXCLUDED.score, achieved_at = EXCLUDED.achieved_at
+        WHERE EXCLUDED.score > user_best_scores.score
+    """, user_id, game_ids, scores, times)
+
+async def grant_achievements(conn, user_id, tg_id, per_game):
+    items = list(per_game.items())
+    rows = await conn.fetch("""
+        WITH v (user_id, game_id, plays, total_score, best_score, day) AS (
+            SELECT $1::int, * FROM unnest($2::text[], $3::int[], $4::bigint[], $5::int[], $6::date[])
+        ),""" + BUMP_COUNTERS_SQL,
+        user_id, [game_id for game_id, _ in items], [agg["plays"] for _, agg in items],
+        [agg["total_score"] for _, agg in items], [agg["best_score"] for _, agg in items], [agg["day"] for _, agg in items])
+
+    candidates, seen = [], set()
+    for game_id, (old, new) in counter_changes([tuple(row) for row in rows]).items():
+        for rule in ACHIEVEMENTS.crossed(game_id, old, new):
+            if rule["id"] not in seen:
+                seen.add(rule["id"])
+                candidates.append(rule)
+    if not candidates:
+        return []
+
+    inserted = await conn.fetch("""
+        INSERT INTO user_achievements (user_id, achievement_id, unlocked_at)
+        SELECT $1::int, unnest($2::text[]), $3::timestamp
+        ON CONFLICT DO NOTHING RETURNING achievement_id
+    """, user_id, [rule["id"] for rule in candidates], utc_naive(datetime.now(timezone.utc)))
+    inserted_ids = {row['achievement_id'] for row in inserted}
+    new_unlocked = [rule for rule in candidates if rule["id"] in inserted_ids]
+    if tg_id and new_unlocked:
+        await conn.execute("""
+            INSERT INTO notification_outbox (chat_id, kind, payload)
+            SELECT $1::bigint, 'achievement', unnest($2::jsonb[])
+        """, tg_id, [{"name": rule['name'], "desc": rule['desc']} for rule in new_unlocked])
+    return new_unlocked
+
+async def record_scores(session_id, rows, earned_coins, earned_xp):
+    """Запись партий: (level, xp, новые достижения), None без пользователя; исключение, если БД недоступна."""
+    if SCORE_BUFFER:
+        # Буфер write-behind синхронный; в пуле потоков он не блокирует цикл событий
+        return await run_in_threadpool(record_scores_buffered, session_id, rows, earned_coins, earned_xp)
+
+    async with db_connection() as conn:
+        if not conn: raise ConnectionError("DB Error")
+        identity = await resolve_session(conn, session_id)
+        if not identity:
+            return None
+        user_id, tg_id = identity['user_id'], identity['tg_id']
+        async with conn.transaction():
+            await insert_scores(conn, user_id, rows)
+            new_level, new_xp = await add_progress(conn, user_id, earned_coins, earned_xp)
+            new_unlocked = await grant_achievements(conn, user_id, tg_id, aggregate_plays(rows))
+            await publish_user_event(conn, user_id, progress_event(earned_coins, new_level, new_xp, new_unlocked), session_id)
+            await publish_scores(conn, user_id, rows)
+    LEADERBOARDS.submit(user_id, rows)
+    if new_unlocked:
+        OUTBOX.wake()
+    return new_level, new_xp, new_unlocked
+
+
+# =============== HANDLERS ===============
+async def read_json(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+async def verify(request):
+    data = await read_json(request)
+    token = data.get("token") if data else None
+    if not token: return JSONResponse({"success": False})
+
+    try:
+        async with db_connection() as conn:
+            if not conn: return JSONResponse({"success": False, "error": "DB Error"})
+
+            async with conn.transaction():
+                row = await conn.fetchrow("""
+                    SELECT users.id, users.username, auth_tokens.expires_at
+                    FROM auth_tokens JOIN users ON users.id = auth_tokens.user_id WHERE auth_tokens.token=$1
+                """, token)
+                if not row:
+                    return JSONResponse({"success": False, "error": "Invalid token"})
+
+                user_id, username, expires_at = row['id'], row['username'], row['expires_at']
+                if expires_at.tzinfo is None:
+                    expires_at = expires_at.replace(tzinfo=timezone.utc)
+                if datetime.now(timezone.utc) > expires_at:
+                    return JSONResponse({"success": False, "error": "Expired"})
+
+                session_id = str(uuid.uuid4())
+                await conn.execute("INSERT INTO sessions (user_id, session_id, expires_at) VALUES ($1, $2, NOW() + make_interval(secs => $3))",
+                                   user_id, session_id, float(SESSION_TTL))
+                await conn.execute("DELETE FROM auth_tokens WHERE token=$1", token)
+        SESSION_CACHE.invalidate(session_id)
+        return JSONResponse({"success": True, "username": username, "session": session_id})
+    except Exception as e:
+        print(f"Auth verify error: {e}")
+        return JSONResponse({"success": False})
+
+async def logout(request):
+    data = await read_json(request)
+    session_id = data.get("session") if data else None
+    if not session_id: return JSONResponse({"success": False})
+
+    try:
+        async with db_connection() as conn:
+            if not conn: return JSONResponse({"success": False, "error": "DB Error"})
+
+            if data.get("all"):
+                identity = await resolve_session(conn, session_id)
+                if not identity:
+                    return JSONResponse({"success": False, "error": "User not found"})
+                async with conn.transaction():
+                    revoked_ids = [row['session_id'] for row in await conn.fetch(
+                        "DELETE FROM sessions WHERE user_id=$1 RETURNING session_id", identity['user_id'])]
+                    await publish_invalidation(conn, "sessions", revoked_ids)
+                for revoked_id in revoked_ids:
+                    SESSION_CACHE.invalidate(revoked_id)
+                revoked = len(revoked_ids)
+            else:
+                async with conn.transaction():
+                    status = await conn.execute("DELETE FROM sessions WHERE session_id=$1", session_id)
+                    await publish_invalidation(conn, "sessions", [session_id])
+                revoked = int(status.split()[-1])
+                SESSION_CACHE.invalidate(session_id)
+        return JSONResponse({"success": True, "revoked": revoked})
+    except Exception as e:
+        print(f"Logout error: {e}")
+        return JSONResponse({"success": False})
+
+async def get_user_info(request):
+    session_id = request.query_params.get("session")
+    if not session_id: return JSONResponse({"success": False})
+
+    try:
+        async with db_connection() as conn:
+            if not conn: return JSONResponse({"success": False})
+
+            identity = await resolve_session(conn, session_id)
+            if not identity:
+                return JSONResponse({"success": False})
+            user_id = identity['user_id']
+            row = await conn.fetchrow("""
+                SELECT u.id as user_id, u.username, u.tg_id,
+                       s.coins, s.xp, s.level,
+                       p.inventory, p.active_theme, p.has_changed_name, p.display_name,
+                       ARRAY(SELECT achievement_id FROM user_achievements WHERE user_id = u.id) AS achievements
+                FROM users u
+                LEFT JOIN stats s ON s.user_id = u.id
+                LEFT JOIN user_progress p ON p.user_id = u.id
+                WHERE u.id=$1
+            """, user_id)
+            if not row:
+                return JSONResponse({"success": False})
+            user_data = dict(row)
+
+            if user_data.get('coins') is None:
+                async with conn.transaction():
+                    await conn.execute("INSERT INTO stats (user_id, xp, coins, level) VALUES ($1, 0, 1000, 1) ON CONFLICT (user_id) DO NOTHING", user_id)
+                    await conn.execute("INSERT INTO user_progress (user_id) VALUES ($1) ON CONFLICT (user_id) DO NOTHING", user_id)
+                user_data['coins'] = 1000
+                user_data['xp'] = 0
+                user_data['level'] = 1
+
+        avatar_url = AVATARS.avatar_url(user_data['tg_id']) if user_data.get('tg_id') else None
+        return JSONResponse(user_response(user_data, user_data.pop('achievements'), avatar_url))
+    except Exception as e:
+        print(f"User API Error: {e}")
+        return JSONResponse({"success": False})
+
+async def bootstrap_api(request):
+    session_id = request.query_params.get("session")
+    if not session_id: return JSONResponse({"success": False})
+
+    try:
+        async with db_connection() as conn:
+            if not conn: return JSONResponse({"success": False, "error": "DB Error"}, status_code=500)
+
+            identity = await resolve_session(conn, session_id)
+            if not identity:
+                return JSONResponse({"success": False, "error": "User not found"})
+            row = await conn.fetchrow(numbered(BOOTSTRAP_SQL), identity['user_id'])
+            if not row:
+                return JSONResponse({"success": False, "error": "User not found"})
+            row = dict(row)
+            if row['coins'] is None:
+                async with conn.transaction():
+                    await conn.execute("INSERT INTO stats (user_id, xp, coins, level) VALUES ($1, 0, 1000, 1) ON CONFLICT (user_id) DO NOTHING", row['user_id'])
+                    await conn.execute("INSERT INTO user_progress (user_id) VALUES ($1) ON CONFLICT (user_id) DO NOTHING", row['user_id'])
+                row.update({"coins": 1000, "xp": 0, "level": 1})
+
+        avatar_url = AVATARS.avatar_url(row['tg_id']) if row['tg_id'] else None
+        payload, etag = bootstrap_response(row, avatar_url)
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if etag in request.headers.get("if-none-match", ""):
+            return Response(status_code=304, headers=headers)
+        return JSONResponse(payload, headers=headers)
+    except Exception as e:
+        print(f"Bootstrap API Error: {e}")
+        return JSONResponse({"success": False}, status_code=500)
+
+def admission_controlled(endpoint):
+    """Аналог server.admission_controlled; бакеты в Postgres проверяются в пуле потоков."""
+    @functools.wraps(endpoint)
+    async def wrapper(request):
+        data = await read_json(request) or {}
+        if RATE_LIMIT_BACKEND == "postgres":
+            rejected = await run_in_threadpool(admit_scores, data)
+        else:
+            rejected = admit_scores(data)
+        if rejected:
+            payload, status, headers = rejected
+            return JSONResponse(payload, status_code=status, headers=headers)
+        try:
+            return await endpoint(request)
+        finally:
+            SCORE_GATE.leave()
+    return wrapper
+
+async def start_game_api(request):
+    data = await read_json(request) or {}
+    session_id, game_id = data.get("session"), data.get("game_id")
+    if not session_id or not game_id:
+        return JSONResponse({"success": False}, status_code=400)
+    token = issue_play_token(session_id, str(game_id))
+    if not token:
+        return JSONResponse({"success": False, "error": "Play tokens disabled"}, status_code=503)
+    return JSONResponse({"success": True, "play_token": token})
+
+@admission_controlled
+async def save_score_api(request):
+    data = await read_json(request) or {}
+    session_id = data.get("session")
+    game_id = data.get("game_id")
+    score = data.get("score")
+
+    if not session_id or not game_id or score is None:
+        return JSONResponse({"success": False}, status_code=400)
+
+    score_val = int(score)
+    earned_coins, earned_xp = score_rewards(score_val)
+    rows = [(str(game_id), score_val, datetime.now(timezone.utc).isoformat())]
+    try:
+        result = await record_scores(session_id, rows, earned_coins, earned_xp)
+    except Exception as e:
+        print(f"Save Score Error: {e}")
+        return JSONResponse({"success": False}, status_code=500)
+    if not result:
+        return JSONResponse({"success": False, "error": "User not found"})
+    new_level, new_xp, new_unlocked = result
+    return JSONResponse({
+        "success": True,
+        "new_achievements": new_unlocked,
+        "earned_coins": earned_coins,
+        "earned_xp": earned_xp,
+        "new_level": new_level,
+        "current_xp": new_xp
+    })
+
+@admission_controlled
+async def save_scores_batch_api(request):
+    data = await read_json(request) or {}
+    session_id = data.get("session")
+    entries = data.get("scores")
+
+    if not session_id or not isinstance(entries, list) or not entries:
+        return JSONResponse({"success": False}, status_code=400)
+    if len(entries) > SCORE_BATCH_MAX:
+        return JSONResponse({"success": False, "error": f"Too many scores (max {SCORE_BATCH_MAX})"}, status_code=400)
+    # Погашение play_token при бакетах в Postgres — запрос к БД
+    if RATE_LIMIT_BACKEND == "postgres":
+        entries, rejected = await run_in_threadpool(split_plausible, entries, session_id)
+    else:
+        entries, rejected = split_plausible(entries, session_id)
+    if not entries:
+        return JSONResponse({"success": False, "error": "Implausible score", "rejected": rejected}, status_code=400)
+
+    try:
+        rows, earned_coins, earned_xp = parse_score_entries(entries, datetime.now(timezone.utc))
+    except ValueError:
+        return JSONResponse({"success": False, "error": "Invalid score entry"}, status_code=400)
+
+    try:
+        result = await record_scores(session_id, rows, earned_coins, earned_xp)
+    except Exception as e:
+        print(f"Save Scores Batch Error: {e}")
+        return JSONResponse({"success": False}, status_code=500)
+    if not result:
+        return JSONResponse({"success": False, "error": "User not found"})
+    new_level, new_xp, new_unlocked = result
+    return JSONResponse({
+        "success": True,
+        "accepted": len(rows),
+        "rejected": rejected,
+        "new_achievements": new_unlocked,
+        "earned_coins": earned_coins,
+        "earned_xp": earned_xp,
+        "new_level": new_level,
+        "current_xp": new_xp
+    })
+
+async def leaderboard_api(request):
+    game_id = request.path_params["game_id"]
+    if game_id not in GAME_NAMES:
+        return JSONResponse({"success": False, "error": "Unknown game"}, status_code=404)
+    try:
+        page = max(0, int(request.query_params.get("page", 0)))
+        size = min(max(1, int(request.query_params.get("size", 20))), LEADERBOARD_PAGE_MAX)
+    except ValueError:
+        return JSONResponse({"success": False, "error": "Invalid page"}, status_code=400)
+
+    try:
+        async with db_connection() as conn:
+            board, stale = LEADERBOARDS.cached(game_id)
+            if stale and conn:
+                rows = await conn.fetch("SELECT user_id, score, achieved_at FROM user_best_scores WHERE game_id=$1", game_id)
+                board = LEADERBOARDS.build((r['user_id'], r['score'], r['achieved_at']) for r in rows)
+                LEADERBOARDS.put(game_id, board)
+            if board is None:
+                return JSONResponse({"success": False, "error": "DB Error"}, status_code=500)
+
+            entries = board.page(page * size, size)
+            me = None
+            session_id = request.query_params.get("session")
+            if session_id and conn:
+                identity = await resolve_session(conn, session_id)
+                if identity:
+                    my_rank = board.rank(identity['user_id'])
+                    if my_rank:
+                        me = {"rank": my_rank[0], "score": my_rank[1]}
+
+            names = {}
+            if entries and conn:
+                names = dict(await conn.fetch("""
+                    SELECT u.id, COALESCE(p.display_name, u.username) FROM users u
+                    LEFT JOIN user_progress p ON p.user_id = u.id
+                    WHERE u.id = ANY($1::int[])
+                """, list({user_id for _, user_id, _ in entries})))
+        return JSONResponse({
+            "success": True,
+            "game_id": game_id,
+            "game_name": GAME_NAMES[game_id],
+            "total": len(board),
+            "page": page,
+            "size": size,
+            "entries": [{"rank": rank, "user_id": user_id, "name": names.get(user_id) or "Игрок", "score": score_val}
+                        for rank, user_id, score_val in entries],
+            "me": me
+        })
+    except Exception as e:
+        print(f"Leaderboard API Error: {e}")
+        return JSONResponse({"success": False}, status_code=500)
+
+async def avatar_api(request):
+    # Чтение с диска и обращение к Telegram — в пуле потоков
+    cached = await run_in_threadpool(AVATARS.load, request.path_params["tg_id"])
+    if not cached:
+        return JSONResponse({"success": False, "error": "Not found"}, status_code=404)
+    data, etag = cached
+    headers = {"ETag": f'"{etag}"', "Cache-Control": f"public, max-age={int(AVATAR_TTL)}"}
+    if f'"{etag}"' in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    return Response(data, media_type="image/jpeg", headers=headers)
+
+async def update_user_api(request):
+    data = await read_json(request) or {}
+    session_id = data.get("session")
+    action = data.get("action")
+    payload = data.get("payload")
+
+    if not session_id or not action: return JSONResponse({"success": False})
+
+    try:
+        async with db_connection() as conn:
+            if not conn: return JSONResponse({"success": False})
+
+            identity = await resolve_session(conn, session_id)
+            if not identity:
+                return JSONResponse({"success": False, "error": "User not found"})
+
+            try:
+                statement, params = shop_statement(action, identity['user_id'], payload)
+            except (AttributeError, TypeError, ValueError):
+                return JSONResponse({"success": False})
+            transaction = conn.transaction()
+            await transaction.start()
+            try:
+                row = await conn.fetchrow(numbered(statement), *params)
+            except Exception:
+                await transaction.rollback()
+                raise
+            response = shop_response(action, tuple(row) if row else None)
+            if row and row['ok']:
+                await publish_user_event(conn, identity['user_id'], shop_event(action, payload, response), session_id)
+                if action == 'change_name':
+                    await publish_invalidation(conn, "identities", [identity['tg_id']])
+                await transaction.commit()
+                if action == 'change_name':
+                    IDENTITY_CACHE.invalidate(identity['tg_id'])
+            else:
+                await transaction.rollback()
+            return JSONResponse(response)
+
+    except Exception as e:
+        print(f"Update API Error: {e}")
+        return JSONResponse({"success": False})
+
+async def events_api(request):
+    session_id = request.query_params.get("session")
+    if not session_id: return JSONResponse({"success": False}, status_code=400)
+
+    try:
+        async with db_connection() as conn:
+            if not conn: return JSONResponse({"success": False, "error": "DB Error"}, status_code=503)
+            identity = await resolve_session(conn, session_id)
+    except Exception as e:
+        print(f"Events API Error: {e}")
+        return JSONResponse({"success": False}, status_code=500)
+    if not identity:
+        return JSONResponse({"success": False, "error": "User not found"}, status_code=401)
+
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue(EVENT_QUEUE_MAX)
+    overflow = asyncio.Event()
+
+    def deliver(event):
+        try:
+            events.put_nowait(event)
+        except asyncio.QueueFull:
+            overflow.set()
+
+    # EVENTS.publish зовёт push из потока слушателя, поэтому доставка — через цикл событий
+    subscription = EVENTS.subscribe(identity['user_id'], session_id, lambda event: loop.call_soon_threadsafe(deliver, event))
+    if subscription is None:
+        return JSONResponse({"success": False, "error": "Too many streams"}, status_code=503, headers={"Retry-After": "30"})
+
+    async def stream():
+        try:
+            yield sse_message("hello", {"origin": event_origin(session_id)}, retry=EVENT_RETRY_MS)
+            deadline = time.monotonic() + EVENT_STREAM_MAX_AGE
+            while time.monotonic() < deadline and not overflow.is_set():
+                try:
+                    event = await asyncio.wait_for(events.get(), EVENT_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                if event is None:
+                    break
+                yield sse_message(event["type"], event)
+        finally:
+            EVENTS.unsubscribe(subscription)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+async def telegram_webhook(request):
+    if not webhook_secret_ok(request.headers.get("x-telegram-bot-api-secret-token")):
+        return JSONResponse({"success": False}, status_code=403)
+    try:
+        update = types.Update.de_json((await request.body()).decode("utf-8"))
+    except Exception as e:
+        print(f"Webhook parse error: {e}")
+        return JSONResponse({"success": False}, status_code=400)
+    # Обработчики бота синхронные и живут в потоках BOT_DISPATCHER; здесь только постановка в очередь
+    if not BOT_DISPATCHER.submit(update, block=False):
+        return JSONResponse({"success": False, "error": "Busy"}, status_code=503)
+    return JSONResponse({"success": True})
+
+async def metrics_api(request):
+    if not METRICS_ENABLED:
+        return PlainTextResponse("Not Found", status_code=404)
+    if not metrics_allowed(request.headers.get("authorization")):
+        return PlainTextResponse("Forbidden", status_code=403)
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+async def analytics_api(request):
+    if not admin_allowed(request.headers.get("authorization")):
+        return JSONResponse({"success": False, "error": "Forbidden"}, status_code=403)
+    try:
+        days = min(max(1, int(request.query_params.get("days", 7))), ANALYTICS_DAYS_MAX)
+    except ValueError:
+        return JSONResponse({"success": False, "error": "Invalid days"}, status_code=400)
+    game_id = request.query_params.get("game_id")
+
+    try:
+        async with db_connection() as conn:
+            if not conn: return JSONResponse({"success": False, "error": "DB Error"}, status_code=500)
+            rows = [analytics_row(r) for r in await conn.fetch(numbered(ANALYTICS_SQL), days, game_id, game_id)]
+        return JSONResponse({"success": True, "days": rows, "summary": analytics_summary(rows), "rollup": ANALYTICS.last_report})
+    except Exception as e:
+        print(f"Analytics API Error: {e}")
+        return JSONResponse({"success": False}, status_code=500)
+
+async def readiness_api(request):
+    version = None
+    try:
+        async with db_connection() as conn:
+            if conn:
+                exists = await conn.fetchval("SELECT to_regclass('schema_migrations') IS NOT NULL")
+                version = await conn.fetchval(SCHEMA_VERSION_SQL) if exists else 0
+    except Exception as e:
+        print(f"Readiness Error: {e}")
+    payload, status = readiness_payload(version)
+    return JSONResponse(payload, status_code=status)
+
+async def db_pool_stats(request):
+    if _pool is None: return JSONResponse({"success": False, "error": "DB Error"}, status_code=503)
+    return JSONResponse({"success": True, "pool": {
+        "driver": "asyncpg",
+        "min": _pool.get_min_size(),
+        "max": _pool.get_max_size(),
+        "size": _pool.get_size(),
+        "idle": _pool.get_idle_size(),
+    }})
+
+async def cache_stats(request):
+    return JSONResponse({"success": True, "sessions": SESSION_CACHE.stats(), "identities": IDENTITY_CACHE.stats(), "avatars": AVATARS.stats(), "static": STATIC_ASSETS.stats(),
+                         "listener": LISTENER.stats(), "events": EVENTS.stats()})
+
+async def score_buffer_stats(request):
+    if not SCORE_BUFFER:
+        return JSONResponse({"success": True, "write_behind": False, "admission": SCORE_GATE.stats()})
+    return JSONResponse({"success": True, "write_behind": True, "admission": SCORE_GATE.stats(), **SCORE_BUFFER.stats()})
+
+async def session_janitor_stats(request):
+    return JSONResponse({"success": True, "last_sweep": SESSION_JANITOR.last_report, "total_reclaimed": SESSION_JANITOR.total_reclaimed})
+
+async def bot_dispatcher_stats(request):
+    return JSONResponse({"success": True, **BOT_DISPATCHER.stats(), "leader": BOT_LEADER.stats()})
+
+async def outbox_stats(request):
+    pending = None
+    async with db_connection() as conn:
+        if conn:
+            pending = await conn.fetchval("SELECT COUNT(*) FROM notification_outbox WHERE sent_at IS NULL AND attempts < $1", OUTBOX_MAX_ATTEMPTS)
+    return JSONResponse({"success": True, "pending": pending, **OUTBOX.stats()})
+
+async def serve_static(request):
+    result = STATIC_ASSETS.respond(request.path_params.get("path", "index.html"),
+                                   request.headers.get("accept-encoding"), request.headers.get("if-none-match"))
+    if result is None:
+        return Response("Not Found", status_code=404)
+    status, headers, body, file_path = result
+    if file_path:
+        return FileResponse(file_path, headers=headers, media_type=headers["Content-Type"])
+    return Response(body, status_code=status, headers=headers)
+
+
+# =============== ASGI APP ===============
+def observe_query(record):
+    name = statement_name(record.query)
+    DB_QUERY_LATENCY.observe((name,), record.elapsed)
+    if record.exception is not None:
+        DB_QUERY_ERRORS.inc((name,))
+
+async def init_connection(conn):
+    # Как psycopg2: json/jsonb из БД сразу приходят разобранными
+    for type_name in ('json', 'jsonb'):
+        await conn.set_type_codec(type_name, encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+    if METRICS_ENABLED:
+        conn.add_query_logger(observe_query)
+
+def async_pool_gauges():
+    if _pool is None:
+        return []
+    size, idle = _pool.get_size(), _pool.get_idle_size()
+    return [
+        ("app_db_pool_connections", {"state": "in_use", "driver": "asyncpg"}, size - idle),
+        ("app_db_pool_connections", {"state": "idle", "driver": "asyncpg"}, idle),
+        ("app_db_pool_max_connections", {"driver": "asyncpg"}, _pool.get_max_size()),
+    ]
+
+
+class MetricsMiddleware:
+    """Задержка и число запросов по шаблону маршрута, как хуки Flask в server.py."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = ROUTE_TEMPLATES.get(scope.get("endpoint"), "unmatched")
+            HTTP_LATENCY.observe((route, scope["method"]), time.perf_counter() - started)
+            HTTP_REQUESTS.inc((route, scope["method"], str(status[0])))
+
+@asynccontextmanager
+async def lifespan(app):
+    global _pool
+    if DATABASE_URL:
+        try:
+            _pool = await asyncpg.create_pool(DATABASE_URL, min_size=ASYNC_DB_POOL_MIN, max_size=ASYNC_DB_POOL_MAX,
+                                              ssl=DB_SSLMODE, init=init_connection)
+        except Exception as e:
+            print(f"DB Connection Error: {e}")
+    start_background_workers()
+    try:
+        yield
+    finally:
+        if _pool is not None:
+            await asyncio.wait_for(_pool.close(), ASYNC_DB_POOL_TIMEOUT)
+            _pool = None
+
+app = Starlette(
+    routes=[
+        Route("/api/auth/verify", verify, methods=["POST"]),
+        Route("/api/auth/logout", logout, methods=["POST"]),
+        Route("/api/user", get_user_info, methods=["GET"]),
+        Route("/api/bootstrap", bootstrap_api, methods=["GET"]),
+        Route("/api/game/start", start_game_api, methods=["POST"]),
+        Route("/api/game/score", save_score_api, methods=["POST"]),
+        Route("/api/game/scores/batch", save_scores_batch_api, methods=["POST"]),
+        Route("/api/leaderboard/{game_id}", leaderboard_api, methods=["GET"]),
+        Route("/api/avatar/{tg_id:int}", avatar_api, methods=["GET"]),
+        Route("/api/user/update", update_user_api, methods=["POST"]),
+        Route("/api/events", events_api, methods=["GET"]),
+        *([Route(BOT_WEBHOOK_PATH, telegram_webhook, methods=["POST"])] if BOT_MODE == "webhook" else []),
+        Route("/metrics", metrics_api, methods=["GET"]),
+        Route("/api/admin/analytics", analytics_api, methods=["GET"]),
+        Route("/api/ready", readiness_api, methods=["GET"]),
+        Route("/api/health/db", db_pool_stats, methods=["GET"]),
+        Route("/api/health/cache", cache_stats, methods=["GET"]),
+        Route("/api/health/scores", score_buffer_stats, methods=["GET"]),
+        Route("/api/health/sessions", session_janitor_stats, methods=["GET"]),
+        Route("/api/health/bot", bot_dispatcher_stats, methods=["GET"]),
+        Route("/api/health/outbox", outbox_stats, methods=["GET"]),
+        Route("/", serve_static, methods=["GET"]),
+        Route("/{path:path}", serve_static, methods=["GET"]),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])]
+               + ([Middleware(MetricsMiddleware)] if METRICS_ENABLED else []),
+    lifespan=lifespan,
+)
+ROUTE_TEMPLATES = {route.endpoint: route.path for route in app.routes}
+if METRICS_ENABLED:
+    METRIC_GAUGES.append(async_pool_gauges)
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=PORT)
@@ -9,13 +9,44 @@ interface ShopProps {
   coins: number;
   // Исправляем сигнатуру функции: теперь она принимает itemId
   onSpendCoins: (amount: number, itemId: string) => boolean; 
+  // Покупка нескольких товаров одним запросом
+  onBuyItems: (items: ShopItem[]) => Promise<boolean>;
   onUpdateUser: (updates: Partial<UserProfile>) => void;
   onBack: () => void;
 }
 
-const Shop: React.FC<ShopProps> = ({ user, coins, onSpendCoins, onUpdateUser, onBack }) => {
+const Shop: React.FC<ShopProps> = ({ user, coins, onSpendCoins, onBuyItems, onUpdateUser, onBack }) => {
   const [error, setError] = useState<string | null>(null);
   const [success, setSuccess] = useState<string | null>(null);
+  const [cart, setCart] = useState<Set<string>>(new Set());
+
+  const cartItems = SHOP_ITEMS.filter(item => cart.has(item.id) && !user.inventory.includes(item.id));
+  const cartTotal = cartItems.reduce((sum, item) => sum + item.price, 0);
+
+  const toggleCart = (itemId: string) => {
+    setCart(prev => {
+      const next = new Set(prev);
+      if (next.has(itemId)) next.delete(itemId); else next.add(itemId);
+      return next;
+    });
+  };
+
+  const handleBuyCart = async () => {
+    setError(null);
+    setSuccess(null);
+    if (coins < cartTotal) {
+      setError(`Недостаточно монет. Нужно еще ${cartTotal - coins}.`);
+      return;
+    }
+    if (await onBuyItems(cartItems)) {
+      const boosts = cartItems.filter(item => item.type === 'boost').map(item => item.id);
+      if (boosts.length) onUpdateUser({ activeBoosts: [...user.activeBoosts, ...boosts] });
+      setSuccess(`Куплено товаров: ${cartItems.length}`);
+      setCart(new Set());
+    } else {
+      setError('Не удалось оформить покупку');
+    }
+  };
 
   const handlePurchase = (item: ShopItem) => {
     setError(null);
@@ -111,6 +142,15 @@ const Shop: React.FC<ShopProps> = ({ user, coins, onSpendCoins, onUpdateUser, on
                                   {!owned ? <><Coins size={12}/> {item.price}</> : (item.type === 'theme' ? 'Куплено' : '')}
                               </span>
                               
+                              <div className="flex items-center gap-2">
+                              {!owned && (
+                                <button
+                                  onClick={() => toggleCart(item.id)}
+                                  className={`px-2 py-1.5 rounded-lg text-xs font-bold transition-all ${cart.has(item.id) ? 'bg-yellow-500/30 text-yellow-300' : 'bg-white/10 text-textMuted hover:bg-white/20'}`}
+                                >
+                                  {cart.has(item.id) ? 'В корзине' : '+ В корзину'}
+                                </button>
+                              )}
                               <button 
                                 onClick={() => handlePurchase(item)}
                                 className={`
@@ -125,6 +165,7 @@ const Shop: React.FC<ShopProps> = ({ user, coins, onSpendCoins, onUpdateUser, on
                               >
                                   {active ? 'Отключить' : (owned && item.type === 'theme' ? 'Применить' : 'Купить')}
                               </button>
+                              </div>
                           </div>
                       </div>
                   </motion.div>
@@ -132,6 +173,15 @@ const Shop: React.FC<ShopProps> = ({ user, coins, onSpendCoins, onUpdateUser, on
           })}
       </div>
 
+      {cartItems.length > 0 && (
+        <button
+          onClick={handleBuyCart}
+          className="mt-2 w-full bg-gradient-to-r from-yellow-500 to-orange-500 text-black font-bold p-3 rounded-xl flex items-center justify-center gap-2 shadow-lg"
+        >
+          <ShoppingBag size={18} /> Купить выбранное ({cartItems.length}) — <Coins size={16} /> {cartTotal}
+        </button>
+      )}
+
       {/* Messages */}
       {error && (
         <div className="mt-auto p-3 bg-red-500/10 border border-red-500/20 rounded-xl flex items-center gap-2 text-red-400 text-sm animate-in fade-in slide-in-from-bottom-2">
@@ -0,0 +1,283 @@
+# Потоковая выгрузка и загрузка данных игроков через COPY (резервная копия, переезд, наполнение).
+#
+# Запуск:
+#   python dataio.py export dump/ --format ndjson --gzip
+#   python dataio.py export dump/ --format csv --since 2025-01-01 --until 2025-07-01
+#   python dataio.py import dump/
+#
+# Таблицы обходятся в порядке зависимостей (users первой), game_scores режется на месячные куски.
+# Каждый кусок — отдельный файл, данные идут COPY прямо в файл и обратно, поэтому память не растёт
+# с размером таблиц. manifest.json (выгрузка) и import_state.json (загрузка) хранят готовые куски:
+# повторный запуск с теми же параметрами продолжает с места обрыва. Продолженная выгрузка читает
+# уже другой снимок, поэтому все куски ограничены MAX(users.id) и MAX(game_scores.id) первого запуска.
+#
+# Загрузка сохраняет id и пропускает строки с уже существующими ключами (ON CONFLICT DO NOTHING).
+# Она рассчитана на пустую базу или на ту же самую базу. Непустую чужую базу надо подтвердить флагом --merge.
+import argparse
+import csv
+import gzip
+import json
+import os
+import time
+from datetime import date, datetime, timezone
+from urllib.parse import urlparse
+
+import psycopg2
+from psycopg2 import sql
+
+import server
+
+MANIFEST = "manifest.json"
+IMPORT_STATE = "import_state.json"
+# Порядок важен: сначала то, на что ссылаются внешние ключи
+TABLES = ["users", "stats", "user_progress", "achievement_rules", "user_achievements", "user_best_scores",
+          "user_game_counters", "game_scores_daily", "game_scores_rollups", "game_scores"]
+# Таблицы, где выгрузка важнее значений в базе (правила засеяны миграцией): конфликт по ключу обновляет строку
+UPSERT_KEYS = {"achievement_rules": "id"}
+# Сеансовые и служебные таблицы (sessions, auth_tokens, notification_outbox, rate_limit_buckets, play_tokens_used)
+# не переносятся, а game_stats_daily пересчитывается аналитикой после загрузки
+SEQUENCES = [("users", "id"), ("stats", "id"), ("game_scores", "id")]
+# NDJSON идёт через CSV с символами, которых нет в тексте row_to_json: строки копируются как есть
+NDJSON_COPY = "WITH (FORMAT csv, QUOTE e'\\x01', DELIMITER e'\\x02')"
+
+
+def connect():
+    if not server.DATABASE_URL:
+        raise SystemExit("Задайте DATABASE_URL")
+    return psycopg2.connect(server.DATABASE_URL, sslmode=server.DB_SSLMODE)
+
+def open_data(path, mode):
+    return gzip.open(path, mode) if path.endswith(".gz") else open(path, mode)
+
+def read_json(path, default=None):
+    if not os.path.exists(path):
+        return default
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def write_json(path, data):
+    # Через временный файл: оборванная запись не портит состояние
+    with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2, default=str)
+    os.replace(f"{path}.tmp", path)
+
+def table_columns(cursor, table):
+    cursor.execute("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s
+        ORDER BY ordinal_position
+    """, (table,))
+    return [r[0] for r in cursor.fetchall()]
+
+def add_month(day):
+    return date(day.year + day.month // 12, day.month % 12 + 1, 1)
+
+
+# =============== EXPORT ===============
+def score_months(cursor, since, until):
+    """Месяцы [начало, конец) с партиями в диапазоне since..until для нарезки game_scores."""
+    cursor.execute("""
+        SELECT MIN(created_at), MAX(created_at) FROM game_scores
+        WHERE (%s::date IS NULL OR created_at >= %s::date) AND (%s::date IS NULL OR created_at < %s::date)
+    """, (since, since, until, until))
+    first, last = cursor.fetchone()
+    if first is None:
+        return []
+    months, month = [], first.date().replace(day=1)
+    while month <= last.date():
+        months.append((month, add_month(month)))
+        month = add_month(month)
+    return months
+
+def export_bounds(cursor):
+    """Верхние границы id на момент первого запуска: по ним же режутся куски продолженной выгрузки."""
+    cursor.execute("SELECT (SELECT COALESCE(MAX(id), 0) FROM users), (SELECT COALESCE(MAX(id), 0) FROM game_scores)")
+    users_max_id, scores_max_id = cursor.fetchone()
+    return {"users_max_id": users_max_id, "game_scores_max_id": scores_max_id}
+
+def export_units(cursor, since, until):
+    units = [{"name": table, "table": table, "range": None} for table in TABLES if table != "game_scores"]
+    for start, end in score_months(cursor, since, until):
+        # Границы куска сужаются фильтром, чтобы в файл не попало лишнее
+        low = max(start, date.fromisoformat(since)) if since else start
+        high = min(end, date.fromisoformat(until)) if until else end
+        units.append({"name": f"game_scores.{start:%Y-%m}", "table": "game_scores", "range": [low.isoformat(), high.isoformat()]})
+    return units
+
+def export_query(unit, columns, fmt, bounds):
+    conditions = []
+    if unit["table"] == "users":
+        conditions.append(sql.SQL("id <= {}").format(sql.Literal(bounds["users_max_id"])))
+    elif "user_id" in columns:
+        # Строки пользователей, появившихся после первого запуска, сослались бы на отсутствующих в users
+        conditions.append(sql.SQL("user_id <= {}").format(sql.Literal(bounds["users_max_id"])))
+    if unit["table"] == "game_scores":
+        conditions.append(sql.SQL("id <= {}").format(sql.Literal(bounds["game_scores_max_id"])))
+    if unit["range"]:
+        conditions.append(sql.SQL("created_at >= {} AND created_at < {}").format(*map(sql.Literal, unit["range"])))
+    select = sql.SQL("SELECT {} FROM {}").format(sql.SQL(", ").join(map(sql.Identifier, columns)), sql.Identifier(unit["table"]))
+    if conditions:
+        select += sql.SQL(" WHERE ") + sql.SQL(" AND ").join(conditions)
+    if fmt == "csv":
+        return sql.SQL("COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER true)").format(select)
+    return sql.SQL("COPY (SELECT row_to_json(t) FROM ({}) t) TO STDOUT " + NDJSON_COPY).format(select)
+
+def export_data(directory, fmt, compress, since, until):
+    os.makedirs(directory, exist_ok=True)
+    manifest_path = os.path.join(directory, MANIFEST)
+    settings = {"format": fmt, "gzip": compress, "since": since, "until": until}
+    manifest = read_json(manifest_path)
+    if manifest and {k: manifest.get(k) for k in settings} != settings:
+        raise SystemExit(f"В {directory} уже есть выгрузка с другими параметрами: {manifest_path}")
+
+    conn = connect()
+    # Один запуск читает один снимок; между запусками согласованность держат границы из manifest
+    conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+    try:
+        with conn.cursor() as cursor:
+            if not manifest:
+                manifest = {**settings, "schema_version": server.SCHEMA_VERSION, "started_at": datetime.now(timezone.utc).isoformat(),
+                            "finished_at": None, "bounds": export_bounds(cursor), "units": export_units(cursor, since, until)}
+                write_json(manifest_path, manifest)
+            ext = ("csv" if fmt == "csv" else "ndjson") + (".gz" if compress else "")
+            for unit in manifest["units"]:
+                if unit.get("done"):
+                    continue
+                started = time.time()
+                unit["columns"] = table_columns(cursor, unit["table"])
+                unit["file"] = f"{unit['name']}.{ext}"
+                path = os.path.join(directory, unit["file"])
+                with open_data(f"{path}.part", 'wb') as f:
+                    cursor.copy_expert(export_query(unit, unit["columns"], fmt, manifest["bounds"]), f, size=1 << 16)
+                os.replace(f"{path}.part", path)
+                # rowcount после COPY — число строк из ответа сервера (-1, если драйвер его не знает)
+                unit["rows"], unit["done"] = (cursor.rowcount if cursor.rowcount >= 0 else None), True
+                write_json(manifest_path, manifest)
+                print(f"{unit['name']:>22}: {unit['rows']} rows in {time.time() - started:.1f}s")
+        manifest["finished_at"] = datetime.now(timezone.utc).isoformat()
+        write_json(manifest_path, manifest)
+    finally:
+        conn.close()
+    print(f"Export finished: {sum(u['rows'] or 0 for u in manifest['units'])} rows in {directory}")
+
+
+# =============== IMPORT ===============
+def stage_unit(cursor, unit, path, fmt):
+    """Копирует файл куска во временную import_stage; возвращает столбцы, которые в нём есть."""
+    with open_data(path, 'rb') as f:
+        if fmt == "csv":
+            # Заголовок читается отдельно, остальное уходит в COPY потоком
+            header = next(csv.reader([f.readline().decode('utf-8')]))
+            cursor.execute(sql.SQL("CREATE TEMP TABLE import_stage (LIKE {}) ON COMMIT DROP").format(sql.Identifier(unit["table"])))
+            cursor.copy_expert(sql.SQL("COPY import_stage ({}) FROM STDIN WITH (FORMAT csv)").format(
+                sql.SQL(", ").join(map(sql.Identifier, header))), f, size=1 << 16)
+            return header
+        cursor.execute("CREATE TEMP TABLE import_stage (doc JSONB) ON COMMIT DROP")
+        cursor.copy_expert("COPY import_stage (doc) FROM STDIN " + NDJSON_COPY, f, size=1 << 16)
+        return unit["columns"]
+
+def import_unit(cursor, unit, path, fmt):
+    target = table_columns(cursor, unit["table"])
+    columns = [c for c in stage_unit(cursor, unit, path, fmt) if c in target]
+    if unit["table"] == "game_scores":
+        # Старые месяцы получают свои партиции, а не оседают в game_scores_default
+        cursor.execute("SELECT MIN(created_at) FROM import_stage" if fmt == "csv"
+                       else "SELECT MIN((doc->>'created_at')::timestamp) FROM import_stage")
+        first = cursor.fetchone()[0]
+        if first:
+            server.ensure_score_partitions(cursor, first.date())
+    names = sql.SQL(", ").join(map(sql.Identifier, columns))
+    if fmt == "csv":
+        source = sql.SQL("SELECT {} FROM import_stage").format(names)
+    else:
+        source = sql.SQL("SELECT {} FROM import_stage s, jsonb_populate_record(NULL::{}, s.doc) r").format(
+            sql.SQL(", ").join(sql.Identifier("r", c) for c in columns), sql.Identifier(unit["table"]))
+    key = UPSERT_KEYS.get(unit["table"])
+    if key:
+        conflict = sql.SQL("ON CONFLICT ({}) DO UPDATE SET {}").format(sql.Identifier(key), sql.SQL(", ").join(
+            sql.SQL("{0} = EXCLUDED.{0}").format(sql.Identifier(c)) for c in columns if c != key))
+    else:
+        conflict = sql.SQL("ON CONFLICT DO NOTHING")
+    cursor.execute(sql.SQL("INSERT INTO {} ({}) {} {}").format(sql.Identifier(unit["table"]), names, source, conflict))
+    return cursor.rowcount
+
+def finish_import(cursor, tables):
+    for table, column in SEQUENCES:
+        cursor.execute(sql.SQL("SELECT setval(pg_get_serial_sequence(%s, %s), COALESCE(MAX({}), 0) + 1, false) FROM {}").format(
+            sql.Identifier(column), sql.Identifier(table)), (table, column))
+    if "game_scores" in tables:
+        # Один ограниченный пересчёт окна аналитики; дальше фоновая задача идёт от MAX(id)
+        server.ANALYTICS.backfill(cursor)
+    # Запущенные процессы сбрасывают кэши (в том числе IDENTITY_CACHE) и перечитывают лидерборды после COMMIT
+    server.publish_invalidation(cursor, "all")
+    server.clear_identity_caches()
+
+def import_data(directory, merge):
+    manifest = read_json(os.path.join(directory, MANIFEST))
+    if not manifest:
+        raise SystemExit(f"Нет {MANIFEST} в {directory}")
+    if not manifest.get("finished_at"):
+        raise SystemExit("Выгрузка не завершена: допишите её повторным export с теми же параметрами")
+    if manifest["schema_version"] > server.SCHEMA_VERSION:
+        raise SystemExit(f"Выгрузка сделана на схеме {manifest['schema_version']}, здесь только {server.SCHEMA_VERSION}")
+    if (server.migrate_schema() or 0) < server.SCHEMA_VERSION:
+        raise SystemExit("Не удалось применить миграции: проверьте DATABASE_URL и DB_SSLMODE")
+
+    url = urlparse(server.DATABASE_URL)
+    target = f"{url.hostname}:{url.port or 5432}{url.path}"
+    state_path = os.path.join(directory, IMPORT_STATE)
+    state = read_json(state_path)
+    if not state or state.get("target") != target or state.get("started_at") != manifest["started_at"]:
+        state = {"target": target, "started_at": manifest["started_at"], "done": {}}
+
+    conn = connect()
+    try:
+        with conn.cursor() as cursor:
+            # Каждый кусок фиксируется отдельно и повторяем, поэтому ожидание fsync не нужно
+            cursor.execute("SET synchronous_commit TO off")
+            if not state["done"] and not merge:
+                cursor.execute("SELECT EXISTS (SELECT 1 FROM users)")
+                if cursor.fetchone()[0]:
+                    raise SystemExit("В базе уже есть пользователи; для слияния запустите с --merge")
+            conn.commit()
+            for unit in manifest["units"]:
+                if unit["name"] in state["done"]:
+                    continue
+                started = time.time()
+                inserted = import_unit(cursor, unit, os.path.join(directory, unit["file"]), manifest["format"])
+                conn.commit()
+                state["done"][unit["name"]] = inserted
+                write_json(state_path, state)
+                print(f"{unit['name']:>22}: {inserted}/{unit['rows']} rows in {time.time() - started:.1f}s")
+            finish_import(cursor, {unit["table"] for unit in manifest["units"]})
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    print(f"Import finished: {sum(state['done'].values())} rows inserted from {directory}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Выгрузка и загрузка данных игроков через COPY.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="выгрузить таблицы в каталог")
+    export_parser.add_argument("directory")
+    export_parser.add_argument("--format", choices=("ndjson", "csv"), default="ndjson")
+    export_parser.add_argument("--gzip", action="store_true", help="сжимать файлы")
+    export_parser.add_argument("--since", type=date.fromisoformat, help="game_scores с этой даты (YYYY-MM-DD)")
+    export_parser.add_argument("--until", type=date.fromisoformat, help="game_scores до этой даты, не включая")
+    import_parser = commands.add_parser("import", help="загрузить выгрузку из каталога")
+    import_parser.add_argument("directory")
+    import_parser.add_argument("--merge", action="store_true", help="разрешить загрузку в непустую базу")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_data(args.directory, args.format, args.gzip,
+                    args.since.isoformat() if args.since else None, args.until.isoformat() if args.until else None)
+    else:
+        import_data(args.directory, args.merge)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+# Продакшен-запуск Flask-приложения на всех ядрах:  gunicorn -c gunicorn.conf.py server:app
+#
+# Миграции выполняются один раз в мастере до форка воркеров. Каждый воркер запускает свои
+# фоновые потоки, а Telegram опрашивает только выбранный лидер (server.BotLeader).
+# Кэши сессий между воркерами синхронизирует LISTEN/NOTIFY (server.NotificationListener).
+import multiprocessing
+import os
+import subprocess
+import sys
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+# Обработчики в основном ждут БД, поэтому в каждом воркере ещё и пул потоков
+worker_class = "gthread"
+threads = int(os.getenv("WEB_THREADS", 8))
+# SSE-поток /api/events держит поток воркера, пока открыт: не отдаём им больше половины
+os.environ.setdefault("EVENT_STREAMS_MAX", str(max(1, threads // 2)))
+timeout = int(os.getenv("WEB_TIMEOUT", 60))
+graceful_timeout = 30
+keepalive = 5
+# Приложение импортируется в каждом воркере после fork: пул БД, потоки и сокеты у каждого свои
+preload_app = False
+accesslog = os.getenv("WEB_ACCESS_LOG") or None
+
+if workers > 1 and os.getenv("SCORE_WRITE_BEHIND") == "1":
+    print("WARNING: SCORE_WRITE_BEHIND держит xp/level в памяти процесса и несовместим с несколькими воркерами — отключён.")
+    os.environ["SCORE_WRITE_BEHIND"] = "0"
+if workers > 1 and os.getenv("RATE_LIMIT_BACKEND", "memory") == "memory":
+    print(f"WARNING: RATE_LIMIT_BACKEND=memory считает лимиты очков в каждом воркере отдельно — "
+          f"фактический лимит в {workers} раз выше; общий даёт RATE_LIMIT_BACKEND=postgres.")
+
+def on_starting(server):
+    if os.getenv("AUTO_MIGRATE", "1") == "1":
+        # Отдельным процессом: мастер не должен держать соединения, которые унаследуют воркеры
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+        if subprocess.run([sys.executable, script, "migrate"]).returncode != 0:
+            # БД недоступна: воркеры стартуют, /api/ready отвечает 503, а миграции повторит каждый воркер
+            # (под advisory-блокировкой, так что применит их только первый)
+            print("WARNING: миграции не применились, воркеры попробуют ещё раз при старте.")
+            return
+    # Схема уже актуальна; воркерам не нужно проверять её заново
+    os.environ["AUTO_MIGRATE"] = "0"
+
+def post_worker_init(worker):
+    import server as app_module
+    app_module.start_background_workers()
@@ -1,16 +1,40 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_file, Response, g
 from flask_cors import CORS
 import threading
 import telebot
-from telebot import types 
+from telebot import types, apihelper
 import uuid
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+from psycopg2 import sql
 import os
+import sys
 import json
+import time
+import math
+import bisect
+import atexit
+import hashlib
+import functools
+import hmac
+import queue
+import gzip
+import re
+import select
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from collections import OrderedDict, deque
 from urllib.parse import urlparse
 from datetime import datetime, timezone, timedelta
 
+try:
+    import brotli  # необязательно: без него статика сжимается только gzip
+except ImportError:
+    brotli = None
+
 # Загружаем переменные окружения
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 SITE_URL = os.getenv("SITE_URL")
@@ -53,350 +77,3695 @@ GAME_NAMES = {
     '5': 'Шашки', '6': 'Сапёр', '7': 'Пасьянс', '8': 'Tetris', '9': 'Paint'
 }
 
-# =============== DB HELPER ===============
-def get_db_connection():
-    if not DATABASE_URL:
-        return None
+# =============== METRICS ===============
+# Prometheus-метрики на /metrics. METRICS_ENABLED=0 выключает их полностью:
+# хуки Flask, обёртки обработчиков бота, курсоров БД и запросов к Telegram тогда не ставятся.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+# Границы корзин гистограмм задержки, в секундах
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def metric_labels(labelnames, values):
+    if not labelnames:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{k}="{v}"' for k, v in zip(labelnames, escaped)) + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{metric_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series = {}  # labels -> [счётчики по корзинам (последняя — +Inf), сумма]
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = sorted((labels, list(series)) for labels, series in self._series.items())
+        for labels, series in snapshot:
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                total += count
+                lines.append(f"{self.name}_bucket{metric_labels(self.labelnames + ('le',), labels + (bound,))} {total}")
+            label_str = metric_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_str} {series[-1]:.6f}")
+            lines.append(f"{self.name}_count{label_str} {total}")
+        return lines
+
+
+HTTP_REQUESTS = Counter("app_http_requests_total", "HTTP requests by route, method and status.", ("route", "method", "status"))
+HTTP_LATENCY = Histogram("app_http_request_duration_seconds", "HTTP request latency by route.", ("route", "method"))
+BOT_HANDLER_LATENCY = Histogram("app_bot_handler_duration_seconds", "Bot handler latency.", ("handler",))
+BOT_HANDLER_ERRORS = Counter("app_bot_handler_errors_total", "Bot handler exceptions.", ("handler",))
+DB_QUERY_LATENCY = Histogram("app_db_query_duration_seconds", "DB statement latency by statement name.", ("statement",))
+DB_QUERY_ERRORS = Counter("app_db_query_errors_total", "Failed DB statements by statement name.", ("statement",))
+TELEGRAM_LATENCY = Histogram("app_telegram_request_duration_seconds", "Telegram Bot API call latency.", ("method",))
+TELEGRAM_ERRORS = Counter("app_telegram_errors_total", "Failed Telegram Bot API calls.", ("method", "reason"))
+ADMISSION_REJECTED = Counter("app_admission_rejected_total", "Score submissions rejected before the DB.", ("reason",))
+
+# Функции, возвращающие [(имя, {метки}, значение)] для gauge-метрик, снимаемых в момент запроса /metrics
+METRIC_GAUGES = []
+
+def render_metrics():
+    lines = []
+    for metric in (HTTP_REQUESTS, HTTP_LATENCY, BOT_HANDLER_LATENCY, BOT_HANDLER_ERRORS,
+                   DB_QUERY_LATENCY, DB_QUERY_ERRORS, TELEGRAM_LATENCY, TELEGRAM_ERRORS, ADMISSION_REJECTED):
+        lines.extend(metric.render())
+    seen = set()
+    for collect in METRIC_GAUGES:
+        try:
+            samples = collect()
+        except Exception as e:
+            print(f"Metrics gauge error: {e}")
+            continue
+        for name, labels, value in samples:
+            if value is None:
+                continue
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name}{metric_labels(tuple(labels), tuple(labels.values()))} {value}")
+    return "\n".join(lines) + "\n"
+
+# Имя выражения: /* name */ в начале SQL или «глагол_таблица», например update_sessions
+SQL_NAME_RE = re.compile(r"\b(insert\s+into|update|delete\s+from|from)\s+([a-z_][a-z0-9_]*)", re.I)
+_statement_names = {}
+
+def statement_name(query):
+    if isinstance(query, bytes):
+        # execute_values: значения уже подставлены в текст, кэшировать по нему бессмысленно
+        key, cacheable = query[:300].decode('utf-8', 'replace'), False
+    elif isinstance(query, str):
+        key, cacheable = query[:300], True
+    else:
+        return "dynamic"  # psycopg2.sql.Composed — DDL партиций и т.п.
+    name = _statement_names.get(key) if cacheable else None
+    if name is None:
+        head = key.lstrip()
+        if head.startswith("/*"):
+            name = head[2:head.find("*/")].strip()
+        else:
+            match = SQL_NAME_RE.search(head)
+            if match:
+                name = f"{match.group(1).split()[0].lower()}_{match.group(2).lower()}".replace("from_", "select_", 1)
+            else:
+                name = (head.split(None, 1) or ["empty"])[0].lower()
+        if cacheable and len(_statement_names) < 1000:
+            _statement_names[key] = name
+    return name
+
+_timed_cursor_classes = {}
+
+def timed_cursor_class(base):
+    """Подкласс курсора base, пишущий время каждого execute в DB_QUERY_LATENCY."""
+    cls = _timed_cursor_classes.get(base)
+    if cls is None:
+        def execute(self, query, vars=None):
+            started = time.perf_counter()
+            try:
+                return base.execute(self, query, vars)
+            except Exception:
+                DB_QUERY_ERRORS.inc((statement_name(query),))
+                raise
+            finally:
+                DB_QUERY_LATENCY.observe((statement_name(query),), time.perf_counter() - started)
+        cls = _timed_cursor_classes[base] = type(f"Timed{base.__name__}", (base,), {"execute": execute})
+    return cls
+
+
+class TimedConnection(psycopg2.extensions.connection):
+    """Соединение, чьи курсоры (любого cursor_factory) замеряют время выражений."""
+
+    def cursor(self, *args, **kwargs):
+        kwargs["cursor_factory"] = timed_cursor_class(kwargs.get("cursor_factory") or psycopg2.extensions.cursor)
+        return super().cursor(*args, **kwargs)
+
+def timed_telegram_request(method, url, **kwargs):
+    """Отправитель запросов для telebot.apihelper с замером времени каждого метода Bot API."""
+    api_method = url.rsplit('/', 1)[-1]
+    started = time.perf_counter()
     try:
-        url = urlparse(DATABASE_URL)
-        conn = psycopg2.connect(
+        response = apihelper._get_req_session().request(method, url, **kwargs)
+    except Exception as e:
+        TELEGRAM_ERRORS.inc((api_method, type(e).__name__))
+        raise
+    finally:
+        TELEGRAM_LATENCY.observe((api_method,), time.perf_counter() - started)
+    if response.status_code != 200:
+        TELEGRAM_ERRORS.inc((api_method, str(response.status_code)))
+    return response
+
+if METRICS_ENABLED:
+    apihelper.CUSTOM_REQUEST_SENDER = timed_telegram_request
+
+# Другой адрес Bot API (локальный сервер Bot API или заглушка бенчмарка), шаблон вида http://host/bot{0}/{1}
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+if TELEGRAM_API_URL:
+    apihelper.API_URL = TELEGRAM_API_URL
+
+
+# =============== DB HELPER ===============
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 5))
+# Соединение, простоявшее дольше этого времени, проверяется SELECT 1 перед выдачей
+DB_POOL_VALIDATE_AFTER = float(os.getenv("DB_POOL_VALIDATE_AFTER", 30))
+# Локальный PostgreSQL (бенчмарки, разработка) обычно без TLS: DB_SSLMODE=disable
+DB_SSLMODE = os.getenv("DB_SSLMODE", "require")
+
+
+class DBPool:
+    """Потокобезопасный пул соединений, общий для Flask и потока бота."""
+
+    def __init__(self, dsn_url, minconn, maxconn, timeout, validate_after):
+        url = urlparse(dsn_url)
+        self._pool = ThreadedConnectionPool(
+            minconn, maxconn,
             dbname=url.path[1:],
             user=url.username,
             password=url.password,
             host=url.hostname,
             port=url.port,
-            sslmode='require'
+            sslmode=DB_SSLMODE,
+            connection_factory=TimedConnection if METRICS_ENABLED else None
         )
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._last_used = {}
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.validate_after = validate_after
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.discarded = 0
+
+    def _is_alive(self, conn):
+        if conn.closed:
+            return False
+        last_used = self._last_used.get(id(conn))
+        if last_used is None or time.monotonic() - last_used < self.validate_after:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def getconn(self):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.waits += 1
+            if not self._slots.acquire(timeout=self.timeout):
+                with self._lock:
+                    self.timeouts += 1
+                raise PoolError("connection pool exhausted")
+        try:
+            conn = self._pool.getconn()
+            if not self._is_alive(conn):
+                self._pool.putconn(conn, close=True)
+                with self._lock:
+                    self.discarded += 1
+                    self._last_used.pop(id(conn), None)
+                conn = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self.in_use += 1
+            self.checkouts += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
         return conn
-    except Exception as e:
-        print(f"DB Connection Error: {e}")
+
+    def putconn(self, conn, close=False):
+        try:
+            if not conn.closed and conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except Exception:
+            close = True
+        with self._lock:
+            self.in_use -= 1
+            if close or conn.closed:
+                self.discarded += 1
+                self._last_used.pop(id(conn), None)
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+        try:
+            self._pool.putconn(conn, close=close or bool(conn.closed))
+        finally:
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max": self.maxconn,
+                "in_use": self.in_use,
+                "idle": len(self._pool._pool),
+                "peak_in_use": self.peak_in_use,
+                "saturation": round(self.in_use / self.maxconn, 3),
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "timeouts": self.timeouts,
+                "discarded": self.discarded,
+            }
+
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    global _db_pool
+    if not DATABASE_URL:
         return None
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                try:
+                    _db_pool = DBPool(DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_VALIDATE_AFTER)
+                except Exception as e:
+                    print(f"DB Connection Error: {e}")
+                    return None
+    return _db_pool
+
+def db_pool_gauges():
+    if _db_pool is None:
+        return []
+    stats = _db_pool.stats()
+    return [
+        ("app_db_pool_connections", {"state": "in_use"}, stats["in_use"]),
+        ("app_db_pool_connections", {"state": "idle"}, stats["idle"]),
+        ("app_db_pool_max_connections", {}, stats["max"]),
+        ("app_db_pool_checkout_waits", {}, stats["waits"]),
+        ("app_db_pool_checkout_timeouts", {}, stats["timeouts"]),
+    ]
 
-def init_db():
+METRIC_GAUGES.append(db_pool_gauges)
+
+@contextmanager
+def db_connection():
+    """Выдаёт соединение из пула (или None, если БД недоступна) и всегда возвращает его обратно.
+
+    Незакоммиченная транзакция откатывается при выходе, в том числе при исключении.
+    """
+    pool = get_db_pool()
+    conn = None
+    if pool:
+        try:
+            conn = pool.getconn()
+        except Exception as e:
+            print(f"DB Connection Error: {e}")
     try:
-        conn = get_db_connection()
-        if not conn:
-            print("Could not connect to DB for init.")
+        yield conn
+    finally:
+        if conn is not None:
+            pool.putconn(conn)
+
+# =============== CACHES ===============
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", 10000))
+SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", 300))
+# Срок жизни сессии; продлевается при использовании
+SESSION_TTL = int(os.getenv("SESSION_TTL", 30 * 24 * 3600))
+IDENTITY_CACHE_SIZE = int(os.getenv("IDENTITY_CACHE_SIZE", 10000))
+IDENTITY_CACHE_TTL = float(os.getenv("IDENTITY_CACHE_TTL", 600))
+
+
+class TTLCache:
+    """Ограниченный по размеру LRU-кэш с TTL и счётчиками попаданий."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+# session_id -> {"user_id", "tg_id", "expires_at"}
+SESSION_CACHE = TTLCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+
+def resolve_session(cursor, session_id):
+    """Возвращает личность пользователя по session_id, по возможности без запроса в БД.
+
+    При обращении к БД заодно продлевает сессию (скользящий срок жизни). Если у вызывающего уже
+    открыта транзакция, продление уходит вместе с ней: чужую транзакцию функция не фиксирует.
+    """
+    identity = SESSION_CACHE.get(session_id)
+    if identity:
+        if identity["expires_at"] > time.time():
+            return identity
+        SESSION_CACHE.invalidate(session_id)
+    owns_transaction = cursor.connection.get_transaction_status() == TRANSACTION_STATUS_IDLE
+    cursor.execute("""
+        UPDATE sessions ses SET expires_at = NOW() + make_interval(secs => %s)
+        FROM users u
+        WHERE u.id = ses.user_id AND ses.session_id=%s AND ses.expires_at > NOW()
+        RETURNING u.id, u.tg_id
+    """, (SESSION_TTL, session_id))
+    row = cursor.fetchone()
+    # Продление должно сохраниться, даже если вызывающий код не делает commit
+    if owns_transaction:
+        cursor.connection.commit()
+    if not row:
+        return None
+    if isinstance(row, dict):
+        row = (row['id'], row['tg_id'])
+    identity = {"user_id": row[0], "tg_id": row[1], "expires_at": time.time() + SESSION_TTL}
+    SESSION_CACHE.set(session_id, identity)
+    return identity
+
+
+# tg_id -> {"user_id", "name"} для обработчиков бота; пользователи без аккаунта не кэшируются
+IDENTITY_CACHE = TTLCache(IDENTITY_CACHE_SIZE, IDENTITY_CACHE_TTL)
+
+def remember_identity(tg_id, user_id, name):
+    identity = {"user_id": user_id, "name": name}
+    IDENTITY_CACHE.set(tg_id, identity)
+    return identity
+
+def bot_identity(cursor, tg_id):
+    """Пользователь по Telegram id: из IDENTITY_CACHE или одним запросом; None, если /start ещё не нажимали."""
+    identity = IDENTITY_CACHE.get(tg_id)
+    if identity:
+        return identity
+    cursor.execute("""
+        SELECT u.id, COALESCE(p.display_name, u.username) FROM users u
+        LEFT JOIN user_progress p ON p.user_id = u.id
+        WHERE u.tg_id = %s
+    """, (tg_id,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    if isinstance(row, dict):
+        row = tuple(row.values())
+    return remember_identity(tg_id, row[0], row[1])
+
+def clear_identity_caches():
+    SESSION_CACHE.clear()
+    IDENTITY_CACHE.clear()
+
+
+# =============== CLUSTER EVENTS ===============
+# При нескольких процессах (gunicorn, uvicorn --workers) у каждого свои кэши; о сбросах они
+# узнают через LISTEN/NOTIFY. NOTIFY внутри транзакции доставляется только после COMMIT.
+INVALIDATION_CHANNEL = "app_invalidate"
+# payload у NOTIFY ограничен 8000 байт, поэтому ключи уходят пачками
+INVALIDATION_CHUNK = 100
+LISTENER_RETRY = float(os.getenv("LISTENER_RETRY", 5))
+
+def invalidation_payloads(cache, keys=None):
+    if keys is None:
+        return [json.dumps({"cache": cache})]
+    keys = list(keys)
+    return [json.dumps({"cache": cache, "keys": keys[i:i + INVALIDATION_CHUNK]}) for i in range(0, len(keys), INVALIDATION_CHUNK)]
+
+def publish_invalidation(cursor, cache, keys=None):
+    """Просит все процессы сбросить кэш ("sessions"/"identities" по ключам или "all"); уходит вместе с COMMIT."""
+    for payload in invalidation_payloads(cache, keys):
+        cursor.execute("SELECT pg_notify(%s, %s)", (INVALIDATION_CHANNEL, payload))
+
+def apply_invalidation(payload):
+    message = json.loads(payload)
+    if message["cache"] == "sessions" and message.get("keys") is not None:
+        for key in message["keys"]:
+            SESSION_CACHE.invalidate(key)
+        EVENTS.close_sessions(message["keys"])
+    elif message["cache"] == "sessions":
+        SESSION_CACHE.clear()
+        EVENTS.close_sessions()
+    elif message["cache"] == "identities" and message.get("keys") is not None:
+        for key in message["keys"]:
+            IDENTITY_CACHE.invalidate(key)
+    elif message["cache"] == "identities":
+        IDENTITY_CACHE.clear()
+    elif message["cache"] == "all":
+        if SCORE_BUFFER:
+            SCORE_BUFFER.reset()
+        clear_identity_caches()
+        LEADERBOARDS.reset()
+        EVENTS.close_sessions()
+
+
+class NotificationListener:
+    """Держит отдельное соединение с LISTEN на подписанные каналы и вызывает колбэки в своём потоке.
+
+    Пока соединения нет, уведомления теряются, поэтому при каждом подключении вызывается on_connect.
+    """
+
+    def __init__(self, retry):
+        self.retry = retry
+        self._handlers = {}
+        self._thread = None
+        self.connected = False
+        self.received = 0
+        self.reconnects = 0
+
+    def subscribe(self, channel, callback, on_connect=None):
+        self._handlers[channel] = (callback, on_connect)
+
+    def start(self):
+        if not DATABASE_URL or not self._handlers:
             return
-        
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="pg-listener", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(DATABASE_URL, sslmode=DB_SSLMODE, keepalives=1,
+                                        keepalives_idle=30, keepalives_interval=10, keepalives_count=3)
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    for channel in self._handlers:
+                        cursor.execute(sql.SQL("LISTEN {}").format(sql.Identifier(channel)))
+                for _, on_connect in self._handlers.values():
+                    if on_connect:
+                        on_connect()
+                self.connected = True
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        note = conn.notifies.pop(0)
+                        self.received += 1
+                        try:
+                            self._handlers[note.channel][0](note.payload)
+                        except Exception as e:
+                            print(f"Listener callback error ({note.channel}): {e}")
+            except Exception as e:
+                print(f"Listener error: {e}")
+            finally:
+                self.connected = False
+                if conn is not None:
+                    conn.close()
+            self.reconnects += 1
+            time.sleep(self.retry)
+
+    def stats(self):
+        return {"connected": self.connected, "channels": sorted(self._handlers),
+                "received": self.received, "reconnects": self.reconnects}
+
+
+LISTENER = NotificationListener(LISTENER_RETRY)
+LISTENER.subscribe(INVALIDATION_CHANNEL, apply_invalidation, on_connect=clear_identity_caches)
+
+
+# =============== LIVE EVENTS ===============
+# /api/events — SSE-поток изменений профиля: монеты, xp, уровень, новые достижения, инвентарь.
+# События уходят через NOTIFY в транзакции изменения и раздаются потокам всех процессов.
+EVENTS_CHANNEL = "app_user_events"
+# Каждый поток во Flask-режиме занимает поток сервера, поэтому их число ограничено
+EVENT_STREAMS_MAX = int(os.getenv("EVENT_STREAMS_MAX", 100))
+EVENT_QUEUE_MAX = 100
+EVENT_HEARTBEAT = float(os.getenv("EVENT_HEARTBEAT", 15))
+# Поток закрывается через столько секунд; EventSource переподключится и заново проверит сессию
+EVENT_STREAM_MAX_AGE = float(os.getenv("EVENT_STREAM_MAX_AGE", 600))
+EVENT_RETRY_MS = 3000
+
+def event_origin(session_id):
+    """Метка сессии-источника: вкладка пропускает собственные события, не видя чужих session_id."""
+    return hashlib.sha256(session_id.encode()).hexdigest()[:16]
+
+def user_event_payload(user_id, event, session_id=None):
+    return json.dumps({"user_id": user_id, "origin": event_origin(session_id) if session_id else None, **event}, default=str)
+
+def publish_user_event(cursor, user_id, event, session_id=None):
+    """Событие для SSE-потоков пользователя во всех процессах; уходит вместе с COMMIT."""
+    cursor.execute("SELECT pg_notify(%s, %s)", (EVENTS_CHANNEL, user_event_payload(user_id, event, session_id)))
+
+def progress_event(earned_coins, new_level, new_xp, new_unlocked):
+    return {"type": "progress", "coins_delta": earned_coins, "level": new_level, "xp": new_xp,
+            "achievements": [a["id"] for a in new_unlocked]}
+
+def shop_event(action, payload, response):
+    event = {"type": "shop", "coins": response["coins"]}
+    if "inventory" in response:
+        event["inventory"] = response["inventory"]
+    if action == 'change_name':
+        event["display_name"] = payload["name"]
+    elif action == 'set_theme':
+        event["active_theme"] = payload["theme"]
+    return event
+
+def sse_message(event, data, retry=None):
+    head = f"retry: {retry}\n" if retry else ""
+    return f"{head}event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+class EventHub:
+    """SSE-подписки процесса: user_id -> {метка: (session_id, push)}. push(None) просит поток закрыться."""
+
+    def __init__(self, max_streams):
+        self.max_streams = max_streams
+        self._subs = {}
+        self._lock = threading.Lock()
+        self._count = 0
+        self.delivered = 0
+        self.rejected = 0
+
+    def subscribe(self, user_id, session_id, push):
+        """Возвращает подписку для unsubscribe или None, если потоков уже слишком много."""
+        with self._lock:
+            if self._count >= self.max_streams:
+                self.rejected += 1
+                return None
+            token = object()
+            self._subs.setdefault(user_id, {})[token] = (session_id, push)
+            self._count += 1
+            return user_id, token
+
+    def unsubscribe(self, subscription):
+        user_id, token = subscription
+        with self._lock:
+            subs = self._subs.get(user_id)
+            if subs and subs.pop(token, None):
+                self._count -= 1
+                if not subs:
+                    del self._subs[user_id]
+
+    def publish(self, user_id, event):
+        with self._lock:
+            pushes = [push for _, push in self._subs.get(user_id, {}).values()]
+            self.delivered += len(pushes)
+        for push in pushes:
+            push(event)
+
+    def dispatch(self, payload):
+        event = json.loads(payload)
+        self.publish(event.pop("user_id"), event)
+
+    def close_sessions(self, session_ids=None):
+        """Закрывает потоки отозванных сессий (все — при session_ids=None)."""
+        ids = set(session_ids) if session_ids is not None else None
+        with self._lock:
+            pushes = [push for subs in self._subs.values() for session_id, push in subs.values()
+                      if ids is None or session_id in ids]
+        for push in pushes:
+            push(None)
+
+    def stats(self):
+        with self._lock:
+            return {"streams": self._count, "users": len(self._subs), "max": self.max_streams,
+                    "delivered": self.delivered, "rejected": self.rejected}
+
+
+EVENTS = EventHub(EVENT_STREAMS_MAX)
+LISTENER.subscribe(EVENTS_CHANNEL, EVENTS.dispatch)
+
+
+# =============== SESSIONS ===============
+SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", 600))
+SESSION_SWEEP_BATCH = int(os.getenv("SESSION_SWEEP_BATCH", 1000))
+# Таблицы со столбцом expires_at, которые чистит SessionJanitor
+SESSION_SWEEP_TABLES = ("sessions", "auth_tokens", "rate_limit_buckets", "notification_outbox", "play_tokens_used")
+
+def revoke_user_sessions(cursor, user_id):
+    """Удаляет все сессии пользователя и выкидывает их из кэша. Возвращает число удалённых."""
+    cursor.execute("DELETE FROM sessions WHERE user_id=%s RETURNING session_id", (user_id,))
+    revoked = [r[0] if not isinstance(r, dict) else r['session_id'] for r in cursor.fetchall()]
+    for session_id in revoked:
+        SESSION_CACHE.invalidate(session_id)
+    publish_invalidation(cursor, "sessions", revoked)
+    return len(revoked)
+
+
+class SessionJanitor:
+    """Фоновая чистка просроченных sessions, auth_tokens, бакетов лимитов и старого outbox небольшими пачками, без долгих блокировок."""
+
+    def __init__(self, interval, batch_size):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._thread = None
+        self.last_report = None
+        self.total_reclaimed = {table: 0 for table in SESSION_SWEEP_TABLES}
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="session-janitor", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            self.sweep()
+            time.sleep(self.interval)
+
+    def _sweep_table(self, table):
+        deleted = 0
+        while True:
+            with db_connection() as conn:
+                if not conn: return deleted
+                with conn.cursor() as cursor:
+                    cursor.execute(sql.SQL("""
+                        DELETE FROM {table} WHERE ctid IN (
+                            SELECT ctid FROM {table} WHERE expires_at < NOW() LIMIT %s
+                        )
+                    """).format(table=sql.Identifier(table)), (self.batch_size,))
+                    batch = cursor.rowcount
+                conn.commit()
+            deleted += batch
+            if batch < self.batch_size:
+                return deleted
+            # Даём дорогу обычным запросам между пачками
+            time.sleep(0.05)
+
+    def sweep(self):
+        started = time.monotonic()
+        try:
+            report = {table: self._sweep_table(table) for table in SESSION_SWEEP_TABLES}
+        except Exception as e:
+            print(f"Session janitor error: {e}")
+            return None
+        for table, deleted in report.items():
+            self.total_reclaimed[table] += deleted
+        report["duration_ms"] = round((time.monotonic() - started) * 1000, 2)
+        self.last_report = report
+        if any(report[table] for table in SESSION_SWEEP_TABLES):
+            print(f"Session janitor reclaimed: {report}")
+        return report
+
+
+SESSION_JANITOR = SessionJanitor(SESSION_SWEEP_INTERVAL, SESSION_SWEEP_BATCH)
+
+
+# =============== SCORE PARTITIONS ===============
+# game_scores разбита на месячные партиции по created_at
+SCORE_PARTITIONS_AHEAD = int(os.getenv("SCORE_PARTITIONS_AHEAD", 2))
+# Сырые партиции старше стольких месяцев сворачиваются в game_scores_daily и удаляются (0 — хранить вечно)
+SCORE_RETENTION_MONTHS = int(os.getenv("SCORE_RETENTION_MONTHS", 0))
+SCORE_MAINTENANCE_INTERVAL = float(os.getenv("SCORE_MAINTENANCE_INTERVAL", 3600))
+# Пакетная отправка принимает партии не старше этого срока, поэтому закрытый месяц
+# сворачивается только после такой паузы
+SCORE_LATE_DAYS = int(os.getenv("SCORE_LATE_DAYS", 30))
+
+def add_months(day, months):
+    month_index = day.year * 12 + day.month - 1 + months
+    return day.replace(year=month_index // 12, month=month_index % 12 + 1, day=1)
+
+def score_partition_name(month_start):
+    return f"game_scores_y{month_start.year}m{month_start.month:02d}"
+
+def ensure_score_partitions(cursor, first_month=None):
+    """Создаёт месячные партиции от first_month (по умолчанию прошлый месяц) до SCORE_PARTITIONS_AHEAD вперёд."""
+    this_month = datetime.now(timezone.utc).date().replace(day=1)
+    month = (first_month or add_months(this_month, -1)).replace(day=1)
+    last_month = add_months(this_month, SCORE_PARTITIONS_AHEAD)
+    created = 0
+    while month <= last_month:
+        name = score_partition_name(month)
+        cursor.execute("SELECT to_regclass(%s) IS NULL", (name,))
+        if cursor.fetchone()[0]:
+            cursor.execute(sql.SQL("CREATE TABLE {} PARTITION OF game_scores FOR VALUES FROM (%s) TO (%s)").format(sql.Identifier(name)),
+                           (month, add_months(month, 1)))
+            created += 1
+        month = add_months(month, 1)
+    return created
+
+def create_partitioned_game_scores(cursor):
+    cursor.execute("CREATE SEQUENCE IF NOT EXISTS game_scores_id_seq")
+    cursor.execute("""
+        CREATE TABLE game_scores (
+            id BIGINT NOT NULL DEFAULT nextval('game_scores_id_seq'),
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            game_id TEXT NOT NULL,
+            score INTEGER NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at);
+    """)
+    cursor.execute("ALTER SEQUENCE game_scores_id_seq OWNED BY game_scores.id")
+    # Страховка для строк вне заранее созданных месяцев
+    cursor.execute("CREATE TABLE game_scores_default PARTITION OF game_scores DEFAULT")
+    # Индекс на родителе создаётся в каждой партиции автоматически
+    cursor.execute("CREATE INDEX idx_game_scores_user_game_score ON game_scores (user_id, game_id, score DESC)")
+
+def migrate_game_scores(cursor):
+    """Создаёт партиционированную game_scores или переносит в неё старую обычную таблицу."""
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('game_scores')")
+    row = cursor.fetchone()
+    if row is None:
+        create_partitioned_game_scores(cursor)
+        ensure_score_partitions(cursor)
+        return
+    if row[0] == 'p':
+        ensure_score_partitions(cursor)
+        return
+
+    print("Converting game_scores to monthly partitions...")
+    cursor.execute("SELECT pg_get_serial_sequence('game_scores', 'id')")
+    seq_name = cursor.fetchone()[0]
+    cursor.execute("ALTER TABLE game_scores RENAME TO game_scores_legacy")
+    cursor.execute("ALTER TABLE game_scores_legacy RENAME CONSTRAINT game_scores_pkey TO game_scores_legacy_pkey")
+    cursor.execute("ALTER TABLE game_scores_legacy ALTER COLUMN id DROP DEFAULT")
+    if seq_name:
+        cursor.execute(f"ALTER SEQUENCE {seq_name} OWNED BY NONE")
+        # Имя приходит со схемой (и в кавычках, если нужно): сравниваем только саму последовательность
+        if seq_name.rsplit(".", 1)[-1].strip('"') != "game_scores_id_seq":
+            cursor.execute(f"ALTER SEQUENCE {seq_name} RENAME TO game_scores_id_seq")
+    create_partitioned_game_scores(cursor)
+
+    cursor.execute("SELECT MIN(created_at) FROM game_scores_legacy")
+    oldest = cursor.fetchone()[0]
+    ensure_score_partitions(cursor, oldest.date() if oldest else None)
+    cursor.execute("""
+        INSERT INTO game_scores (id, user_id, game_id, score, created_at)
+        SELECT id, user_id, game_id, score, COALESCE(created_at, CURRENT_TIMESTAMP) FROM game_scores_legacy
+    """)
+    cursor.execute("SELECT setval('game_scores_id_seq', GREATEST((SELECT MAX(id) FROM game_scores), 1))")
+    cursor.execute("DROP TABLE game_scores_legacy")
+    print("game_scores converted.")
+
+def list_score_partitions(cursor):
+    """[(name, month_start)] для месячных партиций game_scores, от старых к новым."""
+    cursor.execute("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'game_scores'::regclass
+    """)
+    partitions = []
+    for (name,) in cursor.fetchall():
+        try:
+            month = datetime.strptime(name, "game_scores_y%Ym%m").date()
+        except ValueError:
+            continue
+        partitions.append((name, month))
+    return sorted(partitions, key=lambda p: p[1])
+
+def rollup_and_prune_scores(cursor):
+    """Сворачивает закрытые месяцы в game_scores_daily и удаляет сырые партиции старше срока хранения."""
+    report = {"rolled_up": [], "dropped": []}
+    now = datetime.now(timezone.utc).date()
+    closed_before = now - timedelta(days=SCORE_LATE_DAYS)
+    drop_before = add_months(now.replace(day=1), -SCORE_RETENTION_MONTHS) if SCORE_RETENTION_MONTHS > 0 else None
+
+    cursor.execute("SELECT partition_name FROM game_scores_rollups")
+    rolled_up = {r[0] for r in cursor.fetchall()}
+    for name, month in list_score_partitions(cursor):
+        if add_months(month, 1) > closed_before:
+            break
+        if name not in rolled_up:
+            cursor.execute(sql.SQL("""
+                INSERT INTO game_scores_daily (day, user_id, game_id, plays, total_score, best_score)
+                SELECT created_at::date, user_id, game_id, COUNT(*), SUM(score), MAX(score)
+                FROM {} WHERE user_id IS NOT NULL
+                GROUP BY 1, 2, 3
+                ON CONFLICT (day, user_id, game_id) DO UPDATE
+                SET plays = game_scores_daily.plays + EXCLUDED.plays,
+                    total_score = game_scores_daily.total_score + EXCLUDED.total_score,
+                    best_score = GREATEST(game_scores_daily.best_score, EXCLUDED.best_score)
+            """).format(sql.Identifier(name)))
+            cursor.execute("INSERT INTO game_scores_rollups (partition_name) VALUES (%s)", (name,))
+            rolled_up.add(name)
+            report["rolled_up"].append(name)
+        if drop_before and month < drop_before and name in rolled_up:
+            # Удаление целой партиции вместо DELETE: без раздувания и долгих блокировок
+            cursor.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(name)))
+            report["dropped"].append(name)
+    return report
+
+
+class ScoreMaintenance:
+    """Периодически создаёт партиции наперёд, сворачивает старые месяцы и применяет срок хранения."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._thread = None
+        self.last_report = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="score-maintenance", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            self.run_once()
+            time.sleep(self.interval)
+
+    def run_once(self):
+        try:
+            with db_connection() as conn:
+                if not conn: return None
+                with conn.cursor() as cursor:
+                    # Только один процесс выполняет обслуживание одновременно
+                    cursor.execute("SELECT pg_try_advisory_xact_lock(hashtext('score_maintenance'))")
+                    if not cursor.fetchone()[0]:
+                        return None
+                    created = ensure_score_partitions(cursor)
+                    report = rollup_and_prune_scores(cursor)
+                    report["created"] = created
+                conn.commit()
+            if created or report["rolled_up"] or report["dropped"]:
+                print(f"Score maintenance: {report}")
+            self.last_report = report
+            return report
+        except Exception as e:
+            print(f"Score maintenance error: {e}")
+            return None
+
+
+SCORE_MAINTENANCE = ScoreMaintenance(SCORE_MAINTENANCE_INTERVAL)
+
+
+def backfill_best_scores(cursor):
+    """Пересчитывает user_best_scores по всей истории game_scores (идемпотентно)."""
+    cursor.execute("""
+        INSERT INTO user_best_scores (user_id, game_id, score, achieved_at)
+        SELECT DISTINCT ON (user_id, game_id) user_id, game_id, score, COALESCE(created_at, CURRENT_TIMESTAMP)
+        FROM game_scores
+        ORDER BY user_id, game_id, score DESC, created_at ASC
+        ON CONFLICT (user_id, game_id) DO UPDATE
+        SET score = EXCLUDED.score, achieved_at = EXCLUDED.achieved_at
+        WHERE EXCLUDED.score > user_best_scores.score
+    """)
+    return cursor.rowcount
+
+def backfill_game_counters(cursor):
+    """Заполняет user_game_counters по истории game_scores; серия — последний непрерывный отрезок дней."""
+    cursor.execute("""
+        INSERT INTO user_game_counters (user_id, game_id, plays, total_score, best_score, streak, best_streak, last_played)
+        SELECT t.user_id, t.game_id, t.plays, t.total_score, t.best_score,
+               COALESCE(s.streak, 1), COALESCE(s.best_streak, 1), t.last_played
+        FROM (
+            SELECT user_id, game_id, COUNT(*) AS plays, SUM(score) AS total_score, MAX(score) AS best_score,
+                   MAX(created_at)::date AS last_played
+            FROM game_scores WHERE user_id IS NOT NULL
+            GROUP BY user_id, game_id
+        ) t
+        LEFT JOIN (
+            SELECT user_id, game_id,
+                   COUNT(*) FILTER (WHERE grp = last_grp) AS streak,
+                   MAX(run) AS best_streak
+            FROM (
+                SELECT user_id, game_id, grp,
+                       FIRST_VALUE(grp) OVER (PARTITION BY user_id, game_id ORDER BY d DESC) AS last_grp,
+                       COUNT(*) OVER (PARTITION BY user_id, game_id, grp) AS run
+                FROM (
+                    SELECT user_id, game_id, d,
+                           d - (ROW_NUMBER() OVER (PARTITION BY user_id, game_id ORDER BY d))::int AS grp
+                    FROM (SELECT DISTINCT user_id, game_id, created_at::date AS d FROM game_scores WHERE user_id IS NOT NULL) days
+                ) islands
+            ) runs
+            GROUP BY user_id, game_id
+        ) s ON s.user_id = t.user_id AND s.game_id = t.game_id
+        ON CONFLICT (user_id, game_id) DO NOTHING
+    """)
+    return cursor.rowcount
+
+
+# =============== MIGRATIONS ===============
+# Схема версионируется в schema_migrations: при актуальной версии старт процесса не выполняет DDL.
+# Миграции применяются отдельной командой (python server.py migrate) или при старте, если AUTO_MIGRATE=1.
+AUTO_MIGRATE = os.getenv("AUTO_MIGRATE", "1") == "1"
+# Ключ advisory-блокировки: параллельно стартующие процессы не применяют миграции дважды
+MIGRATION_LOCK_ID = 7_310_001
+SCHEMA_VERSION_SQL = "SELECT COALESCE(MAX(version), 0) FROM schema_migrations"
+
+def migration_base_tables(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            tg_id BIGINT UNIQUE NOT NULL,
+            username TEXT
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS stats (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            xp INTEGER DEFAULT 0,
+            coins INTEGER DEFAULT 1000,
+            level INTEGER DEFAULT 1,
+            CONSTRAINT unique_user_stats UNIQUE (user_id)
+        );
+    """)
+    # Таблица прогресса (инвентарь, тема, настройки)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_progress (
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE PRIMARY KEY,
+            inventory JSONB NOT NULL DEFAULT '[]',
+            active_theme TEXT DEFAULT 'default',
+            has_changed_name BOOLEAN DEFAULT FALSE,
+            display_name TEXT
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_achievements (
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            achievement_id TEXT NOT NULL,
+            unlocked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, achievement_id)
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS auth_tokens (
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            token TEXT UNIQUE NOT NULL,
+            expires_at TIMESTAMP NOT NULL
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sessions (
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            session_id TEXT UNIQUE NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+
+def migration_inventory_jsonb(cursor):
+    # Старые базы хранили инвентарь JSON-текстом; JSONB позволяет дописывать его одним UPDATE
+    cursor.execute("""
+        SELECT data_type FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = 'user_progress' AND column_name = 'inventory'
+    """)
+    if cursor.fetchone()[0] != 'jsonb':
+        cursor.execute("ALTER TABLE user_progress ALTER COLUMN inventory DROP DEFAULT")
+        cursor.execute("""
+            ALTER TABLE user_progress ALTER COLUMN inventory TYPE JSONB
+            USING COALESCE(NULLIF(inventory, ''), '[]')::jsonb
+        """)
+        cursor.execute("ALTER TABLE user_progress ALTER COLUMN inventory SET DEFAULT '[]'")
+        cursor.execute("ALTER TABLE user_progress ALTER COLUMN inventory SET NOT NULL")
+
+def migration_score_history(cursor):
+    # История партий: месячные партиции + дневные агрегаты для свёрнутых месяцев
+    migrate_game_scores(cursor)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS game_scores_daily (
+            day DATE NOT NULL,
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            game_id TEXT NOT NULL,
+            plays INTEGER NOT NULL,
+            total_score BIGINT NOT NULL,
+            best_score INTEGER NOT NULL,
+            PRIMARY KEY (day, user_id, game_id)
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS game_scores_rollups (
+            partition_name TEXT PRIMARY KEY,
+            rolled_up_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+
+def migration_session_expiry(cursor):
+    # Срок жизни сессий и индексы для фоновой чистки
+    cursor.execute("""
+        ALTER TABLE sessions ADD COLUMN IF NOT EXISTS
+        expires_at TIMESTAMP NOT NULL DEFAULT (CURRENT_TIMESTAMP + INTERVAL '30 days');
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires_at ON sessions (expires_at);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sessions_user_id ON sessions (user_id);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_auth_tokens_expires_at ON auth_tokens (expires_at);")
+
+def migration_notification_outbox(cursor):
+    # Очередь уведомлений бота (outbox), разбирается фоновым воркером
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS notification_outbox (
+            id BIGSERIAL PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            kind TEXT NOT NULL,
+            payload JSONB NOT NULL,
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sent_at TIMESTAMP,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_outbox_pending
+        ON notification_outbox (next_attempt_at) WHERE sent_at IS NULL;
+    """)
+
+def migration_best_scores(cursor):
+    # Лучший результат пользователя в каждой игре (основа лидербордов)
+    cursor.execute("SELECT to_regclass('user_best_scores') IS NULL")
+    needs_backfill = cursor.fetchone()[0]
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_best_scores (
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            game_id TEXT NOT NULL,
+            score INTEGER NOT NULL,
+            achieved_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (user_id, game_id)
+        );
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_best_scores_rank
+        ON user_best_scores (game_id, score DESC, achieved_at);
+    """)
+    if needs_backfill:
+        backfill_best_scores(cursor)
+
+def migration_achievement_rules(cursor):
+    # Правила достижений; стартовый набор из ACHIEVEMENTS_RULES уже выдавался старой логикой
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS achievement_rules (
+            id TEXT PRIMARY KEY,
+            game_id TEXT NOT NULL,
+            kind TEXT NOT NULL DEFAULT 'score' CHECK (kind IN ('score', 'total', 'plays', 'streak')),
+            threshold BIGINT NOT NULL,
+            name TEXT NOT NULL,
+            description TEXT NOT NULL DEFAULT '',
+            enabled BOOLEAN NOT NULL DEFAULT TRUE,
+            backfilled_at TIMESTAMP
+        );
+    """)
+    execute_values(cursor, """
+        INSERT INTO achievement_rules (id, game_id, kind, threshold, name, description, backfilled_at)
+        VALUES %s ON CONFLICT (id) DO NOTHING
+    """, [(r["id"], r["game_id"], "score", r["score"], r["name"], r["desc"]) for r in ACHIEVEMENTS_RULES],
+        template="(%s, %s, %s, %s, %s, %s, NOW())")
+
+def migration_game_counters(cursor):
+    # Счётчики по (пользователь, игра) для правил без сканирования истории
+    cursor.execute("SELECT to_regclass('user_game_counters') IS NULL")
+    needs_backfill = cursor.fetchone()[0]
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_game_counters (
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            game_id TEXT NOT NULL,
+            plays INTEGER NOT NULL DEFAULT 0,
+            total_score BIGINT NOT NULL DEFAULT 0,
+            best_score INTEGER,
+            streak INTEGER NOT NULL DEFAULT 0,
+            best_streak INTEGER NOT NULL DEFAULT 0,
+            last_played DATE,
+            PRIMARY KEY (user_id, game_id)
+        );
+    """)
+    if needs_backfill:
+        backfill_game_counters(cursor)
+
+def migration_rate_limit_buckets(cursor):
+    # Бакеты RATE_LIMIT_BACKEND=postgres: при сбое их не жалко, поэтому без WAL
+    cursor.execute("""
+        CREATE UNLOGGED TABLE IF NOT EXISTS rate_limit_buckets (
+            key TEXT PRIMARY KEY,
+            tokens DOUBLE PRECISION NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL
+        );
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_rate_limit_buckets_expires_at ON rate_limit_buckets (expires_at);")
+
+def migration_game_stats_daily(cursor):
+    # Дневная аналитика по играм; водяной знак 0 — первый проход посчитает всю сырую историю
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS game_stats_daily (
+            day DATE NOT NULL,
+            game_id TEXT NOT NULL,
+            plays INTEGER NOT NULL,
+            players INTEGER NOT NULL,
+            avg_score DOUBLE PRECISION NOT NULL,
+            p50_score DOUBLE PRECISION NOT NULL,
+            p95_score DOUBLE PRECISION NOT NULL,
+            max_score INTEGER NOT NULL,
+            coins BIGINT NOT NULL,
+            xp BIGINT NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (day, game_id)
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS analytics_watermarks (
+            name TEXT PRIMARY KEY,
+            last_id BIGINT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+    cursor.execute("INSERT INTO analytics_watermarks (name) VALUES ('game_stats_daily') ON CONFLICT DO NOTHING")
+    # Пересчёт (день, игра) читает только нужный отрезок партиции
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_game_scores_game_created ON game_scores (game_id, created_at)")
+
+def migration_outbox_retention(cursor):
+    # Срок хранения отправленных и исчерпавших попытки уведомлений; NULL — строка ещё в работе
+    cursor.execute("ALTER TABLE notification_outbox ADD COLUMN IF NOT EXISTS expires_at TIMESTAMP")
+    cursor.execute("""
+        UPDATE notification_outbox SET expires_at = NOW() + INTERVAL '7 days'
+        WHERE sent_at IS NOT NULL OR attempts >= %s
+    """, (OUTBOX_MAX_ATTEMPTS,))
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_outbox_expires_at
+        ON notification_outbox (expires_at) WHERE expires_at IS NOT NULL;
+    """)
+
+def migration_play_tokens(cursor):
+    # Погашенные play_token при RATE_LIMIT_BACKEND=postgres; после expires_at токен и так недействителен
+    cursor.execute("""
+        CREATE UNLOGGED TABLE IF NOT EXISTS play_tokens_used (
+            token TEXT PRIMARY KEY,
+            expires_at TIMESTAMPTZ NOT NULL
+        );
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_play_tokens_used_expires_at ON play_tokens_used (expires_at);")
+
+# Только дописывать в конец. Ранние шаги идемпотентны: базы, созданные до версионирования,
+# проходят их без изменений и лишь получают запись в schema_migrations.
+MIGRATIONS = [
+    (1, "base_tables", migration_base_tables),
+    (2, "inventory_jsonb", migration_inventory_jsonb),
+    (3, "score_history", migration_score_history),
+    (4, "session_expiry", migration_session_expiry),
+    (5, "notification_outbox", migration_notification_outbox),
+    (6, "best_scores", migration_best_scores),
+    (7, "achievement_rules", migration_achievement_rules),
+    (8, "game_counters", migration_game_counters),
+    (9, "rate_limit_buckets", migration_rate_limit_buckets),
+    (10, "game_stats_daily", migration_game_stats_daily),
+    (11, "outbox_retention", migration_outbox_retention),
+    (12, "play_tokens", migration_play_tokens),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# Последняя версия схемы, которую видел процесс (для /api/ready)
+SCHEMA_STATE = {"version": None}
+# Выставляется в конце start_background_workers(): до этого процесс не готов принимать трафик
+WORKERS_STARTED = threading.Event()
+
+def current_schema_version(cursor):
+    cursor.execute("SELECT to_regclass('schema_migrations') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        return 0
+    cursor.execute(SCHEMA_VERSION_SQL)
+    return cursor.fetchone()[0]
+
+def migrate_schema():
+    """Применяет недостающие миграции, каждую в своей транзакции. Возвращает версию схемы или None."""
+    try:
+        with db_connection() as conn:
+            if not conn:
+                print("Could not connect to DB for migrations.")
+                return None
+            with conn.cursor() as cursor:
+                version = current_schema_version(cursor)
+                conn.rollback()
+                if version >= SCHEMA_VERSION:
+                    SCHEMA_STATE["version"] = version
+                    return version
+                for number, name, migration in MIGRATIONS:
+                    cursor.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,))
+                    cursor.execute("""
+                        CREATE TABLE IF NOT EXISTS schema_migrations (
+                            version INTEGER PRIMARY KEY,
+                            name TEXT NOT NULL,
+                            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                        );
+                    """)
+                    # Перечитываем под блокировкой: другой процесс мог успеть раньше
+                    cursor.execute(SCHEMA_VERSION_SQL)
+                    version = cursor.fetchone()[0]
+                    if number <= version:
+                        conn.rollback()
+                        continue
+                    started = time.time()
+                    migration(cursor)
+                    cursor.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (number, name))
+                    conn.commit()
+                    version = number
+                    print(f"Migration {number} ({name}) applied in {time.time() - started:.2f}s")
+                SCHEMA_STATE["version"] = version
+                print(f"Database schema is at version {version}.")
+                return version
+    except Exception as e:
+        print(f"Error applying migrations: {e}")
+        return None
+
+def readiness_payload(version):
+    """Ответ /api/ready по версии схемы из БД (None — БД недоступна): (payload, HTTP-статус)."""
+    if version is not None:
+        SCHEMA_STATE["version"] = version
+    checks = {
+        "database": version is not None,
+        "schema": version is not None and version >= SCHEMA_VERSION,
+        "workers": WORKERS_STARTED.is_set(),
+    }
+    ready = all(checks.values())
+    return {"ready": ready, "checks": checks, "schema_version": version, "expected_schema_version": SCHEMA_VERSION}, 200 if ready else 503
+
+
+# =============== ANALYTICS ===============
+# Дневные агрегаты по играм в game_stats_daily. Фоновая задача пересчитывает только те (день, игра),
+# в которые попали новые строки game_scores после водяного знака (последнего обработанного id).
+ANALYTICS_INTERVAL = float(os.getenv("ANALYTICS_INTERVAL", 60))
+# id выдаются при INSERT, а видны после COMMIT: каждый проход захватывает хвост уже обработанных id,
+# чтобы не потерять строки из транзакций, закоммиченных позже более новых
+ANALYTICS_ID_OVERLAP = int(os.getenv("ANALYTICS_ID_OVERLAP", 10000))
+# Сколько новых id берёт один проход; отставший воркер догоняет несколькими проходами подряд
+ANALYTICS_BATCH_IDS = int(os.getenv("ANALYTICS_BATCH_IDS", 100000))
+# Дни старше окна не пересчитываются: их не показывают ни /analytics, ни /api/admin/analytics
+ANALYTICS_DAYS_MAX = 90
+# tg_id через запятую: кому доступна команда /analytics
+ADMIN_TG_IDS = {int(x) for x in os.getenv("ADMIN_TG_IDS", "").replace(" ", "").split(",") if x}
+# /api/admin/* отвечает только на "Authorization: Bearer <ADMIN_TOKEN>"; без токена выключен
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+# Монеты и XP считаются как в score_rewards; {touched} — какие (день, игра) пересчитать
+ANALYTICS_UPSERT_SQL = """
+    /* {name} */
+    WITH touched AS ({touched})
+    INSERT INTO game_stats_daily (day, game_id, plays, players, avg_score, p50_score, p95_score, max_score, coins, xp, updated_at)
+    SELECT t.day, t.game_id, COUNT(*), COUNT(DISTINCT s.user_id), AVG(s.score),
+           percentile_cont(0.5) WITHIN GROUP (ORDER BY s.score),
+           percentile_cont(0.95) WITHIN GROUP (ORDER BY s.score),
+           MAX(s.score), SUM(GREATEST(1, trunc(s.score * 0.1))), SUM(GREATEST(1, trunc(s.score * 0.5))), NOW()
+    FROM touched t
+    JOIN game_scores s ON s.game_id = t.game_id AND s.created_at >= t.day AND s.created_at < t.day + 1
+    GROUP BY t.day, t.game_id
+    ON CONFLICT (day, game_id) DO UPDATE
+    SET plays = EXCLUDED.plays, players = EXCLUDED.players, avg_score = EXCLUDED.avg_score,
+        p50_score = EXCLUDED.p50_score, p95_score = EXCLUDED.p95_score, max_score = EXCLUDED.max_score,
+        coins = EXCLUDED.coins, xp = EXCLUDED.xp, updated_at = EXCLUDED.updated_at
+"""
+ANALYTICS_ROLLUP_SQL = ANALYTICS_UPSERT_SQL.format(name="analytics_rollup", touched="""
+        SELECT DISTINCT created_at::date AS day, game_id FROM game_scores
+        WHERE id > %(since)s AND id <= %(until)s AND created_at >= CURRENT_DATE - %(days)s::int
+    """)
+# Полный пересчёт окна ANALYTICS_DAYS_MAX (после загрузки данных), а не всей истории
+ANALYTICS_BACKFILL_SQL = ANALYTICS_UPSERT_SQL.format(name="analytics_backfill", touched="""
+        SELECT DISTINCT created_at::date AS day, game_id FROM game_scores WHERE created_at >= CURRENT_DATE - %(days)s::int
+    """)
+
+ANALYTICS_SQL = """
+    SELECT day, game_id, plays, players, avg_score, p50_score, p95_score, max_score, coins, xp
+    FROM game_stats_daily
+    WHERE day > CURRENT_DATE - %s::int AND (%s::text IS NULL OR game_id = %s::text)
+    ORDER BY day DESC, game_id
+"""
+
+class AnalyticsRollup:
+    """Периодически досчитывает game_stats_daily от водяного знака; один процесс за раз."""
+
+    def __init__(self, interval, overlap, batch_ids, days):
+        self.interval = interval
+        self.overlap = overlap
+        self.batch_ids = batch_ids
+        self.days = days
+        self._thread = None
+        self.last_report = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="analytics-rollup", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            report = self.run_once()
+            if not (report and report["behind"]):
+                time.sleep(self.interval)
+
+    def run_once(self):
+        try:
+            started = time.monotonic()
+            with db_connection() as conn:
+                if not conn: return None
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT pg_try_advisory_xact_lock(hashtext('analytics_rollup'))")
+                    if not cursor.fetchone()[0]:
+                        return None
+                    cursor.execute("SELECT last_id FROM analytics_watermarks WHERE name = 'game_stats_daily'")
+                    last_id = cursor.fetchone()[0]
+                    cursor.execute("SELECT MAX(id) FROM game_scores")
+                    max_id = cursor.fetchone()[0] or 0
+                    if max_id <= last_id:
+                        return None
+                    until = min(max_id, last_id + self.batch_ids)
+                    cursor.execute(ANALYTICS_ROLLUP_SQL, {"since": max(0, last_id - self.overlap), "until": until, "days": self.days})
+                    groups = cursor.rowcount
+                    cursor.execute("UPDATE analytics_watermarks SET last_id = %s, updated_at = NOW() WHERE name = 'game_stats_daily'", (until,))
+                conn.commit()
+            self.last_report = {"watermark": until, "groups": groups, "behind": until < max_id,
+                                "duration_ms": round((time.monotonic() - started) * 1000, 2),
+                                "at": datetime.now(timezone.utc).isoformat()}
+            return self.last_report
+        except Exception as e:
+            print(f"Analytics rollup error: {e}")
+            return None
+
+    def backfill(self, cursor):
+        """Пересчитывает окно self.days и ставит водяной знак на MAX(id); commit — за вызывающим кодом."""
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext('analytics_rollup'))")
+        cursor.execute("SELECT MAX(id) FROM game_scores")
+        max_id = cursor.fetchone()[0] or 0
+        cursor.execute(ANALYTICS_BACKFILL_SQL, {"days": self.days})
+        groups = cursor.rowcount
+        cursor.execute("UPDATE analytics_watermarks SET last_id = %s, updated_at = NOW() WHERE name = 'game_stats_daily'", (max_id,))
+        return groups
+
+
+ANALYTICS = AnalyticsRollup(ANALYTICS_INTERVAL, ANALYTICS_ID_OVERLAP, ANALYTICS_BATCH_IDS, ANALYTICS_DAYS_MAX)
+
+def analytics_row(row):
+    day, game_id, plays, players, avg_score, p50, p95, max_score, coins, xp = row
+    return {"day": day.isoformat(), "game_id": game_id, "game": GAME_NAMES.get(game_id, game_id),
+            "plays": plays, "players": players, "avg_score": round(avg_score, 1),
+            "p50_score": round(p50, 1), "p95_score": round(p95, 1), "max_score": max_score,
+            "coins": coins, "xp": xp}
+
+def analytics_summary(rows):
+    """Сводка за период по играм: дневные перцентили не складываются, поэтому только суммы, среднее и максимум."""
+    games = {}
+    for r in rows:
+        g = games.setdefault(r["game_id"], {"game": r["game"], "plays": 0, "total": 0.0, "max_score": 0, "coins": 0, "xp": 0})
+        g["plays"] += r["plays"]
+        g["total"] += r["avg_score"] * r["plays"]
+        g["max_score"] = max(g["max_score"], r["max_score"])
+        g["coins"] += r["coins"]
+        g["xp"] += r["xp"]
+    return {game_id: {**{k: v for k, v in g.items() if k != "total"}, "avg_score": round(g["total"] / g["plays"], 1) if g["plays"] else 0}
+            for game_id, g in games.items()}
+
+def admin_allowed(authorization):
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(authorization or "", f"Bearer {ADMIN_TOKEN}")
+
+
+# =============== LEADERBOARDS ===============
+LEADERBOARD_PAGE_MAX = int(os.getenv("LEADERBOARD_PAGE_MAX", 100))
+# Страховочное перечитывание из БД; рекорды других процессов приходят через NOTIFY сразу
+LEADERBOARD_RELOAD_INTERVAL = float(os.getenv("LEADERBOARD_RELOAD_INTERVAL", 300))
+LEADERBOARD_CHANNEL = "app_scores"
+
+def score_notification_payload(user_id, rows):
+    """Лучшая партия каждой игры из [(game_id, score, created_at)]: не больше строки на игру."""
+    best = {}
+    for game_id, score_val, created_at in rows:
+        game_id = str(game_id)
+        if game_id not in best or score_val > best[game_id][1]:
+            best[game_id] = (game_id, score_val, created_at)
+    return json.dumps({"user_id": user_id, "rows": list(best.values())}, default=str)
+
+def publish_scores(cursor, user_id, rows):
+    """Сообщает лидербордам всех процессов о новых партиях; уходит вместе с COMMIT."""
+    cursor.execute("SELECT pg_notify(%s, %s)", (LEADERBOARD_CHANNEL, score_notification_payload(user_id, rows)))
+
+def upsert_best_scores(cursor, rows):
+    """Обновляет user_best_scores по партиям [(user_id, game_id, score, created_at)], только если рекорд улучшен."""
+    best = {}
+    for user_id, game_id, score_val, created_at in rows:
+        key = (user_id, str(game_id))
+        if key not in best or score_val > best[key][0]:
+            best[key] = (score_val, created_at)
+    execute_values(cursor, """
+        INSERT INTO user_best_scores (user_id, game_id, score, achieved_at) VALUES %s
+        ON CONFLICT (user_id, game_id) DO UPDATE
+        SET score = EXCLUDED.score, achieved_at = EXCLUDED.achieved_at
+        WHERE EXCLUDED.score > user_best_scores.score
+    """, [(user_id, game_id, score_val, created_at) for (user_id, game_id), (score_val, created_at) in best.items()])
+
+
+class GameLeaderboard:
+    """Отсортированный список лучших результатов одной игры: (-score, achieved_at, user_id)."""
+
+    def __init__(self, rows=()):
+        self._lock = threading.Lock()
+        self._by_user = {user_id: (score_val, ts) for user_id, score_val, ts in rows}
+        self._entries = sorted((-score_val, ts, user_id) for user_id, (score_val, ts) in self._by_user.items())
+        self.loaded_at = time.monotonic()
+
+    def submit(self, user_id, score_val, ts):
+        with self._lock:
+            current = self._by_user.get(user_id)
+            if current and current[0] >= score_val:
+                return False
+            if current:
+                del self._entries[bisect.bisect_left(self._entries, (-current[0], current[1], user_id))]
+            bisect.insort(self._entries, (-score_val, ts, user_id))
+            self._by_user[user_id] = (score_val, ts)
+            return True
+
+    def rank(self, user_id):
+        with self._lock:
+            current = self._by_user.get(user_id)
+            if not current:
+                return None
+            return bisect.bisect_left(self._entries, (-current[0], current[1], user_id)) + 1, current[0]
+
+    def page(self, offset, limit):
+        with self._lock:
+            return [(offset + i + 1, user_id, -neg_score)
+                    for i, (neg_score, _, user_id) in enumerate(self._entries[offset:offset + limit])]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class Leaderboards:
+    """Лидерборды всех игр из GAME_NAMES; загружаются из user_best_scores лениво и обновляются инкрементально."""
+
+    def __init__(self, reload_interval):
+        self.reload_interval = reload_interval
+        self._boards = {}
+        self._lock = threading.Lock()
+
+    def _load(self, game_id):
+        with db_connection() as conn:
+            if not conn:
+                return None
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT user_id, score, achieved_at FROM user_best_scores WHERE game_id=%s", (game_id,))
+                return self.build(cursor.fetchall())
+
+    @staticmethod
+    def build(rows):
+        """Лидерборд из строк (user_id, score, achieved_at) таблицы user_best_scores."""
+        return GameLeaderboard((user_id, score_val, achieved_at.replace(tzinfo=timezone.utc).timestamp())
+                               for user_id, score_val, achieved_at in rows)
+
+    def cached(self, game_id):
+        """Загруженный лидерборд и признак того, что его пора перечитать."""
+        board = self._boards.get(game_id)
+        return board, board is None or time.monotonic() - board.loaded_at > self.reload_interval
+
+    def put(self, game_id, board):
+        with self._lock:
+            self._boards[game_id] = board
+
+    def board(self, game_id):
+        board, stale = self.cached(game_id)
+        if stale:
+            fresh = self._load(game_id)
+            if fresh is None:
+                return board
+            self.put(game_id, fresh)
+            board = fresh
+        return board
+
+    def submit(self, user_id, rows):
+        """Применяет к загруженным лидербордам партии [(game_id, score, created_at)]."""
+        for game_id, score_val, created_at in rows:
+            board = self._boards.get(str(game_id))
+            if board is not None:
+                board.submit(user_id, score_val, datetime.fromisoformat(created_at).timestamp())
+
+    def dispatch(self, payload):
+        # Свои же уведомления безвредны: submit пропускает результат не лучше текущего
+        message = json.loads(payload)
+        self.submit(message["user_id"], message["rows"])
+
+    def reset(self):
+        with self._lock:
+            self._boards.clear()
+
+
+LEADERBOARDS = Leaderboards(LEADERBOARD_RELOAD_INTERVAL)
+# Пока LISTEN-соединения не было, уведомления терялись: после переподключения таблицы перечитываются
+LISTENER.subscribe(LEADERBOARD_CHANNEL, LEADERBOARDS.dispatch, on_connect=LEADERBOARDS.reset)
+
+def leaderboard_names(user_ids):
+    if not user_ids:
+        return {}
+    with db_connection() as conn:
+        if not conn:
+            return {}
         with conn.cursor() as cursor:
-            # Основные таблицы
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    id SERIAL PRIMARY KEY,
-                    tg_id BIGINT UNIQUE NOT NULL,
-                    username TEXT
-                );
-            """)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS stats (
-                    id SERIAL PRIMARY KEY,
-                    user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                    xp INTEGER DEFAULT 0,
-                    coins INTEGER DEFAULT 1000,
-                    level INTEGER DEFAULT 1,
-                    CONSTRAINT unique_user_stats UNIQUE (user_id)
-                );
-            """)
-            # Таблица прогресса (инвентарь, тема, настройки)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS user_progress (
-                    user_id INTEGER REFERENCES users(id) ON DELETE CASCADE PRIMARY KEY,
-                    inventory TEXT DEFAULT '[]',
-                    active_theme TEXT DEFAULT 'default',
-                    has_changed_name BOOLEAN DEFAULT FALSE,
-                    display_name TEXT
-                );
-            """)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS game_scores (
-                    id SERIAL PRIMARY KEY,
-                    user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                    game_id TEXT NOT NULL,
-                    score INTEGER NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS user_achievements (
-                    user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                    achievement_id TEXT NOT NULL,
-                    unlocked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    PRIMARY KEY (user_id, achievement_id)
-                );
-            """)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS auth_tokens (
-                    user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                    token TEXT UNIQUE NOT NULL,
-                    expires_at TIMESTAMP NOT NULL
-                );
-            """)
             cursor.execute("""
-                CREATE TABLE IF NOT EXISTS sessions (
-                    user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                    session_id TEXT UNIQUE NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
-            conn.commit()
-            print("Database initialized successfully.")
-        conn.close()
+                SELECT u.id, COALESCE(p.display_name, u.username) FROM users u
+                LEFT JOIN user_progress p ON p.user_id = u.id
+                WHERE u.id = ANY(%s)
+            """, (list(user_ids),))
+            return dict(cursor.fetchall())
+
+
+# =============== BOT HANDLERS ===================
+class LazyBot:
+    """TeleBot, создаваемый при первом обращении: импорт модуля и процессы без бота его не строят.
+
+    Декораторы обработчиков только запоминают регистрацию и применяются при создании бота.
+    """
+
+    def __init__(self, token):
+        self._token = token
+        self._bot = None
+        self._lock = threading.Lock()
+        self._registrations = []  # [(метод регистрации, args, kwargs, функция)]
+
+    def _register(self, method, args, kwargs):
+        def decorator(func):
+            with self._lock:
+                self._registrations.append((method, args, kwargs, func))
+                if self._bot is not None:
+                    getattr(self._bot, method)(*args, **kwargs)(func)
+            return func
+        return decorator
+
+    def message_handler(self, *args, **kwargs):
+        return self._register("message_handler", args, kwargs)
+
+    def callback_query_handler(self, *args, **kwargs):
+        return self._register("callback_query_handler", args, kwargs)
+
+    def wrap_handlers(self, wrapper):
+        """Оборачивает функции всех обработчиков: wrapper(name, func) -> func."""
+        with self._lock:
+            self._registrations = [(method, args, kwargs, wrapper(func.__name__, func))
+                                   for method, args, kwargs, func in self._registrations]
+            if self._bot is not None:
+                for handler in self._bot.message_handlers + self._bot.callback_query_handlers:
+                    handler['function'] = wrapper(handler['function'].__name__, handler['function'])
+
+    def get(self):
+        if self._bot is None:
+            with self._lock:
+                if self._bot is None:
+                    # Обработчики выполняются в потоках BOT_DISPATCHER, а не во внутреннем пуле telebot
+                    instance = telebot.TeleBot(self._token, threaded=False)
+                    for method, args, kwargs, func in self._registrations:
+                        getattr(instance, method)(*args, **kwargs)(func)
+                    self._bot = instance
+        return self._bot
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+bot = LazyBot(BOT_TOKEN)
+
+def run_bot(should_run=lambda: True):
+    """polling: забирает апдейты, пока should_run(); webhook: только регистрирует URL, апдейты придут в /api/telegram/webhook."""
+    if BOT_MODE == "webhook":
+        try:
+            bot.set_webhook(url=BOT_WEBHOOK_URL, secret_token=BOT_WEBHOOK_SECRET,
+                            max_connections=BOT_WORKERS, drop_pending_updates=False)
+            print(f"Telegram Bot webhook set: {BOT_WEBHOOK_URL}")
+        except Exception as e:
+            print(f"Bot webhook error: {e}")
+        return
+
+    print("Telegram Bot started polling...")
+    try:
+        bot.remove_webhook()
+    except Exception as e:
+        print(f"Bot polling error: {e}")
+    offset = None
+    while should_run():
+        try:
+            updates = bot.get_updates(offset=offset, timeout=BOT_POLL_TIMEOUT + 10, long_polling_timeout=BOT_POLL_TIMEOUT)
+        except Exception as e:
+            print(f"Bot polling error: {e}")
+            time.sleep(3)
+            continue
+        for update in updates:
+            offset = update.update_id + 1
+            # Блокируется, пока очередь полна: так polling сам притормаживает
+            BOT_DISPATCHER.submit(update)
+
+@bot.message_handler(commands=['clear'])
+def clear_db_cmd(message):
+    try:
+        with db_connection() as conn:
+            if conn:
+                if SCORE_BUFFER:
+                    SCORE_BUFFER.reset()
+                with conn.cursor() as cursor:
+                    cursor.execute("TRUNCATE TABLE game_scores, user_achievements, auth_tokens, sessions, stats, users, user_progress, notification_outbox, user_best_scores, game_scores_daily, game_scores_rollups, user_game_counters RESTART IDENTITY CASCADE;")
+                    publish_invalidation(cursor, "all")
+                    conn.commit()
+                clear_identity_caches()
+                LEADERBOARDS.reset()
+                bot.reply_to(message, "🗑️ База данных полностью очищена.")
+            else:
+                bot.reply_to(message, "Ошибка подключения к БД.")
     except Exception as e:
-        print(f"Error initializing DB: {e}")
+        bot.reply_to(message, f"Ошибка при очистке: {e}")
+
+def handle_games_request(message):
+    tg_id = message.from_user.id
+    chat_id = message.chat.id
+    
+    try:
+        with db_connection() as conn:
+            if not conn:
+                bot.send_message(chat_id, "Ошибка подключения к базе данных.")
+                return
+
+            with conn.cursor() as cursor:
+                identity = bot_identity(cursor, tg_id)
+            
+                if not identity:
+                    bot.send_message(chat_id, "Сначала нажми /start", reply_markup=REPLY_KEYBOARD)
+                    return
+
+                user_id = identity['user_id']
+                token = str(uuid.uuid4())
+                expires_at = (datetime.now(timezone.utc) + timedelta(minutes=10)).isoformat()
+            
+                cursor.execute("INSERT INTO auth_tokens (user_id, token, expires_at) VALUES (%s, %s, %s)", (user_id, token, expires_at))
+                conn.commit()
+            
+                link = f"{SITE_URL}/login.html?token={token}"
+            
+                markup = types.InlineKeyboardMarkup()
+                btn = types.InlineKeyboardButton("Играть 🎮", url=link)
+                markup.add(btn)
+            
+                bot.send_message(chat_id, "Твоя ссылка для входа (действует 10 минут):", reply_markup=markup)
+    except Exception as e:
+        print(f"Error in handle_games_request: {e}")
+        bot.send_message(chat_id, "Ошибка сервера.", reply_markup=REPLY_KEYBOARD)
+
+@bot.message_handler(commands=['start'])
+def start_cmd(message):
+    tg_id = message.from_user.id
+    username = message.from_user.username or "Player"
+    
+    # Вторая попытка — после сброса IDENTITY_CACHE, если кэш ссылался на удалённого пользователя
+    for attempt in range(2):
+        try:
+            with db_connection() as conn:
+                if not conn: return
+
+                with conn.cursor() as cursor:
+                    user = bot_identity(cursor, tg_id)
+
+                    if not user:
+                        cursor.execute("INSERT INTO users (tg_id, username) VALUES (%s, %s) RETURNING id", (tg_id, username))
+                        new_user_id = cursor.fetchone()[0]
+                        cursor.execute("INSERT INTO stats (user_id, xp, coins, level) VALUES (%s, 0, 1000, 1)", (new_user_id,))
+                        cursor.execute("INSERT INTO user_progress (user_id, display_name) VALUES (%s, %s)", (new_user_id, username))
+                        conn.commit()
+                        remember_identity(tg_id, new_user_id, username)
+                        bot.send_message(message.chat.id, "Добро пожаловать! Вам начислено 1000 монет 💰", reply_markup=REPLY_KEYBOARD)
+                    else:
+                        user_id = user['user_id']
+                        cursor.execute("INSERT INTO stats (user_id, xp, coins, level) VALUES (%s, 0, 1000, 1) ON CONFLICT (user_id) DO NOTHING", (user_id,))
+                        cursor.execute("INSERT INTO user_progress (user_id, display_name) VALUES (%s, %s) ON CONFLICT (user_id) DO NOTHING", (user_id, username))
+                        conn.commit()
+                        bot.send_message(message.chat.id, "С возвращением! Выбери действие:", reply_markup=REPLY_KEYBOARD)
+            return
+        except psycopg2.IntegrityError as e:
+            # Пользователя удалили мимо бота (загрузка dataio, ручной DELETE) или его создал параллельный /start
+            IDENTITY_CACHE.invalidate(tg_id)
+            if attempt:
+                print(f"Error in start_cmd: {e}")
+        except Exception as e:
+            print(f"Error in start_cmd: {e}")
+            return
+
+@bot.message_handler(commands=['games'])
+@bot.message_handler(func=lambda message: message.text == "🎮 Играть")
+def games_cmd_or_button(message):
+    handle_games_request(message)
+
+@bot.message_handler(commands=['profile'])
+@bot.message_handler(func=lambda message: message.text == "👤 Профиль")
+def profile_cmd(message):
+    tg_id = message.from_user.id
+    try:
+        with db_connection() as conn:
+            if not conn: return
+
+            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                cursor.execute("""
+                    SELECT u.id, u.username, s.coins, s.xp, s.level, p.display_name 
+                    FROM users u
+                    LEFT JOIN stats s ON u.id = s.user_id
+                    LEFT JOIN user_progress p ON u.id = p.user_id
+                    WHERE u.tg_id = %s
+                """, (tg_id,))
+                user_data = cursor.fetchone()
+            
+                if user_data:
+                    remember_identity(tg_id, user_data['id'], user_data.get('display_name') or user_data.get('username'))
+                    name = user_data.get('display_name') or user_data.get('username') or "Игрок"
+                    text = (
+                        f"👤 *Твой Профиль*\n\n"
+                        f"🆔 *Имя*: {name}\n"
+                        f"📊 *Уровень*: {user_data.get('level', 1)}\n"
+                        f"⭐ *Опыт (XP)*: {user_data.get('xp', 0)}\n"
+                        f"💰 *Монеты*: {user_data.get('coins', 1000)}"
+                    )
+                    bot.send_message(message.chat.id, text, parse_mode='Markdown', reply_markup=REPLY_KEYBOARD)
+                else:
+                    bot.send_message(message.chat.id, "Профиль не найден. Нажми /start", reply_markup=REPLY_KEYBOARD)
+    except Exception as e:
+        print(f"Error in profile_cmd: {e}")
+
+@bot.message_handler(func=lambda message: message.text == "🏅 Достижения")
+def achievements_cmd(message):
+    tg_id = message.from_user.id
+    try:
+        with db_connection() as conn:
+            if not conn: return
+
+            with conn.cursor() as cursor:
+                identity = bot_identity(cursor, tg_id)
+                if not identity: return
+                user_id = identity['user_id']
+            
+                cursor.execute("SELECT achievement_id FROM user_achievements WHERE user_id=%s", (user_id,))
+                unlocked_ids = {r[0] for r in cursor.fetchall()}
+            
+                response_text = "🏅 *Ваши достижения:*\n\n"
+                for rule in ACHIEVEMENTS.rules:
+                    status = "✅" if rule['id'] in unlocked_ids else "🔒"
+                    response_text += f"{status} *{rule['name']}*\n_{rule['desc']}_\n\n"
+            
+                bot.send_message(message.chat.id, response_text, parse_mode='Markdown', reply_markup=REPLY_KEYBOARD)
+    except Exception: pass
+
+@bot.message_handler(commands=['stats'])
+@bot.message_handler(func=lambda message: message.text == "🏆 Моя Статистика")
+def stats_cmd(message):
+    send_stats_page(message.chat.id, message.from_user.id, 0, message.message_id)
+
+def send_stats_page(chat_id, tg_id, page, message_id=None, is_edit=False):
+    try:
+        with db_connection() as conn:
+            if not conn: return
+        
+            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                # Рекорды берём из user_best_scores по первичному ключу (не больше строки на игру)
+                cursor.execute("""
+                    SELECT b.game_id, b.score, b.achieved_at AS created_at
+                    FROM users u
+                    LEFT JOIN user_best_scores b ON b.user_id = u.id
+                    WHERE u.tg_id=%s
+                    ORDER BY b.score DESC, b.game_id
+                """, (tg_id,))
+                rows = cursor.fetchall()
+                if not rows: 
+                    return
+                best_scores = [row for row in rows if row['game_id'] is not None]
+            
+                if not best_scores:
+                    bot.send_message(chat_id, "Статистики пока нет. Сыграйте в игру!", reply_markup=REPLY_KEYBOARD)
+                    return
+            
+                num_games = len(best_scores)
+                page = page % num_games
+                current = best_scores[page]
+                game_name = GAME_NAMES.get(current['game_id'], f"Игра #{current['game_id']}")
+            
+                created_at = current.get('created_at')
+                date_str = str(created_at) if created_at else "Н/Д"
+
+                text = f"🏆 *Рекорды* ({page+1}/{num_games}):\n\n🕹️ *{game_name}*\n📈 *Счет*: {current['score']}\n"
+            
+                markup = types.InlineKeyboardMarkup(row_width=3)
+                buttons = [
+                    types.InlineKeyboardButton("⬅️", callback_data=f"stats_{(page-1)%num_games}_{tg_id}"),
+                    types.InlineKeyboardButton(f"{page+1}/{num_games}", callback_data="stats_info"),
+                    types.InlineKeyboardButton("➡️", callback_data=f"stats_{(page+1)%num_games}_{tg_id}")
+                ]
+                markup.add(*buttons)
+
+                if is_edit and message_id:
+                    bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, reply_markup=markup, parse_mode='Markdown')
+                else:
+                    bot.send_message(chat_id, text, reply_markup=markup, parse_mode='Markdown')
+    except Exception as e:
+        print(f"Error stats: {e}")
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('stats_'))
+def stats_callback(call):
+    if call.data == "stats_info":
+        bot.answer_callback_query(call.id)
+        return
+    try:
+        parts = call.data.split('_')
+        page = int(parts[1])
+        owner_id = int(parts[2])
+        if call.from_user.id != owner_id:
+             bot.answer_callback_query(call.id, "Это чужая статистика")
+             return
+        send_stats_page(call.message.chat.id, call.from_user.id, page, call.message.message_id, is_edit=True)
+        bot.answer_callback_query(call.id)
+    except: pass
+
+@bot.message_handler(commands=['logout'])
+def logout_cmd(message):
+    try:
+        with db_connection() as conn:
+            if not conn: return
+            with conn.cursor() as cursor:
+                identity = bot_identity(cursor, message.from_user.id)
+                if not identity: return
+                revoked = revoke_user_sessions(cursor, identity['user_id'])
+                conn.commit()
+        bot.send_message(message.chat.id, f"🔒 Завершено сессий: {revoked}. Для входа снова нажми '🎮 Играть'.", reply_markup=REPLY_KEYBOARD)
+    except Exception as e:
+        print(f"Error in logout_cmd: {e}")
+
+@bot.message_handler(commands=['top'])
+def top_cmd(message):
+    markup = types.InlineKeyboardMarkup(row_width=3)
+    markup.add(*[types.InlineKeyboardButton(name, callback_data=f"top_{game_id}") for game_id, name in GAME_NAMES.items()])
+    bot.send_message(message.chat.id, "🏆 *Таблица лидеров* — выбери игру:", parse_mode='Markdown', reply_markup=markup)
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('top_'))
+def top_callback(call):
+    game_id = call.data[len('top_'):]
+    try:
+        board = LEADERBOARDS.board(game_id) if game_id in GAME_NAMES else None
+        if board is None:
+            bot.answer_callback_query(call.id, "Таблица недоступна")
+            return
+        entries = board.page(0, 10)
+        names = leaderboard_names({user_id for _, user_id, _ in entries})
+        medals = {1: "🥇", 2: "🥈", 3: "🥉"}
+        lines = [f"{medals.get(rank, f'{rank}.')} {names.get(user_id) or 'Игрок'} — {score_val}" for rank, user_id, score_val in entries]
+        text = f"🏆 *{GAME_NAMES[game_id]}*\n\n" + ("\n".join(lines) if lines else "Пока никто не играл.")
+
+        with db_connection() as conn:
+            if conn:
+                with conn.cursor() as cursor:
+                    identity = bot_identity(cursor, call.from_user.id)
+                    my_rank = board.rank(identity['user_id']) if identity else None
+                    if my_rank:
+                        text += f"\n\n📍 Твоё место: {my_rank[0]} из {len(board)} ({my_rank[1]})"
+
+        bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.message_id, text=text,
+                              reply_markup=call.message.reply_markup, parse_mode='Markdown')
+        bot.answer_callback_query(call.id)
+    except Exception as e:
+        print(f"Error top: {e}")
+
+@bot.message_handler(commands=['analytics'])
+def analytics_cmd(message):
+    """/analytics [дней] — сводка по играм из game_stats_daily; только для ADMIN_TG_IDS."""
+    if message.from_user.id not in ADMIN_TG_IDS:
+        return
+    parts = message.text.split()
+    days = min(max(1, int(parts[1])), ANALYTICS_DAYS_MAX) if len(parts) > 1 and parts[1].isdigit() else 1
+    try:
+        with db_connection() as conn:
+            if not conn:
+                bot.reply_to(message, "Ошибка подключения к БД.")
+                return
+            with conn.cursor() as cursor:
+                cursor.execute(ANALYTICS_SQL, (days, None, None))
+                rows = [analytics_row(r) for r in cursor.fetchall()]
+    except Exception as e:
+        print(f"Analytics cmd error: {e}")
+        return
+    if not rows:
+        bot.reply_to(message, "📈 Данных за период пока нет.")
+        return
+    if days == 1:
+        lines = [f"📈 *Аналитика за {rows[0]['day']}*"]
+        lines += [f"• {r['game']}: {r['plays']} игр, {r['players']} игроков, "
+                  f"p50 {r['p50_score']:g}, p95 {r['p95_score']:g}, max {r['max_score']}, "
+                  f"🪙 {r['coins']}, ✨ {r['xp']}" for r in rows if r['day'] == rows[0]['day']]
+    else:
+        lines = [f"📈 *Аналитика за {days} дн.*"]
+        lines += [f"• {g['game']}: {g['plays']} игр, среднее {g['avg_score']:g}, max {g['max_score']}, "
+                  f"🪙 {g['coins']}, ✨ {g['xp']}" for g in analytics_summary(rows).values()]
+    report = ANALYTICS.last_report
+    if report:
+        lines.append(f"_Обновлено: {report['at'][:16].replace('T', ' ')} UTC_")
+    bot.send_message(message.chat.id, "\n".join(lines), parse_mode='Markdown')
+
+@bot.message_handler(func=lambda message: message.text == "❓ Помощь")
+def help_cmd(message):
+    text = "🤖 *Помощь:*\nИграй в мини-игры, копи монеты и открывай достижения!\nНажми '🎮 Играть' чтобы начать.\n/top — таблица лидеров."
+    bot.send_message(message.chat.id, text, parse_mode='Markdown', reply_markup=REPLY_KEYBOARD)
+
+
+# =============== BOT DISPATCH ===============
+# polling (по умолчанию) или webhook; в обоих режимах апдейты разбирает пул BOT_DISPATCHER
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+BOT_WEBHOOK_PATH = "/api/telegram/webhook"
+BOT_WEBHOOK_URL = os.getenv("BOT_WEBHOOK_URL") or f"{(SITE_URL or '').rstrip('/')}{BOT_WEBHOOK_PATH}"
+# Telegram присылает его в X-Telegram-Bot-Api-Secret-Token; обязателен в режиме webhook
+BOT_WEBHOOK_SECRET = os.getenv("BOT_WEBHOOK_SECRET")
+if BOT_MODE == "webhook" and not BOT_WEBHOOK_SECRET:
+    # Иначе любой POST с поддельным from.id получил бы ссылку для входа чужого пользователя
+    raise SystemExit("BOT_MODE=webhook requires BOT_WEBHOOK_SECRET")
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", 8))
+BOT_QUEUE_MAX = int(os.getenv("BOT_QUEUE_MAX", 1000))
+BOT_POLL_TIMEOUT = int(os.getenv("BOT_POLL_TIMEOUT", 20))
+# Сколько последних апдейтов учитывать в перцентилях задержки
+BOT_LATENCY_WINDOW = 1000
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+def update_chat_id(update):
+    """Чат, к которому относится апдейт; апдейты одного чата обрабатываются по порядку."""
+    for event in (update.message, update.edited_message, update.channel_post, update.edited_channel_post):
+        if event is not None:
+            return event.chat.id
+    if update.callback_query is not None:
+        call = update.callback_query
+        return call.message.chat.id if call.message else call.from_user.id
+    # Прочие типы апдейтов бот не обрабатывает — достаточно любого стабильного ключа
+    return None
+
+
+class UpdateDispatcher:
+    """Ограниченный пул потоков для апдейтов бота.
+
+    Разные чаты обрабатываются параллельно, апдейты одного чата — строго по очереди:
+    чат, у которого апдейт уже в работе, не попадает в очередь готовых.
+    """
+
+    def __init__(self, client, workers, max_pending):
+        self.client = client
+        self.workers = workers
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._has_work = threading.Condition(self._lock)
+        self._has_room = threading.Condition(self._lock)
+        self._chats = {}        # chat_id -> deque[(update, enqueued_at)], пока чат в очереди или в работе
+        self._ready = deque()   # чаты с апдейтами, которые сейчас никто не обрабатывает
+        self._pending = 0
+        self._busy = 0
+        self._threads = []
+        self._timings = deque(maxlen=BOT_LATENCY_WINDOW)  # (ожидание в очереди, работа обработчика)
+        self.processed = 0
+        self.errors = 0
+        self.rejected = 0
+
+    def start(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"bot-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, update, block=True):
+        """Ставит апдейт в очередь; без block при полной очереди сразу возвращает False."""
+        chat_id = update_chat_id(update)
+        with self._lock:
+            while self._pending >= self.max_pending:
+                if not block:
+                    self.rejected += 1
+                    return False
+                self._has_room.wait()
+            queue = self._chats.get(chat_id)
+            if queue is None:
+                queue = self._chats[chat_id] = deque()
+                self._ready.append(chat_id)
+                self._has_work.notify()
+            queue.append((update, time.monotonic()))
+            self._pending += 1
+        return True
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._ready:
+                    self._has_work.wait()
+                chat_id = self._ready.popleft()
+                update, enqueued_at = self._chats[chat_id].popleft()
+                self._busy += 1
+
+            started = time.monotonic()
+            failed = False
+            try:
+                self.client.process_new_updates([update])
+            except Exception as e:
+                failed = True
+                print(f"Bot update error: {e}")
+            finished = time.monotonic()
+
+            with self._lock:
+                self._busy -= 1
+                self._pending -= 1
+                self.processed += 1
+                self.errors += failed
+                self._timings.append((started - enqueued_at, finished - started))
+                if self._chats[chat_id]:
+                    self._ready.append(chat_id)
+                    self._has_work.notify()
+                else:
+                    del self._chats[chat_id]
+                self._has_room.notify()
+
+    def stats(self):
+        with self._lock:
+            waits = sorted(round(w * 1000, 1) for w, _ in self._timings)
+            handles = sorted(round(h * 1000, 1) for _, h in self._timings)
+            return {
+                "mode": BOT_MODE,
+                "workers": self.workers,
+                "busy": self._busy,
+                "queue_depth": self._pending,
+                "queue_max": self.max_pending,
+                "chats_queued": len(self._chats),
+                "processed": self.processed,
+                "errors": self.errors,
+                "rejected": self.rejected,
+                "wait_ms": {"p50": percentile(waits, 0.5), "p95": percentile(waits, 0.95), "max": waits[-1] if waits else None},
+                "handler_ms": {"p50": percentile(handles, 0.5), "p95": percentile(handles, 0.95), "max": handles[-1] if handles else None},
+            }
+
+
+BOT_DISPATCHER = UpdateDispatcher(bot, BOT_WORKERS, BOT_QUEUE_MAX)
+
+def bot_dispatcher_gauges():
+    stats = BOT_DISPATCHER.stats()
+    return [
+        ("app_bot_queue_depth", {}, stats["queue_depth"]),
+        ("app_bot_workers_busy", {}, stats["busy"]),
+        ("app_bot_updates_rejected", {}, stats["rejected"]),
+    ]
+
+def timed_handler(name, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            BOT_HANDLER_ERRORS.inc((name,))
+            raise
+        finally:
+            BOT_HANDLER_LATENCY.observe((name,), time.perf_counter() - started)
+    return wrapper
+
+if METRICS_ENABLED:
+    METRIC_GAUGES.append(bot_dispatcher_gauges)
+    bot.wrap_handlers(timed_handler)
+
+
+# Только один процесс опрашивает Telegram (getUpdates не терпит конкурентов) и регистрирует webhook
+BOT_LEADER_LOCK_ID = 7_310_002
+BOT_LEADER_RETRY = float(os.getenv("BOT_LEADER_RETRY", 5))
+
+class BotLeader:
+    """Выбор лидера для run_bot через advisory-блокировку, которую держит отдельное соединение.
+
+    Если процесс-лидер умирает, соединение закрывается, блокировка освобождается,
+    и следующий процесс забирает её в пределах BOT_LEADER_RETRY секунд.
+    """
+
+    def __init__(self, lock_id, retry):
+        self.lock_id = lock_id
+        self.retry = retry
+        self._conn = None
+        self._thread = None
+        self.is_leader = False
+        self.elected_at = None
+        self.elections = 0
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="bot-leader", daemon=True)
+        self._thread.start()
+
+    def _acquire(self):
+        if not DATABASE_URL:
+            # Без общей БД выбирать не из кого: единственный процесс сам себе лидер
+            return True
+        self._conn = psycopg2.connect(DATABASE_URL, sslmode=DB_SSLMODE, keepalives=1,
+                                      keepalives_idle=30, keepalives_interval=10, keepalives_count=3)
+        self._conn.autocommit = True
+        with self._conn.cursor() as cursor:
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", (self.lock_id,))
+            return cursor.fetchone()[0]
+
+    def _release(self):
+        self.is_leader = False
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+    def still_leader(self):
+        """Блокировка жива, пока живо соединение, которое её держит."""
+        if self._conn is None:
+            return self.is_leader
+        try:
+            with self._conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            return True
+        except Exception as e:
+            print(f"Bot leader lost connection: {e}")
+            return False
+
+    def _run(self):
+        while True:
+            try:
+                if self._acquire():
+                    self.is_leader = True
+                    self.elected_at = time.time()
+                    self.elections += 1
+                    print(f"Bot leader elected (pid {os.getpid()})")
+                    run_bot(self.still_leader)
+                    # В режиме webhook run_bot сразу возвращается: держим лидерство, пока живо соединение
+                    while self.still_leader():
+                        time.sleep(self.retry)
+            except Exception as e:
+                print(f"Bot leader error: {e}")
+            self._release()
+            time.sleep(self.retry)
+
+    def stats(self):
+        return {"is_leader": self.is_leader, "pid": os.getpid(), "elections": self.elections,
+                "elected_at": datetime.fromtimestamp(self.elected_at, timezone.utc).isoformat() if self.elected_at else None}
+
+
+BOT_LEADER = BotLeader(BOT_LEADER_LOCK_ID, BOT_LEADER_RETRY)
+
+def webhook_secret_ok(header_value):
+    if not BOT_WEBHOOK_SECRET:
+        return False
+    return hmac.compare_digest((header_value or "").encode(), BOT_WEBHOOK_SECRET.encode())
+
+
+# =============== AVATARS ===============
+AVATAR_DIR = os.getenv("AVATAR_DIR", os.path.join(BASE_DIR, 'avatar_cache'))
+AVATAR_TTL = float(os.getenv("AVATAR_TTL", 6 * 3600))
+AVATAR_MEMORY_ITEMS = int(os.getenv("AVATAR_MEMORY_ITEMS", 500))
+
+
+class AvatarStore:
+    """Локальный кэш аватарок из Telegram (память + диск) с фоновым обновлением.
+
+    client — объект с методами get_user_profile_photos, get_file и download_file
+    (TeleBot или заглушка в тестах).
+    """
+
+    def __init__(self, client, cache_dir, ttl, memory_items):
+        self.client = client
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self._memory = TTLCache(memory_items, ttl)
+        self._meta = {}
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="avatar")
+        self.fetches = 0
+        self.fetch_errors = 0
+
+    def _path(self, tg_id):
+        return os.path.join(self.cache_dir, f"{int(tg_id)}.jpg")
+
+    def _get_meta(self, tg_id):
+        meta = self._meta.get(tg_id)
+        if meta is None:
+            # После перезапуска подхватываем то, что уже лежит на диске
+            try:
+                st = os.stat(self._path(tg_id))
+                meta = {"etag": f"{int(st.st_mtime)}-{st.st_size}", "fetched_at": st.st_mtime, "has_photo": True}
+                self._meta[tg_id] = meta
+            except OSError:
+                return None
+        return meta
+
+    def avatar_url(self, tg_id):
+        """Возвращает URL аватарки без обращения к Telegram; при необходимости ставит обновление в фон."""
+        with self._lock:
+            meta = self._get_meta(tg_id)
+        if meta is None or time.time() - meta["fetched_at"] > self.ttl:
+            self.schedule_refresh(tg_id)
+        if meta and meta["has_photo"]:
+            return f"/api/avatar/{tg_id}?v={meta['etag']}"
+        return None
+
+    def schedule_refresh(self, tg_id):
+        with self._lock:
+            if tg_id in self._pending:
+                return
+            self._pending.add(tg_id)
+        self._executor.submit(self._refresh_safe, tg_id)
+
+    def _refresh_safe(self, tg_id):
+        try:
+            self.refresh(tg_id)
+        except Exception as e:
+            self.fetch_errors += 1
+            print(f"Avatar fetch error for {tg_id}: {e}")
+            # Не долбим Telegram повторно до истечения TTL
+            with self._lock:
+                meta = self._meta.setdefault(tg_id, {"etag": None, "has_photo": False})
+                meta["fetched_at"] = time.time()
+        finally:
+            with self._lock:
+                self._pending.discard(tg_id)
+
+    def refresh(self, tg_id):
+        self.fetches += 1
+        photos = self.client.get_user_profile_photos(tg_id, limit=1)
+        if photos.total_count == 0:
+            with self._lock:
+                self._meta[tg_id] = {"etag": None, "fetched_at": time.time(), "has_photo": False}
+            self._memory.invalidate(tg_id)
+            return
+        file_info = self.client.get_file(photos.photos[0][0].file_id)
+        data = self.client.download_file(file_info.file_path)
+        etag = hashlib.sha1(data).hexdigest()[:16]
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f"{self._path(tg_id)}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self._path(tg_id))
+
+        self._memory.set(tg_id, (data, etag))
+        with self._lock:
+            self._meta[tg_id] = {"etag": etag, "fetched_at": time.time(), "has_photo": True}
+
+    def load(self, tg_id):
+        """Возвращает (bytes, etag) из памяти или с диска, либо None."""
+        cached = self._memory.get(tg_id)
+        if cached:
+            return cached
+        with self._lock:
+            meta = self._get_meta(tg_id)
+        if not meta or not meta["has_photo"]:
+            return None
+        try:
+            with open(self._path(tg_id), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        self._memory.set(tg_id, (data, meta["etag"]))
+        return data, meta["etag"]
+
+    def stats(self):
+        return {"known": len(self._meta), "pending": len(self._pending), "fetches": self.fetches,
+                "fetch_errors": self.fetch_errors, "memory": self._memory.stats()}
+
+
+AVATARS = AvatarStore(bot, AVATAR_DIR, AVATAR_TTL, AVATAR_MEMORY_ITEMS)
+
+
+# =============== NOTIFICATION OUTBOX ===============
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", 1))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", 100))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 5))
+# Отправленные и исчерпавшие попытки строки хранятся столько часов, затем их удаляет SessionJanitor
+OUTBOX_RETENTION_HOURS = float(os.getenv("OUTBOX_RETENTION_HOURS", 168))
+# Лимиты Telegram: ~30 сообщений в секунду всего и 1 в секунду в один чат
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", 25))
+OUTBOX_CHAT_INTERVAL = float(os.getenv("OUTBOX_CHAT_INTERVAL", 1))
+
+def enqueue_notification(cursor, chat_id, kind, payload):
+    """Кладёт уведомление в outbox в рамках текущей транзакции; отправит фоновый воркер."""
+    cursor.execute(
+        "INSERT INTO notification_outbox (chat_id, kind, payload) VALUES (%s, %s, %s)",
+        (chat_id, kind, json.dumps(payload, ensure_ascii=False))
+    )
+
+def render_achievements(payloads):
+    if len(payloads) == 1:
+        p = payloads[0]
+        return f"🎉 <b>Новое достижение!</b>\n\n🏆 <b>{p['name']}</b>\n📝 {p['desc']}", "HTML"
+    lines = "\n\n".join(f"🏆 <b>{p['name']}</b>\n📝 {p['desc']}" for p in payloads)
+    return f"🎉 <b>Новые достижения ({len(payloads)})!</b>\n\n{lines}", "HTML"
+
+def render_text(payloads):
+    return "\n\n".join(p['text'] for p in payloads), payloads[0].get('parse_mode')
+
+# kind -> функция, склеивающая несколько уведомлений одного чата в одно сообщение
+OUTBOX_RENDERERS = {
+    "achievement": render_achievements,
+    "text": render_text,
+}
+
+
+class OutboxWorker:
+    """Фоновый воркер, который вычитывает notification_outbox и отправляет сообщения в Telegram.
+
+    Лимиты частоты живут в памяти процесса, поэтому отправляет только тот, для кого should_run() истинно.
+    """
+
+    def __init__(self, client, should_run=lambda: True):
+        self.client = client
+        self.should_run = should_run
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._chat_last_sent = {}
+        self._last_sent = 0.0
+        self.sent_messages = 0
+        self.sent_rows = 0
+        self.failures = 0
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="outbox", daemon=True)
+        self._thread.start()
+        print("Notification outbox worker started.")
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def wake(self):
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            if not self.should_run():
+                self._wake.wait(OUTBOX_POLL_INTERVAL)
+                self._wake.clear()
+                continue
+            try:
+                drained = self.drain_once()
+            except Exception as e:
+                print(f"Outbox error: {e}")
+                drained = 0
+            if drained < OUTBOX_BATCH_SIZE:
+                self._wake.wait(OUTBOX_POLL_INTERVAL)
+                self._wake.clear()
+
+    def _claim(self):
+        # Аренда строк на минуту вместо долгой транзакции на время отправки
+        with db_connection() as conn:
+            if not conn: return []
+            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                # Последняя попытка сразу получает срок хранения: строка не зависнет, даже если процесс упадёт
+                cursor.execute("""
+                    UPDATE notification_outbox
+                    SET attempts = attempts + 1, next_attempt_at = NOW() + INTERVAL '60 seconds',
+                        expires_at = CASE WHEN attempts + 1 >= %s THEN NOW() + make_interval(hours => %s) END
+                    WHERE id IN (
+                        SELECT id FROM notification_outbox
+                        WHERE sent_at IS NULL AND attempts < %s AND next_attempt_at <= NOW()
+                        ORDER BY id LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING id, chat_id, kind, payload, attempts
+                """, (OUTBOX_MAX_ATTEMPTS, OUTBOX_RETENTION_HOURS, OUTBOX_MAX_ATTEMPTS, OUTBOX_BATCH_SIZE))
+                rows = cursor.fetchall()
+                conn.commit()
+        return rows
+
+    def _finish(self, sent_ids, failed):
+        with db_connection() as conn:
+            if not conn: return
+            with conn.cursor() as cursor:
+                if sent_ids:
+                    cursor.execute("""
+                        UPDATE notification_outbox SET sent_at = NOW(), expires_at = NOW() + make_interval(hours => %s)
+                        WHERE id = ANY(%s)
+                    """, (OUTBOX_RETENTION_HOURS, sent_ids))
+                for ids, attempts, delay, error in failed:
+                    cursor.execute("""
+                        UPDATE notification_outbox
+                        SET next_attempt_at = NOW() + make_interval(secs => %s), last_error = %s
+                        WHERE id = ANY(%s)
+                    """, (delay, error[:500], ids))
+                conn.commit()
+
+    def _throttle(self, chat_id):
+        now = time.monotonic()
+        wait = max(self._last_sent + 1 / OUTBOX_GLOBAL_RATE - now,
+                   self._chat_last_sent.get(chat_id, 0) + OUTBOX_CHAT_INTERVAL - now)
+        if wait > 0:
+            time.sleep(wait)
+        now = time.monotonic()
+        self._last_sent = now
+        self._chat_last_sent[chat_id] = now
+        if len(self._chat_last_sent) > 10000:
+            cutoff = now - OUTBOX_CHAT_INTERVAL
+            self._chat_last_sent = {k: v for k, v in self._chat_last_sent.items() if v > cutoff}
+
+    def drain_once(self):
+        rows = self._claim()
+        if not rows:
+            return 0
+
+        # Несколько уведомлений одного вида в один чат склеиваем в одно сообщение;
+        # parse_mode у сообщения один, поэтому разметка разного вида не смешивается
+        groups = OrderedDict()
+        for row in rows:
+            payload = row['payload'] if isinstance(row['payload'], dict) else json.loads(row['payload'])
+            groups.setdefault((row['chat_id'], row['kind'], payload.get('parse_mode')), []).append((row, payload))
+
+        sent_ids, failed = [], []
+        for (chat_id, kind, _), entries in groups.items():
+            group = [row for row, _ in entries]
+            ids = [r['id'] for r in group]
+            renderer = OUTBOX_RENDERERS.get(kind)
+            if renderer is None:
+                failed.append((ids, group[0]['attempts'], 3600, f"unknown kind {kind}"))
+                continue
+            text, parse_mode = renderer([payload for _, payload in entries])
+            self._throttle(chat_id)
+            try:
+                self.client.send_message(chat_id, text, parse_mode=parse_mode)
+                sent_ids.extend(ids)
+                self.sent_messages += 1
+                self.sent_rows += len(ids)
+            except Exception as e:
+                self.failures += 1
+                attempts = max(r['attempts'] for r in group)
+                retry_after = getattr(e, 'result_json', None) or {}
+                delay = retry_after.get('parameters', {}).get('retry_after') or min(2 ** attempts, 300)
+                failed.append((ids, attempts, delay, str(e)))
+        self._finish(sent_ids, failed)
+        return len(rows)
+
+    def stats(self):
+        return {"active": self.should_run(), "sent_messages": self.sent_messages, "sent_rows": self.sent_rows,
+                "failures": self.failures}
+
+
+# Один отправитель на кластер — процесс, держащий BOT_LEADER: лимиты Telegram не умножаются на число воркеров
+OUTBOX = OutboxWorker(bot, lambda: BOT_LEADER.is_leader)
+
+
+# =============== PROGRESSION ===============
+SCORE_BATCH_MAX = int(os.getenv("SCORE_BATCH_MAX", 200))
+
+def score_rewards(score_val):
+    """Монеты и XP за одну партию."""
+    return max(1, int(score_val * 0.1)), max(1, int(score_val * 0.5))
+
+def parse_score_entries(entries, now):
+    """Разбирает пачку партий клиента в [(game_id, score, created_at)] и суммарные (coins, xp).
+
+    Время партии прижимается к окну [now - SCORE_LATE_DAYS, now]; на кривых данных — ValueError.
+    """
+    rows = []
+    earned_coins = earned_xp = 0
+    try:
+        for entry in entries:
+            game_id = str(entry["game_id"])
+            score_val = int(entry["score"])
+            played_at = entry.get("played_at")
+            if played_at:
+                played_at = datetime.fromisoformat(str(played_at).replace("Z", "+00:00"))
+                if played_at.tzinfo is None:
+                    played_at = played_at.replace(tzinfo=timezone.utc)
+                played_at = min(max(played_at, now - timedelta(days=SCORE_LATE_DAYS)), now)
+            else:
+                played_at = now
+            rows.append((game_id, score_val, played_at.isoformat()))
+            coins, xp = score_rewards(score_val)
+            earned_coins += coins
+            earned_xp += xp
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError("Invalid score entry") from e
+    return rows, earned_coins, earned_xp
+
+def level_up(xp, level):
+    """Переводит накопленный XP в уровни: на уровень N нужно N*1000 XP."""
+    xp_needed = level * 1000
+    # Пока XP хватает на следующий уровень, повышаем уровень и вычитаем XP
+    while xp >= xp_needed:
+        xp -= xp_needed
+        level += 1
+        xp_needed = level * 1000
+    return level, xp
+
+def add_progress(cursor, user_id, earned_coins, earned_xp):
+    """Начисляет монеты и XP одним UPDATE под блокировкой строки и возвращает (level, xp)."""
+    cursor.execute("""
+        UPDATE stats 
+        SET coins = coins + %s, xp = xp + %s 
+        WHERE user_id = %s
+        RETURNING xp, level
+    """, (earned_coins, earned_xp, user_id))
+    row = cursor.fetchone()
+    if not row:
+        return level_up(earned_xp, 1)
+    raw_xp, level = (row['xp'], row['level']) if isinstance(row, dict) else row
+    new_level, new_xp = level_up(raw_xp, level)
+    if new_level != level:
+        cursor.execute("UPDATE stats SET xp = %s, level = %s WHERE user_id = %s", (new_xp, new_level, user_id))
+    return new_level, new_xp
+
+
+# =============== ACHIEVEMENTS ===============
+# Правила живут в таблице achievement_rules (при старте туда досеиваются ACHIEVEMENTS_RULES)
+# или в JSON-файле ACHIEVEMENTS_FILE, который синхронизируется в таблицу.
+ACHIEVEMENTS_FILE = os.getenv("ACHIEVEMENTS_FILE")
+ACHIEVEMENTS_RELOAD_INTERVAL = float(os.getenv("ACHIEVEMENTS_RELOAD_INTERVAL", 60))
+
+# Тип правила -> счётчик в user_game_counters, с которым сравнивается порог
+ACHIEVEMENT_COUNTERS = {
+    "score": "best_score",    # лучший результат за одну партию
+    "total": "total_score",   # сумма очков за все партии
+    "plays": "plays",         # число сыгранных партий
+    "streak": "streak",       # дней подряд с хотя бы одной партией
+}
+
+def aggregate_plays(rows):
+    """Сводит партии [(game_id, score, created_at)] по играм: {game_id: {plays, total_score, best_score, day}}."""
+    per_game = {}
+    for game_id, score_val, created_at in rows:
+        day = datetime.fromisoformat(created_at).date()
+        agg = per_game.setdefault(str(game_id), {"plays": 0, "total_score": 0, "best_score": score_val, "day": day})
+        agg["plays"] += 1
+        agg["total_score"] += score_val
+        agg["best_score"] = max(agg["best_score"], score_val)
+        agg["day"] = max(agg["day"], day)
+    return per_game
+
+def advance_counters(counters, agg):
+    """Применяет сводку партий к счётчикам пользователя по игре (та же логика, что в bump_counters)."""
+    counters = dict(counters or {"plays": 0, "total_score": 0, "best_score": None, "streak": 0, "best_streak": 0, "last_played": None})
+    last = counters["last_played"]
+    if last is None or (agg["day"] - last).days > 1:
+        counters["streak"] = 1
+    elif (agg["day"] - last).days == 1:
+        counters["streak"] += 1
+    counters["best_streak"] = max(counters["best_streak"], counters["streak"])
+    counters["last_played"] = max(last, agg["day"]) if last else agg["day"]
+    counters["plays"] += agg["plays"]
+    counters["total_score"] += agg["total_score"]
+    counters["best_score"] = agg["best_score"] if counters["best_score"] is None else max(counters["best_score"], agg["best_score"])
+    return counters
+
+# Продолжение CTE после источника v (user_id, game_id, plays, total_score, best_score, day);
+# общий для bump_counters и асинхронного режима (asgi.py)
+BUMP_COUNTERS_SQL = """
+        prev AS (
+            SELECT c.* FROM user_game_counters c JOIN v ON c.user_id = v.user_id AND c.game_id = v.game_id
+        ),
+        up AS (
+            INSERT INTO user_game_counters AS c (user_id, game_id, plays, total_score, best_score, streak, best_streak, last_played)
+            SELECT user_id, game_id, plays, total_score, best_score, 1, 1, day FROM v
+            ON CONFLICT (user_id, game_id) DO UPDATE SET
+                plays = c.plays + EXCLUDED.plays,
+                total_score = c.total_score + EXCLUDED.total_score,
+                best_score = GREATEST(c.best_score, EXCLUDED.best_score),
+                streak = CASE WHEN EXCLUDED.last_played - c.last_played = 1 THEN c.streak + 1
+                              WHEN EXCLUDED.last_played - c.last_played > 1 THEN 1
+                              ELSE c.streak END,
+                best_streak = GREATEST(c.best_streak, CASE WHEN EXCLUDED.last_played - c.last_played = 1 THEN c.streak + 1
+                                                           ELSE 1 END),
+                last_played = GREATEST(c.last_played, EXCLUDED.last_played)
+            RETURNING c.game_id, c.plays, c.total_score, c.best_score, c.streak
+        )
+        SELECT up.game_id, up.plays, up.total_score, up.best_score, up.streak,
+               prev.plays AS prev_plays, prev.total_score AS prev_total_score,
+               prev.best_score AS prev_best_score, prev.streak AS prev_streak
+        FROM up LEFT JOIN prev ON prev.game_id = up.game_id
+"""
+
+def counter_changes(rows):
+    """Разбирает ответ BUMP_COUNTERS_SQL в {game_id: (старые, новые)} счётчики."""
+    columns = ("plays", "total_score", "best_score", "streak")
+    result = {}
+    for row in rows:
+        row = list(row.values()) if isinstance(row, dict) else row
+        result[row[0]] = (dict(zip(columns, row[5:])) if row[5] is not None else {}, dict(zip(columns, row[1:5])))
+    return result
+
+def bump_counters(cursor, user_id, per_game):
+    """Обновляет user_game_counters одним выражением и возвращает {game_id: (старые, новые)} счётчики.
+
+    CTE prev читает снимок до обновления, поэтому старые значения приходят в том же ответе.
+    """
+    rows = execute_values(cursor, "WITH v (user_id, game_id, plays, total_score, best_score, day) AS (VALUES %s)," + BUMP_COUNTERS_SQL,
+        [(user_id, game_id, agg["plays"], agg["total_score"], agg["best_score"], agg["day"]) for game_id, agg in per_game.items()],
+        template="(%s, %s, %s, %s, %s, %s::date)", page_size=max(len(per_game), 1), fetch=True)
+    return counter_changes(rows)
+
+
+class AchievementEngine:
+    """Правила достижений, проиндексированные по (game_id, тип) с отсортированными порогами.
+
+    Партия проверяет только правила, чей порог счётчик пересёк на этом шаге.
+    """
+
+    def __init__(self, seed_rules, reload_interval):
+        self.reload_interval = reload_interval
+        self._thread = None
+        self._file_mtime = None
+        self._signature = None
+        self.rules = []
+        self._index = {}
+        self.reloads = 0
+        self.load([{"id": r["id"], "game_id": r["game_id"], "kind": "score", "threshold": r["score"],
+                    "name": r["name"], "desc": r["desc"]} for r in seed_rules])
+
+    def load(self, rules):
+        index = {}
+        for rule in rules:
+            index.setdefault((rule["game_id"], rule["kind"]), []).append(rule)
+        for key, bucket in index.items():
+            bucket.sort(key=lambda r: r["threshold"])
+            index[key] = ([r["threshold"] for r in bucket], bucket)
+        # Подмена ссылок атомарна: читатели видят либо старый, либо новый набор целиком
+        self.rules, self._index = list(rules), index
+
+    def crossed(self, game_id, old, new):
+        """Правила игры, пороги которых лежат в (old, new] для любого из счётчиков."""
+        hits = []
+        for kind, column in ACHIEVEMENT_COUNTERS.items():
+            bucket = self._index.get((game_id, kind))
+            if not bucket or new.get(column) is None:
+                continue
+            thresholds, rules = bucket
+            old_value = old.get(column)
+            lo = 0 if old_value is None else bisect.bisect_right(thresholds, old_value)
+            hi = bisect.bisect_right(thresholds, new[column])
+            hits.extend(rules[lo:hi])
+        return hits
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="achievements", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            self.reload()
+            time.sleep(self.reload_interval)
+
+    def _sync_file(self, cursor):
+        mtime = os.path.getmtime(ACHIEVEMENTS_FILE)
+        if mtime == self._file_mtime:
+            return
+        with open(ACHIEVEMENTS_FILE, encoding='utf-8') as f:
+            rules = json.load(f)
+        execute_values(cursor, """
+            INSERT INTO achievement_rules (id, game_id, kind, threshold, name, description) VALUES %s
+            ON CONFLICT (id) DO UPDATE SET game_id = EXCLUDED.game_id, kind = EXCLUDED.kind,
+                threshold = EXCLUDED.threshold, name = EXCLUDED.name, description = EXCLUDED.description, enabled = TRUE
+        """, [(r["id"], str(r["game_id"]), r.get("kind", "score"), r["threshold"], r["name"], r.get("desc", "")) for r in rules])
+        cursor.execute("UPDATE achievement_rules SET enabled = FALSE WHERE NOT (id = ANY(%s))", ([r["id"] for r in rules],))
+        self._file_mtime = mtime
+
+    def reload(self):
+        """Перечитывает правила; новые правила выдаются существующим игрокам одним проходом."""
+        try:
+            with db_connection() as conn:
+                if not conn: return False
+                with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                    if ACHIEVEMENTS_FILE:
+                        self._sync_file(cursor)
+                    cursor.execute("""
+                        SELECT id, game_id, kind, threshold, name, description AS "desc", backfilled_at IS NULL AS needs_backfill
+                        FROM achievement_rules WHERE enabled ORDER BY game_id, threshold, id
+                    """)
+                    rows = cursor.fetchall()
+                    pending = [r['id'] for r in rows if r['needs_backfill']]
+                    if pending:
+                        granted = backfill_achievements(cursor, pending)
+                        print(f"Achievements backfilled: {len(pending)} rules, {granted} grants.")
+                conn.commit()
+        except Exception as e:
+            print(f"Achievements reload error: {e}")
+            return False
+
+        rules = [{k: r[k] for k in ("id", "game_id", "kind", "threshold", "name", "desc")} for r in rows]
+        signature = tuple(tuple(r.values()) for r in rules)
+        if signature != self._signature:
+            self.load(rules)
+            self._signature = signature
+            self.reloads += 1
+            if pending and SCORE_BUFFER:
+                SCORE_BUFFER.forget()
+        return True
+
+
+ACHIEVEMENTS = AchievementEngine(ACHIEVEMENTS_RULES, ACHIEVEMENTS_RELOAD_INTERVAL)
+
+def backfill_achievements(cursor, rule_ids):
+    """Массово выдаёт правила rule_ids всем, кто уже дотянул до порога, по user_game_counters."""
+    cursor.execute("""
+        WITH granted AS (
+            INSERT INTO user_achievements (user_id, achievement_id)
+            SELECT c.user_id, r.id
+            FROM achievement_rules r
+            JOIN user_game_counters c ON c.game_id = r.game_id
+            WHERE r.id = ANY(%s) AND CASE r.kind
+                WHEN 'score' THEN c.best_score
+                WHEN 'total' THEN c.total_score
+                WHEN 'plays' THEN c.plays
+                WHEN 'streak' THEN c.best_streak
+            END >= r.threshold
+            ON CONFLICT DO NOTHING
+            RETURNING 1
+        )
+        SELECT COUNT(*) FROM granted
+    """, (list(rule_ids),))
+    row = cursor.fetchone()
+    granted = row['count'] if isinstance(row, dict) else row[0]
+    cursor.execute("UPDATE achievement_rules SET backfilled_at = NOW() WHERE id = ANY(%s)", (list(rule_ids),))
+    return granted
+
+def grant_rules(cursor, user_id, tg_id, rules):
+    """Записывает достижения (пропуская уже полученные) и ставит уведомления в outbox."""
+    if not rules:
+        return []
+    date_str = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    inserted = execute_values(cursor, """
+        INSERT INTO user_achievements (user_id, achievement_id, unlocked_at) VALUES %s
+        ON CONFLICT DO NOTHING RETURNING achievement_id
+    """, [(user_id, rule["id"], date_str) for rule in rules], fetch=True)
+    inserted_ids = {row[0] if not isinstance(row, dict) else row['achievement_id'] for row in inserted}
+    new_unlocked = [rule for rule in rules if rule["id"] in inserted_ids]
+    if tg_id:
+        for rule in new_unlocked:
+            enqueue_notification(cursor, tg_id, "achievement", {"name": rule['name'], "desc": rule['desc']})
+    return new_unlocked
+
+def grant_achievements(cursor, user_id, tg_id, per_game):
+    """Обновляет счётчики по сводке партий и выдаёт достижения, чьи пороги были пересечены."""
+    candidates, seen = [], set()
+    for game_id, (old, new) in bump_counters(cursor, user_id, per_game).items():
+        for rule in ACHIEVEMENTS.crossed(game_id, old, new):
+            if rule["id"] not in seen:
+                seen.add(rule["id"])
+                candidates.append(rule)
+    return grant_rules(cursor, user_id, tg_id, candidates)
+
+
+# =============== WRITE-BEHIND SCORES ===============
+# Необязательный режим: очки копятся в памяти и пишутся пачками.
+# Строки, не успевшие попасть в БД, теряются при аварийном падении процесса.
+# xp/level здесь живут в памяти процесса, поэтому режим годится только для одного процесса
+# (gunicorn.conf.py отключает его при нескольких воркерах).
+SCORE_WRITE_BEHIND = os.getenv("SCORE_WRITE_BEHIND", "0") == "1"
+SCORE_FLUSH_INTERVAL_MS = int(os.getenv("SCORE_FLUSH_INTERVAL_MS", 200))
+SCORE_FLUSH_ROWS = int(os.getenv("SCORE_FLUSH_ROWS", 500))
+SCORE_BUFFER_MAX = int(os.getenv("SCORE_BUFFER_MAX", 10000))
+# Сколько держать в памяти состояние пользователя (xp/level/достижения) после последней партии
+SCORE_STATE_IDLE = float(os.getenv("SCORE_STATE_IDLE", 600))
+
+
+class ScoreBuffer:
+    """Буфер записи game_scores с групповым коммитом и схлопыванием дельт stats по пользователю.
+
+    Для пользователей с активным состоянием буфер — источник истины по xp/level,
+    поэтому ответ клиенту содержит корректный уровень ещё до сброса в БД.
+    """
+
+    def __init__(self, interval_ms, flush_rows, max_rows, state_idle):
+        self.interval = interval_ms / 1000
+        self.flush_rows = flush_rows
+        self.max_rows = max_rows
+        self.state_idle = state_idle
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._users = {}
+        self._dirty = set()
+        self._dirty_counters = set()
+        self._scores = []
+        self._achievements = []
+        self._notifications = []
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.failures = 0
+        self.last_flush_size = 0
+        self.max_flush_size = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    def start(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="score-flusher", daemon=True)
+            self._thread.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def _load_state(self, user_id, tg_id):
+        state = {"tg_id": tg_id, "xp": 0, "level": 1, "coins_delta": 0, "achievements": set(), "counters": {}}
+        with db_connection() as conn:
+            if not conn:
+                raise RuntimeError("DB Error")
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT xp, level FROM stats WHERE user_id=%s", (user_id,))
+                row = cursor.fetchone()
+                if row:
+                    state["xp"], state["level"] = row[0] or 0, row[1] or 1
+                cursor.execute("SELECT achievement_id FROM user_achievements WHERE user_id=%s", (user_id,))
+                state["achievements"] = {r[0] for r in cursor.fetchall()}
+                cursor.execute("""
+                    SELECT game_id, plays, total_score, best_score, streak, best_streak, last_played
+                    FROM user_game_counters WHERE user_id=%s
+                """, (user_id,))
+                for game_id, *values in cursor.fetchall():
+                    state["counters"][game_id] = dict(zip(("plays", "total_score", "best_score", "streak", "best_streak", "last_played"), values))
+        return state
+
+    def record(self, user_id, tg_id, rows, earned_coins, earned_xp):
+        """Буферизует партии [(game_id, score, created_at)] и возвращает (level, xp, новые достижения)."""
+        self.start()
+        if len(self._scores) >= self.max_rows:
+            # Буфер переполнен — сбрасываем в потоке запроса (backpressure)
+            self.flush()
+            if len(self._scores) >= self.max_rows:
+                raise BufferError("score buffer is full")
+        if user_id not in self._users:
+            state = self._load_state(user_id, tg_id)
+            with self._lock:
+                self._users.setdefault(user_id, state)
+
+        with self._lock:
+            state = self._users[user_id]
+            state["coins_delta"] += earned_coins
+            state["level"], state["xp"] = level_up(state["xp"] + earned_xp, state["level"])
+            state["touched"] = time.monotonic()
+            new_unlocked = []
+            for game_id, agg in aggregate_plays(rows).items():
+                old = state["counters"].get(game_id) or {}
+                new = state["counters"][game_id] = advance_counters(old or None, agg)
+                self._dirty_counters.add((user_id, game_id))
+                for rule in ACHIEVEMENTS.crossed(game_id, old, new):
+                    if rule["id"] not in state["achievements"]:
+                        state["achievements"].add(rule["id"])
+                        new_unlocked.append(rule)
+
+            self._scores.extend((user_id, game_id, score_val, created_at) for game_id, score_val, created_at in rows)
+            if new_unlocked:
+                date_str = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+                for rule in new_unlocked:
+                    self._achievements.append((user_id, rule["id"], date_str))
+                    if tg_id:
+                        payload = json.dumps({"name": rule['name'], "desc": rule['desc']}, ensure_ascii=False)
+                        self._notifications.append((tg_id, "achievement", payload))
+            self._dirty.add(user_id)
+            pending = len(self._scores)
+            result = (state["level"], state["xp"], new_unlocked)
+
+        if pending >= self.flush_rows:
+            self._wake.set()
+        return result
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                scores, self._scores = self._scores, []
+                achievements, self._achievements = self._achievements, []
+                notifications, self._notifications = self._notifications, []
+                dirty, self._dirty = self._dirty, set()
+                dirty_counters, self._dirty_counters = self._dirty_counters, set()
+                stats_rows = []
+                for user_id in dirty:
+                    state = self._users[user_id]
+                    stats_rows.append((user_id, state["coins_delta"], state["xp"], state["level"]))
+                    state["coins_delta"] = 0
+                counter_rows = []
+                for user_id, game_id in dirty_counters:
+                    c = self._users[user_id]["counters"][game_id]
+                    counter_rows.append((user_id, game_id, c["plays"], c["total_score"], c["best_score"],
+                                         c["streak"], c["best_streak"], c["last_played"]))
+            if not scores and not stats_rows:
+                return 0
+
+            started = time.monotonic()
+            try:
+                with db_connection() as conn:
+                    if not conn:
+                        raise RuntimeError("DB Error")
+                    with conn.cursor() as cursor:
+                        if scores:
+                            execute_values(cursor,
+                                           "INSERT INTO game_scores (user_id, game_id, score, created_at) VALUES %s",
+                                           scores, page_size=1000)
+                            upsert_best_scores(cursor, scores)
+                        if stats_rows:
+                            # Один UPDATE на пользователя за сброс, все пользователи — одним выражением
+                            execute_values(cursor, """
+                                UPDATE stats s SET coins = s.coins + v.coins, xp = v.xp, level = v.level
+                                FROM (VALUES %s) AS v(user_id, coins, xp, level)
+                                WHERE s.user_id = v.user_id
+                            """, stats_rows, page_size=1000)
+                        if counter_rows:
+                            execute_values(cursor, """
+                                INSERT INTO user_game_counters (user_id, game_id, plays, total_score, best_score, streak, best_streak, last_played)
+                                VALUES %s
+                                ON CONFLICT (user_id, game_id) DO UPDATE SET
+                                    plays = EXCLUDED.plays, total_score = EXCLUDED.total_score, best_score = EXCLUDED.best_score,
+                                    streak = EXCLUDED.streak, best_streak = EXCLUDED.best_streak, last_played = EXCLUDED.last_played
+                            """, counter_rows, page_size=1000)
+                        if achievements:
+                            execute_values(cursor,
+                                           "INSERT INTO user_achievements (user_id, achievement_id, unlocked_at) VALUES %s ON CONFLICT DO NOTHING",
+                                           achievements)
+                        if notifications:
+                            execute_values(cursor,
+                                           "INSERT INTO notification_outbox (chat_id, kind, payload) VALUES %s",
+                                           notifications)
+                    conn.commit()
+            except Exception as e:
+                print(f"Score flush error: {e}")
+                with self._lock:
+                    self.failures += 1
+                    self._scores[:0] = scores
+                    self._achievements[:0] = achievements
+                    self._notifications[:0] = notifications
+                    for user_id, coins_delta, _, _ in stats_rows:
+                        self._users[user_id]["coins_delta"] += coins_delta
+                        self._dirty.add(user_id)
+                    self._dirty_counters |= dirty_counters
+                return 0
+
+            elapsed_ms = (time.monotonic() - started) * 1000
+            with self._lock:
+                self.flushes += 1
+                self.flushed_rows += len(scores)
+                self.last_flush_size = len(scores)
+                self.max_flush_size = max(self.max_flush_size, len(scores))
+                self.last_flush_ms = elapsed_ms
+                self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+                self.total_flush_ms += elapsed_ms
+                cutoff = time.monotonic() - self.state_idle
+                for user_id in [u for u, s in self._users.items() if u not in self._dirty and s.get("touched", 0) < cutoff]:
+                    del self._users[user_id]
+            if notifications:
+                OUTBOX.wake()
+            return len(scores)
+
+    def forget(self, user_id=None):
+        """Сбрасывает состояние пользователя (или всех), изменённое в обход буфера (например, массовая выдача достижений)."""
+        self.flush()
+        with self._lock:
+            for uid in ([user_id] if user_id is not None else list(self._users)):
+                if uid not in self._dirty:
+                    self._users.pop(uid, None)
+
+    def reset(self):
+        """Выбрасывает весь буфер без записи — перед полной очисткой БД."""
+        with self._flush_lock, self._lock:
+            self._users.clear()
+            self._dirty.clear()
+            self._dirty_counters.clear()
+            self._scores.clear()
+            self._achievements.clear()
+            self._notifications.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending_rows": len(self._scores),
+                "users": len(self._users),
+                "flushes": self.flushes,
+                "flushed_rows": self.flushed_rows,
+                "failures": self.failures,
+                "last_flush_size": self.last_flush_size,
+                "max_flush_size": self.max_flush_size,
+                "last_flush_ms": round(self.last_flush_ms, 2),
+                "max_flush_ms": round(self.max_flush_ms, 2),
+                "avg_flush_ms": round(self.total_flush_ms / self.flushes, 2) if self.flushes else 0.0,
+            }
+
+
+SCORE_BUFFER = ScoreBuffer(SCORE_FLUSH_INTERVAL_MS, SCORE_FLUSH_ROWS, SCORE_BUFFER_MAX, SCORE_STATE_IDLE) if SCORE_WRITE_BEHIND else None
+
+def record_scores_buffered(session_id, rows, earned_coins, earned_xp):
+    """Путь записи в режиме write-behind: соединение нужно только при промахе кэша сессий."""
+    with db_connection() as conn:
+        if not conn: return None
+        with conn.cursor() as cursor:
+            identity = resolve_session(cursor, session_id)
+    if not identity:
+        return None
+    result = SCORE_BUFFER.record(identity['user_id'], identity['tg_id'], rows, earned_coins, earned_xp)
+    LEADERBOARDS.submit(identity['user_id'], rows)
+    # Write-behind работает в одном процессе, так что событие раздаётся прямо здесь, без NOTIFY
+    EVENTS.publish(identity['user_id'], {"origin": event_origin(session_id), **progress_event(earned_coins, *result)})
+    return result
+
+
+
+# =============== ADMISSION CONTROL ===============
+# Отсекает лишние записи очков до БД: правдоподобие очков, токен-бакеты по сессии и пользователю,
+# общий лимит одновременных записей. Ноль в любом лимите отключает соответствующую проверку.
+SCORE_SESSION_RATE = float(os.getenv("SCORE_SESSION_RATE", 1))  # токенов в секунду
+SCORE_SESSION_BURST = float(os.getenv("SCORE_SESSION_BURST", 10))
+SCORE_USER_RATE = float(os.getenv("SCORE_USER_RATE", 2))
+SCORE_USER_BURST = float(os.getenv("SCORE_USER_BURST", 20))
+SCORE_MAX_INFLIGHT = int(os.getenv("SCORE_MAX_INFLIGHT", 32))
+SCORE_SHED_RETRY_AFTER = int(os.getenv("SCORE_SHED_RETRY_AFTER", 1))
+RATE_LIMIT_KEYS_MAX = int(os.getenv("RATE_LIMIT_KEYS_MAX", 100000))
+# memory — счётчики в процессе; postgres — общие для всех воркеров (лишний запрос к БД на проверку)
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+# 0 — не сверять очки с GAME_SCORE_LIMITS (бенчмарк, отладка клиента)
+SCORE_CHECK_PLAUSIBLE = os.getenv("SCORE_CHECK_PLAUSIBLE", "1") == "1"
+# Потолок длительности партии и срок жизни play_token; без длительности засчитывается только запас игры
+SCORE_PLAY_MAX_SECONDS = float(os.getenv("SCORE_PLAY_MAX_SECONDS", 3600))
+# 1 — верить только длительности по play_token от /api/game/start, а не полю duration клиента
+SCORE_REQUIRE_PLAY_TOKEN = os.getenv("SCORE_REQUIRE_PLAY_TOKEN", "0") == "1"
+# Общий для всех воркеров ключ подписи play_token; без него и без BOT_TOKEN токены не выдаются и не принимаются
+PLAY_TOKEN_SECRET = os.getenv("PLAY_TOKEN_SECRET") or (BOT_TOKEN and hashlib.sha256(f"play-token:{BOT_TOKEN}".encode()).hexdigest())
+PLAY_TOKEN_SECRET = PLAY_TOKEN_SECRET.encode() if PLAY_TOKEN_SECRET else None
+if not PLAY_TOKEN_SECRET:
+    print("WARNING: PLAY_TOKEN_SECRET и BOT_TOKEN не заданы, play_token выключены!")
+# game_id -> (очков в секунду игры, запас на короткие партии); игры без записи не проверяются
+GAME_SCORE_LIMITS = {
+    '1': (3000, 4096),  # 2048
+    '2': (5, 10),       # Snake: очко за яблоко
+    '3': (15, 50),      # Dino Run: ~6 очков в секунду при 60 fps
+    '4': (25, 50),      # Clicker: клики за минуту
+    '6': (0, 1),        # Сапёр: 0 или 1 независимо от длительности
+    '8': (200, 400),    # Tetris: 100 за линию
+}
+GAME_SCORE_LIMITS.update({k: tuple(v) for k, v in json.loads(os.getenv("GAME_SCORE_LIMITS", "{}")).items()})
+
+def play_token_signature(session_id, game_id, started_ms):
+    message = f"{session_id}:{game_id}:{started_ms}".encode()
+    return hmac.new(PLAY_TOKEN_SECRET, message, hashlib.sha256).hexdigest()[:32]
+
+def issue_play_token(session_id, game_id):
+    """Метка начала игры, подписанная сервером: длительность по ней клиент подделать не может. None — нет ключа."""
+    if not PLAY_TOKEN_SECRET:
+        return None
+    started_ms = int(time.time() * 1000)
+    return f"{started_ms}.{play_token_signature(session_id, game_id, started_ms)}"
+
+def play_token_seconds(token, session_id, game_id):
+    """Секунды с выдачи play_token и гасит его. None — токен не от этой сессии и игры, просрочен или уже погашен."""
+    if not PLAY_TOKEN_SECRET:
+        return None
+    try:
+        started_ms, signature = str(token).split(".", 1)
+        started_ms = int(started_ms)
+    except (TypeError, ValueError):
+        return None
+    if not hmac.compare_digest(signature.encode(), play_token_signature(session_id, game_id, started_ms).encode()):
+        return None
+    seconds = max(time.time() - started_ms / 1000, 0.0)
+    if seconds > SCORE_PLAY_MAX_SECONDS or not PLAY_TOKENS_USED.consume(str(token)):
+        return None
+    return seconds
+
+def plausible_score(entry, session_id=None):
+    """Очки не больше rate * длительность + запас; кривые записи пропускаются — их отклонит обработчик.
+
+    Длительность берётся из play_token, иначе из duration клиента (если это не запрещено); без неё — ноль.
+    """
+    try:
+        limit = GAME_SCORE_LIMITS.get(str(entry["game_id"]))
+        score = int(entry["score"])
+        seconds = None
+        if entry.get("play_token") and session_id:
+            seconds = play_token_seconds(entry["play_token"], session_id, str(entry["game_id"]))
+        if seconds is None and entry.get("duration") is not None and not SCORE_REQUIRE_PLAY_TOKEN:
+            seconds = float(entry["duration"])
+        seconds = min(max(seconds or 0.0, 0.0), SCORE_PLAY_MAX_SECONDS)
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return True
+    if not limit or not SCORE_CHECK_PLAUSIBLE:
+        return True
+    rate, allowance = limit
+    return score <= allowance + rate * seconds
+
+def split_plausible(entries, session_id):
+    """Делит пачку на записи для сохранения и индексы неправдоподобных: одна кривая партия не губит остальные."""
+    kept, rejected = [], []
+    for index, entry in enumerate(entries):
+        if isinstance(entry, dict) and not plausible_score(entry, session_id):
+            rejected.append(index)
+        else:
+            kept.append(entry)
+    if rejected:
+        ADMISSION_REJECTED.inc(("implausible",), len(rejected))
+    return kept, rejected
+
+
+class UsedPlayTokens:
+    """Погашенные play_token в памяти процесса; при нескольких воркерах у каждого свой список."""
+
+    def __init__(self, ttl, maxsize):
+        self._cache = TTLCache(maxsize, ttl)
+        self._lock = threading.Lock()
+
+    def consume(self, token):
+        """True, если токен гасится впервые."""
+        with self._lock:
+            if self._cache.get(token):
+                return False
+            self._cache.set(token, True)
+            return True
+
+
+class PostgresUsedPlayTokens:
+    """Погашенные play_token в UNLOGGED-таблице, общей для всех процессов. При ошибке БД токен не принимается."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+
+    def consume(self, token):
+        try:
+            with db_connection() as conn:
+                if not conn: return False
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        INSERT INTO play_tokens_used (token, expires_at)
+                        VALUES (%s, clock_timestamp() + make_interval(secs => %s))
+                        ON CONFLICT (token) DO NOTHING
+                        RETURNING token
+                    """, (token, self.ttl))
+                    consumed = cursor.fetchone() is not None
+                conn.commit()
+            return consumed
+        except Exception as e:
+            print(f"Play token error: {e}")
+            return False
+
+
+class TokenBuckets:
+    """Токен-бакеты в памяти процесса: rate токенов в секунду, ёмкость burst; старые ключи вытесняются LRU."""
+
+    def __init__(self, rate, burst, maxsize):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()  # key -> (токены, monotonic последнего обновления)
+        self._lock = threading.Lock()
+
+    def take(self, key):
+        """Забирает токен. Возвращает 0, если запрос допущен, иначе сколько секунд ждать следующего."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+            self._buckets[key] = (tokens - 1 if not wait else tokens, now)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+# Один атомарный UPSERT: пополнение по прошедшему времени и списание токена; нет строки — отказ
+RATE_LIMIT_TAKE_SQL = """
+    /* rate_limit_take */
+    INSERT INTO rate_limit_buckets AS b (key, tokens, updated_at, expires_at)
+    VALUES (%(key)s, %(burst)s - 1, clock_timestamp(), clock_timestamp() + make_interval(secs => %(window)s))
+    ON CONFLICT (key) DO UPDATE SET
+        tokens = LEAST(%(burst)s, b.tokens + EXTRACT(EPOCH FROM clock_timestamp() - b.updated_at) * %(rate)s) - 1,
+        updated_at = clock_timestamp(),
+        expires_at = clock_timestamp() + make_interval(secs => %(window)s)
+    WHERE LEAST(%(burst)s, b.tokens + EXTRACT(EPOCH FROM clock_timestamp() - b.updated_at) * %(rate)s) >= 1
+    RETURNING tokens
+"""
+
+class PostgresTokenBuckets:
+    """Те же бакеты в UNLOGGED-таблице: лимит общий для всех процессов. При ошибке БД запрос допускается."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        # Через столько секунд бакет снова полон и строку можно удалить (это делает SessionJanitor)
+        self.window = burst / rate
+
+    def take(self, key):
+        try:
+            with db_connection() as conn:
+                if not conn: return 0.0
+                with conn.cursor() as cursor:
+                    cursor.execute(RATE_LIMIT_TAKE_SQL, {"key": key, "rate": self.rate, "burst": self.burst, "window": self.window})
+                    admitted = cursor.fetchone() is not None
+                conn.commit()
+            return 0.0 if admitted else 1 / self.rate
+        except Exception as e:
+            print(f"Rate limit error: {e}")
+            return 0.0
+
+
+class ConcurrencyGate:
+    """Ограничивает число одновременных записей очков в процессе; сверх лимита — сразу 429, без ожидания."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._inflight = 0
+        self._lock = threading.Lock()
+        self.peak = 0
+        self.shed = 0
+
+    def enter(self):
+        with self._lock:
+            if self.limit and self._inflight >= self.limit:
+                self.shed += 1
+                return False
+            self._inflight += 1
+            self.peak = max(self.peak, self._inflight)
+            return True
+
+    def leave(self):
+        with self._lock:
+            self._inflight -= 1
+
+    def stats(self):
+        with self._lock:
+            return {"inflight": self._inflight, "limit": self.limit, "peak": self.peak, "shed": self.shed}
+
+
+def token_buckets(rate, burst):
+    if not rate:
+        return None
+    if RATE_LIMIT_BACKEND == "postgres":
+        return PostgresTokenBuckets(rate, burst)
+    return TokenBuckets(rate, burst, RATE_LIMIT_KEYS_MAX)
+
+SESSION_BUCKETS = token_buckets(SCORE_SESSION_RATE, SCORE_SESSION_BURST)
+USER_BUCKETS = token_buckets(SCORE_USER_RATE, SCORE_USER_BURST)
+SCORE_GATE = ConcurrencyGate(SCORE_MAX_INFLIGHT)
+if RATE_LIMIT_BACKEND == "postgres":
+    PLAY_TOKENS_USED = PostgresUsedPlayTokens(SCORE_PLAY_MAX_SECONDS)
+else:
+    PLAY_TOKENS_USED = UsedPlayTokens(SCORE_PLAY_MAX_SECONDS, RATE_LIMIT_KEYS_MAX)
+
+def rejection(reason, status, error, retry_after=None):
+    ADMISSION_REJECTED.inc((reason,))
+    payload = {"success": False, "error": error}
+    headers = {}
+    if retry_after is not None:
+        seconds = max(1, math.ceil(retry_after))
+        payload["retry_after"] = seconds
+        headers["Retry-After"] = str(seconds)
+    return payload, status, headers
+
+def admit_scores(data):
+    """Проверки записи очков до БД. None — запрос допущен (после него обязателен SCORE_GATE.leave()),
+    иначе (payload, status, headers) для ответа. Пачку на правдоподобие проверяет split_plausible в обработчике."""
+    session_id = data.get("session")
+    if session_id and SESSION_BUCKETS:
+        wait = SESSION_BUCKETS.take(f"s:{session_id}")
+        if wait:
+            return rejection("session", 429, "Too many requests", wait)
+    # Пользователь известен без БД, только если сессия уже в кэше; иначе хватает лимита сессии
+    identity = SESSION_CACHE.get(session_id) if session_id and USER_BUCKETS else None
+    if identity:
+        wait = USER_BUCKETS.take(f"u:{identity['user_id']}")
+        if wait:
+            return rejection("user", 429, "Too many requests", wait)
+    if not SCORE_GATE.enter():
+        return rejection("overloaded", 429, "Server busy", SCORE_SHED_RETRY_AFTER)
+    # Последней: проверка гасит play_token, а после отказа 429 клиент отправит партию с ним же
+    if not isinstance(data.get("scores"), list) and not plausible_score(data, session_id):
+        SCORE_GATE.leave()
+        return rejection("implausible", 400, "Implausible score")
+    return None
+
+def admission_controlled(view):
+    """Flask-обёртка для маршрутов записи очков."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        data = request.get_json(silent=True)
+        rejected = admit_scores(data if isinstance(data, dict) else {})
+        if rejected:
+            payload, status, headers = rejected
+            return jsonify(payload), status, headers
+        try:
+            return view(*args, **kwargs)
+        finally:
+            SCORE_GATE.leave()
+    return wrapper
+
+
+# =============== SHOP ===============
+# Каждое действие — одно выражение с условными UPDATE, возвращающее (ok, coins, inventory).
+# Если ok ложно, часть CTE могла сработать, поэтому вызывающий откатывает транзакцию.
+# Инвентарь дописывается под блокировкой строки user_progress, затем списываются монеты:
+# параллельные покупки из двух вкладок не купят предмет дважды и не уведут баланс в минус.
+SHOP_BULK_MAX = int(os.getenv("SHOP_BULK_MAX", 20))
+
+SHOP_BUY_SQL = """
+    WITH added AS (
+        UPDATE user_progress SET inventory = inventory || to_jsonb(%s::text[])
+        WHERE user_id = %s AND NOT inventory ?| %s::text[]
+        RETURNING inventory
+    ), paid AS (
+        UPDATE stats SET coins = coins - %s
+        WHERE user_id = %s AND coins >= %s AND EXISTS (SELECT 1 FROM added)
+        RETURNING coins
+    )
+    SELECT paid.coins IS NOT NULL AS ok,
+           COALESCE(paid.coins, (SELECT coins FROM stats WHERE user_id = %s)) AS coins,
+           CASE WHEN paid.coins IS NOT NULL THEN added.inventory
+                ELSE (SELECT inventory FROM user_progress WHERE user_id = %s) END AS inventory
+    FROM (SELECT 1) one LEFT JOIN added ON TRUE LEFT JOIN paid ON TRUE
+"""
+
+# Бесплатная смена имени — только первая; платная — всегда, если хватает монет
+SHOP_RENAME_SQL = """
+    WITH renamed AS (
+        UPDATE user_progress SET display_name = %s, has_changed_name = TRUE
+        WHERE user_id = %s AND (%s::int > 0 OR NOT has_changed_name)
+        RETURNING user_id
+    ), paid AS (
+        UPDATE stats SET coins = coins - %s
+        WHERE user_id = %s AND coins >= %s AND EXISTS (SELECT 1 FROM renamed)
+        RETURNING coins
+    )
+    SELECT paid.coins IS NOT NULL AS ok,
+           COALESCE(paid.coins, (SELECT coins FROM stats WHERE user_id = %s)) AS coins,
+           NULL::jsonb AS inventory
+    FROM (SELECT 1) one LEFT JOIN renamed ON TRUE LEFT JOIN paid ON TRUE
+"""
+
+SHOP_THEME_SQL = """
+    WITH themed AS (
+        UPDATE user_progress SET active_theme = %s WHERE user_id = %s RETURNING user_id
+    )
+    SELECT themed.user_id IS NOT NULL AS ok,
+           (SELECT coins FROM stats WHERE user_id = %s) AS coins,
+           NULL::jsonb AS inventory
+    FROM (SELECT 1) one LEFT JOIN themed ON TRUE
+"""
+
+def shop_statement(action, user_id, payload):
+    """(sql, params) для действия /api/user/update; ValueError на некорректный payload."""
+    payload = payload or {}
+    if action in ('buy', 'buy_many'):
+        entries = [payload] if action == 'buy' else payload.get('items')
+        if not isinstance(entries, list) or not 0 < len(entries) <= SHOP_BULK_MAX:
+            raise ValueError("Invalid items")
+        items = {}
+        for entry in entries:
+            item_id, price = entry.get('item_id'), int(entry.get('price', 0))
+            if not item_id or not isinstance(item_id, str) or price < 0:
+                raise ValueError("Invalid item")
+            items.setdefault(item_id, price)
+        item_ids, total = list(items), sum(items.values())
+        return SHOP_BUY_SQL, (item_ids, user_id, item_ids, total, user_id, total, user_id, user_id)
+    if action == 'change_name':
+        new_name, price = payload.get('name'), max(0, int(payload.get('price', 0)))
+        if not new_name or not isinstance(new_name, str) or len(new_name) < 3:
+            raise ValueError("Invalid name")
+        return SHOP_RENAME_SQL, (new_name, user_id, price, price, user_id, price, user_id)
+    if action == 'set_theme':
+        theme = payload.get('theme')
+        if not theme or not isinstance(theme, str):
+            raise ValueError("Invalid theme")
+        return SHOP_THEME_SQL, (theme, user_id, user_id)
+    raise ValueError("Unknown action")
+
+def shop_response(action, row):
+    if row is None:
+        return {"success": False}
+    ok, coins, inventory = row
+    response = {"success": ok, "coins": coins}
+    if action in ('buy', 'buy_many'):
+        response["inventory"] = inventory or []
+    return response
 
-init_db()
 
-# =============== BOT HANDLERS ===================
-bot = telebot.TeleBot(BOT_TOKEN)
+# =============== STATIC ASSETS ===============
+# Файлы до STATIC_FILE_MAX держатся в памяти вместе со сжатыми вариантами (в пределах STATIC_MEMORY_MAX)
+STATIC_FILE_MAX = int(os.getenv("STATIC_FILE_MAX", 1024 * 1024))
+STATIC_MEMORY_MAX = int(os.getenv("STATIC_MEMORY_MAX", 64 * 1024 * 1024))
+# Кэш для файлов без хэша в имени (картинки из public/ и т.п.); index.html всегда перепроверяется
+STATIC_MAX_AGE = int(os.getenv("STATIC_MAX_AGE", 3600))
+STATIC_COMPRESS_MIN = 512
+STATIC_SKIP_DIRS = {"node_modules", "__pycache__", "avatar_cache"}
+# Vite кладёт бандлы в assets/ с хэшем содержимого в имени: assets/index-BdF3x9aQ.js
+HASHED_ASSET_RE = re.compile(r"^assets/[^/]+-[A-Za-z0-9_-]{8,}\.[A-Za-z0-9]+$")
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "application/xml",
+                      "image/svg+xml", "application/wasm", "application/manifest+json")
+ENCODING_SUFFIX = {"br": "br", "gzip": "gz"}
 
-def run_bot():
-    print("Telegram Bot started polling...")
-    try:
-        bot.infinity_polling()
-    except Exception as e:
-        print(f"Bot polling error: {e}")
+def accepted_encodings(header):
+    """Кодировки из Accept-Encoding, кроме явно запрещённых через q=0."""
+    accepted = set()
+    for part in (header or "").split(","):
+        name, _, params = part.partition(";")
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                if float(params[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip().lower())
+    return accepted
 
-@bot.message_handler(commands=['clear'])
-def clear_db_cmd(message):
-    try:
-        conn = get_db_connection()
-        if conn:
-            with conn.cursor() as cursor:
-                cursor.execute("TRUNCATE TABLE game_scores, user_achievements, auth_tokens, sessions, stats, users, user_progress RESTART IDENTITY CASCADE;")
-                conn.commit()
-            conn.close()
-            bot.reply_to(message, "🗑️ База данных полностью очищена.")
-        else:
-            bot.reply_to(message, "Ошибка подключения к БД.")
-    except Exception as e:
-        bot.reply_to(message, f"Ошибка при очистке: {e}")
 
-def handle_games_request(message):
-    tg_id = message.from_user.id
-    chat_id = message.chat.id
-    
-    try:
-        conn = get_db_connection()
-        if not conn:
-            bot.send_message(chat_id, "Ошибка подключения к базе данных.")
-            return
+class StaticIndex:
+    """Индекс файлов SITE_DIR, построенный один раз: ETag, заголовки и (для небольших файлов)
+    тела с gzip/brotli-вариантами. Запросы, включая 304, не обращаются к файловой системе;
+    с диска читается только тело крупных файлов.
+    """
 
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT id FROM users WHERE tg_id=%s", (tg_id,))
-            row = cursor.fetchone()
-            
-            if not row:
-                bot.send_message(chat_id, "Сначала нажми /start", reply_markup=REPLY_KEYBOARD)
-                return
+    def __init__(self, root, file_max, memory_max):
+        self.root = root
+        self.file_max = file_max
+        self.memory_max = memory_max
+        self._files = None
+        self._lock = threading.Lock()
+        self.memory_used = 0
+        self.hits = 0
+        self.not_modified = 0
+        self.disk_reads = 0
 
-            user_id = row[0]
-            token = str(uuid.uuid4())
-            expires_at = (datetime.now(timezone.utc) + timedelta(minutes=10)).isoformat()
-            
-            cursor.execute("INSERT INTO auth_tokens (user_id, token, expires_at) VALUES (%s, %s, %s)", (user_id, token, expires_at))
-            conn.commit()
-            
-            link = f"{SITE_URL}/login.html?token={token}"
-            
-            markup = types.InlineKeyboardMarkup()
-            btn = types.InlineKeyboardButton("Играть 🎮", url=link)
-            markup.add(btn)
-            
-            bot.send_message(chat_id, "Твоя ссылка для входа (действует 10 минут):", reply_markup=markup)
-        conn.close()
-    except Exception as e:
-        print(f"Error in handle_games_request: {e}")
-        bot.send_message(chat_id, "Ошибка сервера.", reply_markup=REPLY_KEYBOARD)
+    def _walk(self):
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.') and d not in STATIC_SKIP_DIRS]
+            for name in filenames:
+                if name.startswith('.') or name.endswith(('.gz', '.br')):
+                    continue
+                full_path = os.path.join(dirpath, name)
+                yield os.path.relpath(full_path, self.root).replace(os.sep, '/'), full_path
 
-@bot.message_handler(commands=['start'])
-def start_cmd(message):
-    tg_id = message.from_user.id
-    username = message.from_user.username or "Player"
-    
-    try:
-        conn = get_db_connection()
-        if not conn: return
+    def _index_file(self, rel, full_path, budget):
+        size = os.path.getsize(full_path)
+        content_type = mimetypes.guess_type(rel)[0] or 'application/octet-stream'
+        if content_type.startswith("text/") or content_type == "application/javascript":
+            content_type += "; charset=utf-8"
 
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT id FROM users WHERE tg_id=%s", (tg_id,))
-            user = cursor.fetchone()
-
-            if not user:
-                cursor.execute("INSERT INTO users (tg_id, username) VALUES (%s, %s) RETURNING id", (tg_id, username))
-                new_user_id = cursor.fetchone()[0]
-                cursor.execute("INSERT INTO stats (user_id, xp, coins, level) VALUES (%s, 0, 1000, 1)", (new_user_id,))
-                cursor.execute("INSERT INTO user_progress (user_id, display_name) VALUES (%s, %s)", (new_user_id, username))
-                conn.commit()
-                bot.send_message(message.chat.id, "Добро пожаловать! Вам начислено 1000 монет 💰", reply_markup=REPLY_KEYBOARD)
+        digest = hashlib.sha256()
+        body = None
+        with open(full_path, 'rb') as f:
+            if size <= self.file_max and size <= budget:
+                body = f.read()
+                digest.update(body)
             else:
-                user_id = user[0]
-                cursor.execute("INSERT INTO stats (user_id, xp, coins, level) VALUES (%s, 0, 1000, 1) ON CONFLICT (user_id) DO NOTHING", (user_id,))
-                cursor.execute("INSERT INTO user_progress (user_id, display_name) VALUES (%s, %s) ON CONFLICT (user_id) DO NOTHING", (user_id, username))
-                conn.commit()
-                bot.send_message(message.chat.id, "С возвращением! Выбери действие:", reply_markup=REPLY_KEYBOARD)
-        conn.close()
-    except Exception as e:
-        print(f"Error in start_cmd: {e}")
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(chunk)
+        file_hash = digest.hexdigest()[:32]
 
-@bot.message_handler(commands=['games'])
-@bot.message_handler(func=lambda message: message.text == "🎮 Играть")
-def games_cmd_or_button(message):
-    handle_games_request(message)
+        bodies = {}
+        if body is not None:
+            bodies["identity"] = body
+            if size >= STATIC_COMPRESS_MIN and content_type.startswith(COMPRESSIBLE_TYPES):
+                # Предсжатые сборкой файлы рядом с оригиналом важнее сжатия на лету
+                variants = {"gzip": lambda: gzip.compress(body, 9, mtime=0)}
+                if brotli:
+                    variants["br"] = lambda: brotli.compress(body, quality=11)
+                for encoding, compress in variants.items():
+                    precompressed = f"{full_path}.{ENCODING_SUFFIX[encoding]}"
+                    if os.path.exists(precompressed):
+                        with open(precompressed, 'rb') as f:
+                            data = f.read()
+                    else:
+                        data = compress()
+                    # Сжатие, почти не уменьшившее файл, не стоит памяти и CPU клиента
+                    if len(data) < size * 0.9:
+                        bodies[encoding] = data
 
-@bot.message_handler(commands=['profile'])
-@bot.message_handler(func=lambda message: message.text == "👤 Профиль")
-def profile_cmd(message):
-    tg_id = message.from_user.id
-    try:
-        conn = get_db_connection()
-        if not conn: return
+        if rel == 'index.html':
+            cache = "no-cache"
+        elif HASHED_ASSET_RE.match(rel):
+            cache = "public, max-age=31536000, immutable"
+        else:
+            cache = f"public, max-age={STATIC_MAX_AGE}"
+        return {"path": full_path, "type": content_type, "hash": file_hash, "cache": cache, "bodies": bodies}
 
-        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("""
-                SELECT u.username, s.coins, s.xp, s.level, p.display_name 
-                FROM users u
-                LEFT JOIN stats s ON u.id = s.user_id
-                LEFT JOIN user_progress p ON u.id = p.user_id
-                WHERE u.tg_id = %s
-            """, (tg_id,))
-            user_data = cursor.fetchone()
-            
-            if user_data:
-                name = user_data.get('display_name') or user_data.get('username') or "Игрок"
-                text = (
-                    f"👤 *Твой Профиль*\n\n"
-                    f"🆔 *Имя*: {name}\n"
-                    f"📊 *Уровень*: {user_data.get('level', 1)}\n"
-                    f"⭐ *Опыт (XP)*: {user_data.get('xp', 0)}\n"
-                    f"💰 *Монеты*: {user_data.get('coins', 1000)}"
-                )
-                bot.send_message(message.chat.id, text, parse_mode='Markdown', reply_markup=REPLY_KEYBOARD)
-            else:
-                bot.send_message(message.chat.id, "Профиль не найден. Нажми /start", reply_markup=REPLY_KEYBOARD)
-        conn.close()
-    except Exception as e:
-        print(f"Error in profile_cmd: {e}")
+    def build(self):
+        files = {}
+        memory = 0
+        for rel, full_path in sorted(self._walk()):
+            try:
+                entry = self._index_file(rel, full_path, self.memory_max - memory)
+            except OSError as e:
+                print(f"Static index error ({rel}): {e}")
+                continue
+            memory += sum(len(body) for body in entry["bodies"].values())
+            files[rel] = entry
+        self._files, self.memory_used = files, memory
+        print(f"Static index: {len(files)} files, {memory // 1024} KiB in memory.")
 
-@bot.message_handler(func=lambda message: message.text == "🏅 Достижения")
-def achievements_cmd(message):
-    tg_id = message.from_user.id
-    try:
-        conn = get_db_connection()
-        if not conn: return
+    def files(self):
+        if self._files is None:
+            with self._lock:
+                if self._files is None:
+                    self.build()
+        return self._files
 
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT id FROM users WHERE tg_id=%s", (tg_id,))
-            row = cursor.fetchone()
-            if not row: return
-            user_id = row[0]
-            
-            cursor.execute("SELECT achievement_id FROM user_achievements WHERE user_id=%s", (user_id,))
-            unlocked_ids = {r[0] for r in cursor.fetchall()}
-            
-            response_text = "🏅 *Ваши достижения:*\n\n"
-            for rule in ACHIEVEMENTS_RULES:
-                status = "✅" if rule['id'] in unlocked_ids else "🔒"
-                response_text += f"{status} *{rule['name']}*\n_{rule['desc']}_\n\n"
-            
-            bot.send_message(message.chat.id, response_text, parse_mode='Markdown', reply_markup=REPLY_KEYBOARD)
-        conn.close()
-    except Exception: pass
+    def respond(self, path, accept_encoding, if_none_match):
+        """(status, headers, body, file_path) для пути; неизвестные пути отдают index.html (SPA)."""
+        files = self.files()
+        entry = files.get(path.strip('/')) or files.get('index.html')
+        if entry is None:
+            return None
 
-@bot.message_handler(commands=['stats'])
-@bot.message_handler(func=lambda message: message.text == "🏆 Моя Статистика")
-def stats_cmd(message):
-    send_stats_page(message.chat.id, message.from_user.id, 0, message.message_id)
+        encoding = "identity"
+        accepted = accepted_encodings(accept_encoding)
+        for candidate in ("br", "gzip"):
+            if candidate in entry["bodies"] and (candidate in accepted or "*" in accepted):
+                encoding = candidate
+                break
+        etag = f'"{entry["hash"]}"' if encoding == "identity" else f'"{entry["hash"]}-{ENCODING_SUFFIX[encoding]}"'
+        headers = {"ETag": etag, "Cache-Control": entry["cache"], "Content-Type": entry["type"]}
+        if len(entry["bodies"]) > 1:
+            headers["Vary"] = "Accept-Encoding"
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
 
-def send_stats_page(chat_id, tg_id, page, message_id=None, is_edit=False):
-    try:
-        conn = get_db_connection()
-        if not conn: return
-        
-        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("SELECT id FROM users WHERE tg_id=%s", (tg_id,))
-            user_row = cursor.fetchone()
-            if not user_row: 
-                conn.close()
-                return
-            user_id = user_row['id']
-            
-            cursor.execute("""
-                WITH RankedScores AS (
-                    SELECT game_id, score, created_at,
-                        ROW_NUMBER() OVER (PARTITION BY game_id ORDER BY score DESC, created_at DESC) as rn
-                    FROM game_scores WHERE user_id=%s
-                )
-                SELECT game_id, score, created_at FROM RankedScores WHERE rn = 1 ORDER BY score DESC, game_id
-            """, (user_id,))
-            best_scores = cursor.fetchall()
-            
-            if not best_scores:
-                bot.send_message(chat_id, "Статистики пока нет. Сыграйте в игру!", reply_markup=REPLY_KEYBOARD)
-                conn.close()
-                return
-            
-            num_games = len(best_scores)
-            page = page % num_games
-            current = best_scores[page]
-            game_name = GAME_NAMES.get(current['game_id'], f"Игра #{current['game_id']}")
-            
-            created_at = current.get('created_at')
-            date_str = str(created_at) if created_at else "Н/Д"
+        self.hits += 1
+        # Любой вариант одного файла считаем совпадением: содержимое одно и то же
+        if if_none_match and (if_none_match.strip() == "*" or f'"{entry["hash"]}' in if_none_match):
+            self.not_modified += 1
+            return 304, headers, b"", None
+        body = entry["bodies"].get(encoding)
+        if body is None:
+            self.disk_reads += 1
+            return 200, headers, None, entry["path"]
+        return 200, headers, body, None
 
-            text = f"🏆 *Рекорды* ({page+1}/{num_games}):\n\n🕹️ *{game_name}*\n📈 *Счет*: {current['score']}\n"
-            
-            markup = types.InlineKeyboardMarkup(row_width=3)
-            buttons = [
-                types.InlineKeyboardButton("⬅️", callback_data=f"stats_{(page-1)%num_games}_{tg_id}"),
-                types.InlineKeyboardButton(f"{page+1}/{num_games}", callback_data="stats_info"),
-                types.InlineKeyboardButton("➡️", callback_data=f"stats_{(page+1)%num_games}_{tg_id}")
-            ]
-            markup.add(*buttons)
-
-            if is_edit and message_id:
-                bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, reply_markup=markup, parse_mode='Markdown')
-            else:
-                bot.send_message(chat_id, text, reply_markup=markup, parse_mode='Markdown')
-        conn.close()
-    except Exception as e:
-        print(f"Error stats: {e}")
+    def stats(self):
+        files = self._files or {}
+        return {
+            "files": len(files),
+            "in_memory": sum(1 for entry in files.values() if entry["bodies"]),
+            "compressed": sum(1 for entry in files.values() if len(entry["bodies"]) > 1),
+            "memory_kib": self.memory_used // 1024,
+            "brotli": brotli is not None,
+            "hits": self.hits,
+            "not_modified": self.not_modified,
+            "disk_reads": self.disk_reads,
+        }
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('stats_'))
-def stats_callback(call):
-    if call.data == "stats_info":
-        bot.answer_callback_query(call.id)
-        return
-    try:
-        parts = call.data.split('_')
-        page = int(parts[1])
-        owner_id = int(parts[2])
-        if call.from_user.id != owner_id:
-             bot.answer_callback_query(call.id, "Это чужая статистика")
-             return
-        send_stats_page(call.message.chat.id, call.from_user.id, page, call.message.message_id, is_edit=True)
-        bot.answer_callback_query(call.id)
-    except: pass
 
-@bot.message_handler(func=lambda message: message.text == "❓ Помощь")
-def help_cmd(message):
-    text = "🤖 *Помощь:*\nИграй в мини-игры, копи монеты и открывай достижения!\nНажми '🎮 Играть' чтобы начать."
-    bot.send_message(message.chat.id, text, parse_mode='Markdown', reply_markup=REPLY_KEYBOARD)
+STATIC_ASSETS = StaticIndex(SITE_DIR, STATIC_FILE_MAX, STATIC_MEMORY_MAX)
 
 
 # =============== FLASK APP ===============
-app = Flask(__name__, static_folder=SITE_DIR, static_url_path='')
+app = Flask(__name__, static_folder=None)
 CORS(app)
 
+# Необязательный токен: /metrics отвечает только на "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+if METRICS_ENABLED:
+    @app.before_request
+    def metrics_start():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def metrics_observe(response):
+        started = g.pop("request_started", None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            HTTP_LATENCY.observe((route, request.method), time.perf_counter() - started)
+            HTTP_REQUESTS.inc((route, request.method, str(response.status_code)))
+        return response
+
+def metrics_allowed(authorization):
+    return not METRICS_TOKEN or hmac.compare_digest(authorization or "", f"Bearer {METRICS_TOKEN}")
+
+@app.get("/metrics")
+def metrics_api():
+    if not METRICS_ENABLED:
+        return "Not Found", 404
+    if not metrics_allowed(request.headers.get("Authorization")):
+        return "Forbidden", 403
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+def static_response(path):
+    result = STATIC_ASSETS.respond(path, request.headers.get("Accept-Encoding"), request.headers.get("If-None-Match"))
+    if result is None:
+        return "Not Found", 404
+    status, headers, body, file_path = result
+    if file_path:
+        response = send_file(file_path, mimetype=headers["Content-Type"], conditional=False, etag=False)
+        response.headers.update(headers)
+        return response
+    return Response(body, status=status, headers=headers)
+
 @app.route('/')
 def index(): 
-    return send_from_directory(SITE_DIR, 'index.html')
+    return static_response('index.html')
 
 @app.route('/<path:path>')
 def serve_static(path):
-    if os.path.exists(os.path.join(SITE_DIR, path)): 
-        return send_from_directory(SITE_DIR, path)
-    return send_from_directory(SITE_DIR, 'index.html')
+    return static_response(path)
 
 @app.post("/api/auth/verify")
 def verify():
@@ -405,108 +3774,239 @@ def verify():
     if not token: return jsonify({"success": False})
 
     try:
-        conn = get_db_connection()
-        if not conn: return jsonify({"success": False, "error": "DB Error"})
+        with db_connection() as conn:
+            if not conn: return jsonify({"success": False, "error": "DB Error"})
 
-        with conn.cursor() as cursor:
-            cursor.execute("""
-                SELECT users.id, users.username, auth_tokens.expires_at
-                FROM auth_tokens JOIN users ON users.id = auth_tokens.user_id WHERE auth_tokens.token=%s
-            """, (token,))
-            row = cursor.fetchone()
-            if not row:
-                conn.close()
-                return jsonify({"success": False, "error": "Invalid token"})
-
-            user_id, username, expires_at = row
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT users.id, users.username, auth_tokens.expires_at
+                    FROM auth_tokens JOIN users ON users.id = auth_tokens.user_id WHERE auth_tokens.token=%s
+                """, (token,))
+                row = cursor.fetchone()
+                if not row:
+                    return jsonify({"success": False, "error": "Invalid token"})
+
+                user_id, username, expires_at = row
             
-            if isinstance(expires_at, str):
-                expires_at = datetime.fromisoformat(expires_at)
-            if expires_at.tzinfo is None:
-                expires_at = expires_at.replace(tzinfo=timezone.utc)
+                if isinstance(expires_at, str):
+                    expires_at = datetime.fromisoformat(expires_at)
+                if expires_at.tzinfo is None:
+                    expires_at = expires_at.replace(tzinfo=timezone.utc)
             
-            if datetime.now(timezone.utc) > expires_at:
-                conn.close()
-                return jsonify({"success": False, "error": "Expired"})
+                if datetime.now(timezone.utc) > expires_at:
+                    return jsonify({"success": False, "error": "Expired"})
 
-            session_id = str(uuid.uuid4())
-            cursor.execute("INSERT INTO sessions (user_id, session_id) VALUES (%s, %s)", (user_id, session_id))
-            cursor.execute("DELETE FROM auth_tokens WHERE token=%s", (token,))
-            conn.commit()
-        conn.close()
-        return jsonify({"success": True, "username": username, "session": session_id})
+                session_id = str(uuid.uuid4())
+                cursor.execute("INSERT INTO sessions (user_id, session_id, expires_at) VALUES (%s, %s, NOW() + make_interval(secs => %s))",
+                               (user_id, session_id, SESSION_TTL))
+                cursor.execute("DELETE FROM auth_tokens WHERE token=%s", (token,))
+                conn.commit()
+            SESSION_CACHE.invalidate(session_id)
+            return jsonify({"success": True, "username": username, "session": session_id})
     except Exception as e:
         print(f"Auth verify error: {e}")
         return jsonify({"success": False})
 
+@app.post("/api/auth/logout")
+def logout():
+    data = request.get_json()
+    session_id = data.get("session")
+    if not session_id: return jsonify({"success": False})
+
+    try:
+        with db_connection() as conn:
+            if not conn: return jsonify({"success": False, "error": "DB Error"})
+
+            with conn.cursor() as cursor:
+                if data.get("all"):
+                    identity = resolve_session(cursor, session_id)
+                    if not identity:
+                        return jsonify({"success": False, "error": "User not found"})
+                    revoked = revoke_user_sessions(cursor, identity['user_id'])
+                else:
+                    cursor.execute("DELETE FROM sessions WHERE session_id=%s", (session_id,))
+                    revoked = cursor.rowcount
+                    SESSION_CACHE.invalidate(session_id)
+                    publish_invalidation(cursor, "sessions", [session_id])
+                conn.commit()
+            return jsonify({"success": True, "revoked": revoked})
+    except Exception as e:
+        print(f"Logout error: {e}")
+        return jsonify({"success": False})
+
+def user_response(user_data, achievements, avatar_url):
+    """Тело ответа /api/user; общее для Flask и асинхронного режима."""
+    return {
+        "success": True,
+        "user_id": user_data['user_id'],
+        "username": user_data.get('display_name') or user_data['username'],
+        "tg_id": user_data['tg_id'],
+        "coins": user_data['coins'],
+        "xp": user_data['xp'],
+        "level": user_data['level'],
+        "achievements": achievements,
+        "avatar_url": avatar_url,
+        "inventory": user_data.get('inventory') or [],
+        "active_theme": user_data.get('active_theme') or 'default',
+        "has_changed_name": user_data.get('has_changed_name') or False
+    }
+
+# Всё для старта приложения одним выражением; единственный параметр — users.id
+BOOTSTRAP_SQL = """
+    SELECT u.id AS user_id, u.username, u.tg_id,
+           s.coins, s.xp, s.level,
+           p.inventory, p.active_theme, p.has_changed_name, p.display_name,
+           (SELECT COALESCE(json_agg(a.achievement_id ORDER BY a.unlocked_at, a.achievement_id), '[]')
+            FROM user_achievements a WHERE a.user_id = u.id) AS achievements,
+           (SELECT COALESCE(json_object_agg(b.game_id, b.score), '{}')
+            FROM user_best_scores b WHERE b.user_id = u.id) AS personal_bests,
+           (SELECT COALESCE(json_agg(json_build_object(
+                        'id', r.id, 'game_id', r.game_id, 'kind', r.kind, 'name', r.name, 'desc', r.description,
+                        'threshold', r.threshold,
+                        'value', COALESCE(CASE r.kind
+                            WHEN 'score' THEN c.best_score
+                            WHEN 'total' THEN c.total_score
+                            WHEN 'plays' THEN c.plays
+                            WHEN 'streak' THEN c.streak
+                        END, 0),
+                        'unlocked', a.user_id IS NOT NULL
+                    ) ORDER BY r.game_id, r.threshold, r.id), '[]')
+            FROM achievement_rules r
+            LEFT JOIN user_game_counters c ON c.user_id = u.id AND c.game_id = r.game_id
+            LEFT JOIN user_achievements a ON a.user_id = u.id AND a.achievement_id = r.id
+            WHERE r.enabled) AS achievement_progress
+    FROM users u
+    LEFT JOIN stats s ON s.user_id = u.id
+    LEFT JOIN user_progress p ON p.user_id = u.id
+    WHERE u.id = %s
+"""
+
+def bootstrap_response(row, avatar_url):
+    """Тело /api/bootstrap и его ETag (хэш содержимого)."""
+    payload = user_response(row, row['achievements'], avatar_url)
+    payload.update({
+        "personal_bests": row['personal_bests'],
+        "achievement_progress": row['achievement_progress'],
+    })
+    etag = hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+    return payload, f'"{etag}"'
+
+@app.get("/api/bootstrap")
+def bootstrap_api():
+    session_id = request.args.get("session")
+    if not session_id: return jsonify({"success": False})
+
+    try:
+        with db_connection() as conn:
+            if not conn: return jsonify({"success": False, "error": "DB Error"}), 500
+
+            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                identity = resolve_session(cursor, session_id)
+                if not identity:
+                    return jsonify({"success": False, "error": "User not found"})
+                cursor.execute(BOOTSTRAP_SQL, (identity['user_id'],))
+                row = cursor.fetchone()
+                if not row:
+                    return jsonify({"success": False, "error": "User not found"})
+                if row['coins'] is None:
+                    cursor.execute("INSERT INTO stats (user_id, xp, coins, level) VALUES (%s, 0, 1000, 1) ON CONFLICT (user_id) DO NOTHING", (row['user_id'],))
+                    cursor.execute("INSERT INTO user_progress (user_id) VALUES (%s) ON CONFLICT (user_id) DO NOTHING", (row['user_id'],))
+                    conn.commit()
+                    row.update({"coins": 1000, "xp": 0, "level": 1})
+
+        avatar_url = AVATARS.avatar_url(row['tg_id']) if row['tg_id'] else None
+        payload, etag = bootstrap_response(row, avatar_url)
+        response = jsonify(payload)
+        response.headers["ETag"] = etag
+        # Браузер хранит ответ, но каждый раз перепроверяет его по ETag
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response.make_conditional(request)
+    except Exception as e:
+        print(f"Bootstrap API Error: {e}")
+        return jsonify({"success": False}), 500
+
 @app.get("/api/user")
 def get_user_info():
     session_id = request.args.get("session")
     if not session_id: return jsonify({"success": False})
 
     try:
-        conn = get_db_connection()
-        if not conn: return jsonify({"success": False})
+        with db_connection() as conn:
+            if not conn: return jsonify({"success": False})
 
-        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("""
-                SELECT u.id as user_id, u.username, u.tg_id, 
-                       s.coins, s.xp, s.level,
-                       p.inventory, p.active_theme, p.has_changed_name, p.display_name
-                FROM sessions ses
-                JOIN users u ON u.id = ses.user_id
-                LEFT JOIN stats s ON s.user_id = u.id
-                LEFT JOIN user_progress p ON p.user_id = u.id
-                WHERE ses.session_id=%s
-            """, (session_id,))
-            user_data = cursor.fetchone()
-
-            if user_data:
-                avatar_url = None
-                tg_id = user_data.get('tg_id')
-                if tg_id:
-                    try:
-                        photos = bot.get_user_profile_photos(tg_id, limit=1)
-                        if photos.total_count > 0:
-                            file_id = photos.photos[0][0].file_id 
-                            file_info = bot.get_file(file_id)
-                            avatar_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_info.file_path}"
-                    except: pass
-
-                cursor.execute("SELECT achievement_id FROM user_achievements WHERE user_id=%s", (user_data['user_id'],))
-                achievements = [row['achievement_id'] for row in cursor.fetchall()]
+            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                # Если сессия уже в кэше, обходимся без JOIN по sessions
+                identity = SESSION_CACHE.get(session_id)
+                if identity and identity['expires_at'] > time.time():
+                    cursor.execute("""
+                        SELECT u.id as user_id, u.username, u.tg_id, 
+                               s.coins, s.xp, s.level,
+                               p.inventory, p.active_theme, p.has_changed_name, p.display_name
+                        FROM users u
+                        LEFT JOIN stats s ON s.user_id = u.id
+                        LEFT JOIN user_progress p ON p.user_id = u.id
+                        WHERE u.id=%s
+                    """, (identity['user_id'],))
+                else:
+                    identity = None
+                    # Проверка и продление сессии в том же запросе
+                    cursor.execute("""
+                        WITH ses AS (
+                            UPDATE sessions SET expires_at = NOW() + make_interval(secs => %s)
+                            WHERE session_id=%s AND expires_at > NOW()
+                            RETURNING user_id
+                        )
+                        SELECT u.id as user_id, u.username, u.tg_id, 
+                               s.coins, s.xp, s.level,
+                               p.inventory, p.active_theme, p.has_changed_name, p.display_name
+                        FROM ses
+                        JOIN users u ON u.id = ses.user_id
+                        LEFT JOIN stats s ON s.user_id = u.id
+                        LEFT JOIN user_progress p ON p.user_id = u.id
+                    """, (SESSION_TTL, session_id))
+                user_data = cursor.fetchone()
+                conn.commit()
+
+                if user_data:
+                    if not identity:
+                        SESSION_CACHE.set(session_id, {"user_id": user_data['user_id'], "tg_id": user_data['tg_id'],
+                                                       "expires_at": time.time() + SESSION_TTL})
+                    avatar_url = None
+                    tg_id = user_data.get('tg_id')
+                    if tg_id:
+                        avatar_url = AVATARS.avatar_url(tg_id)
+
+                    cursor.execute("SELECT achievement_id FROM user_achievements WHERE user_id=%s", (user_data['user_id'],))
+                    achievements = [row['achievement_id'] for row in cursor.fetchall()]
                 
-                if user_data.get('coins') is None:
-                    cursor.execute("INSERT INTO stats (user_id, xp, coins, level) VALUES (%s, 0, 1000, 1) ON CONFLICT (user_id) DO NOTHING", (user_data['user_id'],))
-                    cursor.execute("INSERT INTO user_progress (user_id) VALUES (%s) ON CONFLICT (user_id) DO NOTHING", (user_data['user_id'],))
-                    conn.commit()
-                    user_data['coins'] = 1000
-                    user_data['xp'] = 0
-                    user_data['level'] = 1
+                    if user_data.get('coins') is None:
+                        cursor.execute("INSERT INTO stats (user_id, xp, coins, level) VALUES (%s, 0, 1000, 1) ON CONFLICT (user_id) DO NOTHING", (user_data['user_id'],))
+                        cursor.execute("INSERT INTO user_progress (user_id) VALUES (%s) ON CONFLICT (user_id) DO NOTHING", (user_data['user_id'],))
+                        conn.commit()
+                        user_data['coins'] = 1000
+                        user_data['xp'] = 0
+                        user_data['level'] = 1
                 
-                response = {
-                    "success": True,
-                    "user_id": user_data['user_id'],
-                    "username": user_data.get('display_name') or user_data['username'],
-                    "tg_id": user_data['tg_id'],
-                    "coins": user_data['coins'],
-                    "xp": user_data['xp'],
-                    "level": user_data['level'],
-                    "achievements": achievements,
-                    "avatar_url": avatar_url,
-                    "inventory": json.loads(user_data['inventory']) if user_data.get('inventory') else [],
-                    "active_theme": user_data.get('active_theme') or 'default',
-                    "has_changed_name": user_data.get('has_changed_name') or False
-                }
-                return jsonify(response)
+                    return jsonify(user_response(user_data, achievements, avatar_url))
 
-        conn.close()
-        return jsonify({"success": False})
+            return jsonify({"success": False})
     except Exception as e:
         print(f"User API Error: {e}")
         return jsonify({"success": False})
 
+@app.post("/api/game/start")
+def start_game_api():
+    data = request.get_json(silent=True) or {}
+    session_id, game_id = data.get("session"), data.get("game_id")
+    if not session_id or not game_id:
+        return jsonify({"success": False}), 400
+    token = issue_play_token(session_id, str(game_id))
+    if not token:
+        return jsonify({"success": False, "error": "Play tokens disabled"}), 503
+    return jsonify({"success": True, "play_token": token})
+
 @app.post("/api/game/score")
+@admission_controlled
 def save_score_api():
     data = request.get_json()
     session_id = data.get("session")
@@ -519,79 +4019,251 @@ def save_score_api():
     new_unlocked = [] 
     score_val = int(score)
 
+    if SCORE_BUFFER:
+        earned_coins, earned_xp = score_rewards(score_val)
+        now_str = datetime.now(timezone.utc).isoformat()
+        try:
+            result = record_scores_buffered(session_id, [(str(game_id), score_val, now_str)], earned_coins, earned_xp)
+        except Exception as e:
+            print(f"Save Score Error: {e}")
+            return jsonify({"success": False}), 500
+        if not result:
+            return jsonify({"success": False, "error": "User not found"})
+        new_level, new_xp, new_unlocked = result
+        return jsonify({
+            "success": True, 
+            "new_achievements": new_unlocked, 
+            "earned_coins": earned_coins, 
+            "earned_xp": earned_xp,
+            "new_level": new_level,
+            "current_xp": new_xp
+        })
+
     try:
-        conn = get_db_connection()
-        if not conn: return jsonify({"success": False, "error": "DB Error"}), 500
+        with db_connection() as conn:
+            if not conn: return jsonify({"success": False, "error": "DB Error"}), 500
 
-        with conn.cursor() as cursor:
-            cursor.execute("""
-                SELECT u.id, u.tg_id, s.xp, s.level 
-                FROM sessions ses 
-                JOIN users u ON u.id = ses.user_id 
-                LEFT JOIN stats s ON s.user_id = u.id
-                WHERE ses.session_id=%s
-            """, (session_id,))
-            user_row = cursor.fetchone()
-            
-            if user_row:
-                user_id, tg_id = user_row[0], user_row[1]
-                current_xp = user_row[2] or 0
-                current_level = user_row[3] or 1
+            with conn.cursor() as cursor:
+                identity = resolve_session(cursor, session_id)
+                if not identity:
+                    return jsonify({"success": False, "error": "User not found"})
+
+                user_id, tg_id = identity['user_id'], identity['tg_id']
                 
                 now_str = datetime.now(timezone.utc).isoformat()
                 cursor.execute("INSERT INTO game_scores (user_id, game_id, score, created_at) VALUES (%s, %s, %s, %s)", 
                               (user_id, game_id, score_val, now_str))
+                upsert_best_scores(cursor, [(user_id, game_id, score_val, now_str)])
                 
-                earned_coins = max(1, int(score_val * 0.1))
-                earned_xp = max(1, int(score_val * 0.5))
-                
-                # --- ЛОГИКА ПОВЫШЕНИЯ УРОВНЯ ---
-                new_xp = current_xp + earned_xp
-                new_level = current_level
-                xp_needed = new_level * 1000
-                
-                # Пока XP хватает на следующий уровень, повышаем уровень и вычитаем XP
-                while new_xp >= xp_needed:
-                    new_xp -= xp_needed
-                    new_level += 1
-                    xp_needed = new_level * 1000
-                
-                cursor.execute("""
-                    UPDATE stats 
-                    SET coins = coins + %s, xp = %s, level = %s 
-                    WHERE user_id = %s
-                """, (earned_coins, new_xp, new_level, user_id))
+                earned_coins, earned_xp = score_rewards(score_val)
+                new_level, new_xp = add_progress(cursor, user_id, earned_coins, earned_xp)
                 
                 # Достижения
-                cursor.execute("SELECT achievement_id FROM user_achievements WHERE user_id=%s", (user_id,))
-                existing_ids = {row[0] for row in cursor.fetchall()}
-                
-                for rule in ACHIEVEMENTS_RULES:
-                    if rule["game_id"] == str(game_id) and score_val >= rule["score"] and rule["id"] not in existing_ids:
-                        date_str = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
-                        cursor.execute("INSERT INTO user_achievements (user_id, achievement_id, unlocked_at) VALUES (%s, %s, %s)", 
-                                      (user_id, rule["id"], date_str))
-                        existing_ids.add(rule["id"])
-                        new_unlocked.append(rule)
-                        if tg_id:
-                            try:
-                                msg = f"🎉 <b>Новое достижение!</b>\n\n🏆 <b>{rule['name']}</b>\n📝 {rule['desc']}"
-                                bot.send_message(tg_id, msg, parse_mode="HTML")
-                            except: pass
+                new_unlocked = grant_achievements(cursor, user_id, tg_id, aggregate_plays([(game_id, score_val, now_str)]))
+                publish_user_event(cursor, user_id, progress_event(earned_coins, new_level, new_xp, new_unlocked), session_id)
+                publish_scores(cursor, user_id, [(game_id, score_val, now_str)])
 
                 conn.commit()
-        conn.close()
+            LEADERBOARDS.submit(user_id, [(game_id, score_val, now_str)])
+            if new_unlocked:
+                OUTBOX.wake()
+            return jsonify({
+                "success": True, 
+                "new_achievements": new_unlocked, 
+                "earned_coins": earned_coins, 
+                "earned_xp": earned_xp,
+                "new_level": new_level,
+                "current_xp": new_xp
+            })
+    except Exception as e:
+        print(f"Save Score Error: {e}")
+        return jsonify({"success": False}), 500
+
+@app.post("/api/game/scores/batch")
+@admission_controlled
+def save_scores_batch_api():
+    data = request.get_json()
+    session_id = data.get("session")
+    entries = data.get("scores")
+
+    if not session_id or not isinstance(entries, list) or not entries:
+        return jsonify({"success": False}), 400
+    if len(entries) > SCORE_BATCH_MAX:
+        return jsonify({"success": False, "error": f"Too many scores (max {SCORE_BATCH_MAX})"}), 400
+    entries, rejected = split_plausible(entries, session_id)
+    if not entries:
+        return jsonify({"success": False, "error": "Implausible score", "rejected": rejected}), 400
+
+    try:
+        rows, earned_coins, earned_xp = parse_score_entries(entries, datetime.now(timezone.utc))
+    except ValueError:
+        return jsonify({"success": False, "error": "Invalid score entry"}), 400
+
+    if SCORE_BUFFER:
+        try:
+            result = record_scores_buffered(session_id, rows, earned_coins, earned_xp)
+        except Exception as e:
+            print(f"Save Scores Batch Error: {e}")
+            return jsonify({"success": False}), 500
+        if not result:
+            return jsonify({"success": False, "error": "User not found"})
+        new_level, new_xp, new_unlocked = result
         return jsonify({
-            "success": True, 
-            "new_achievements": new_unlocked, 
-            "earned_coins": earned_coins, 
+            "success": True,
+            "accepted": len(rows),
+            "rejected": rejected,
+            "new_achievements": new_unlocked,
+            "earned_coins": earned_coins,
             "earned_xp": earned_xp,
             "new_level": new_level,
             "current_xp": new_xp
         })
+
+    try:
+        with db_connection() as conn:
+            if not conn: return jsonify({"success": False, "error": "DB Error"}), 500
+
+            with conn.cursor() as cursor:
+                identity = resolve_session(cursor, session_id)
+                if not identity:
+                    return jsonify({"success": False, "error": "User not found"})
+
+                user_id, tg_id = identity['user_id'], identity['tg_id']
+
+                # Вся пачка — одним многострочным INSERT
+                execute_values(cursor,
+                               "INSERT INTO game_scores (user_id, game_id, score, created_at) VALUES %s",
+                               [(user_id, game_id, score_val, played_at) for game_id, score_val, played_at in rows],
+                               page_size=len(rows))
+                upsert_best_scores(cursor, [(user_id, game_id, score_val, played_at) for game_id, score_val, played_at in rows])
+                new_level, new_xp = add_progress(cursor, user_id, earned_coins, earned_xp)
+                new_unlocked = grant_achievements(cursor, user_id, tg_id, aggregate_plays(rows))
+                publish_user_event(cursor, user_id, progress_event(earned_coins, new_level, new_xp, new_unlocked), session_id)
+                publish_scores(cursor, user_id, rows)
+
+                conn.commit()
+            LEADERBOARDS.submit(user_id, rows)
+            if new_unlocked:
+                OUTBOX.wake()
+            return jsonify({
+                "success": True,
+                "accepted": len(rows),
+                "rejected": rejected,
+                "new_achievements": new_unlocked,
+                "earned_coins": earned_coins,
+                "earned_xp": earned_xp,
+                "new_level": new_level,
+                "current_xp": new_xp
+            })
+    except Exception as e:
+        print(f"Save Scores Batch Error: {e}")
+        return jsonify({"success": False}), 500
+
+@app.get("/api/leaderboard/<game_id>")
+def leaderboard_api(game_id):
+    if game_id not in GAME_NAMES:
+        return jsonify({"success": False, "error": "Unknown game"}), 404
+    try:
+        page = max(0, int(request.args.get("page", 0)))
+        size = min(max(1, int(request.args.get("size", 20))), LEADERBOARD_PAGE_MAX)
+    except ValueError:
+        return jsonify({"success": False, "error": "Invalid page"}), 400
+
+    try:
+        board = LEADERBOARDS.board(game_id)
+        if board is None:
+            return jsonify({"success": False, "error": "DB Error"}), 500
+
+        entries = board.page(page * size, size)
+        me = None
+        session_id = request.args.get("session")
+        if session_id:
+            with db_connection() as conn:
+                if conn:
+                    with conn.cursor() as cursor:
+                        identity = resolve_session(cursor, session_id)
+                    if identity:
+                        my_rank = board.rank(identity['user_id'])
+                        if my_rank:
+                            me = {"rank": my_rank[0], "score": my_rank[1]}
+
+        names = leaderboard_names({user_id for _, user_id, _ in entries})
+        return jsonify({
+            "success": True,
+            "game_id": game_id,
+            "game_name": GAME_NAMES[game_id],
+            "total": len(board),
+            "page": page,
+            "size": size,
+            "entries": [{"rank": rank, "user_id": user_id, "name": names.get(user_id) or "Игрок", "score": score_val}
+                        for rank, user_id, score_val in entries],
+            "me": me
+        })
     except Exception as e:
-        print(f"Save Score Error: {e}")
+        print(f"Leaderboard API Error: {e}")
+        return jsonify({"success": False}), 500
+
+@app.get("/api/avatar/<int:tg_id>")
+def avatar_api(tg_id):
+    cached = AVATARS.load(tg_id)
+    if not cached:
+        return jsonify({"success": False, "error": "Not found"}), 404
+    data, etag = cached
+    response = Response(data, mimetype='image/jpeg')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = int(AVATAR_TTL)
+    return response.make_conditional(request)
+
+@app.get("/api/events")
+def events_api():
+    session_id = request.args.get("session")
+    if not session_id: return jsonify({"success": False}), 400
+
+    try:
+        with db_connection() as conn:
+            if not conn: return jsonify({"success": False, "error": "DB Error"}), 503
+            with conn.cursor() as cursor:
+                identity = resolve_session(cursor, session_id)
+            conn.commit()
+    except Exception as e:
+        print(f"Events API Error: {e}")
         return jsonify({"success": False}), 500
+    if not identity:
+        return jsonify({"success": False, "error": "User not found"}), 401
+
+    events = queue.Queue(EVENT_QUEUE_MAX)
+    overflow = threading.Event()
+
+    def push(event):
+        try:
+            events.put_nowait(event)
+        except queue.Full:
+            # Клиент не успевает читать: закрываем поток, после переподключения он перечитает профиль
+            overflow.set()
+
+    subscription = EVENTS.subscribe(identity['user_id'], session_id, push)
+    if subscription is None:
+        return jsonify({"success": False, "error": "Too many streams"}), 503, {"Retry-After": "30"}
+
+    def stream():
+        try:
+            yield sse_message("hello", {"origin": event_origin(session_id)}, retry=EVENT_RETRY_MS)
+            deadline = time.monotonic() + EVENT_STREAM_MAX_AGE
+            while time.monotonic() < deadline and not overflow.is_set():
+                try:
+                    event = events.get(timeout=EVENT_HEARTBEAT)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                if event is None:
+                    break
+                yield sse_message(event["type"], event)
+        finally:
+            EVENTS.unsubscribe(subscription)
+
+    return Response(stream(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.post("/api/user/update")
 def update_user_api():
@@ -603,72 +4275,142 @@ def update_user_api():
     if not session_id or not action: return jsonify({"success": False})
 
     try:
-        conn = get_db_connection()
-        if not conn: return jsonify({"success": False})
-
-        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("""
-                SELECT u.id, s.coins, p.inventory, p.has_changed_name
-                FROM sessions ses
-                JOIN users u ON u.id = ses.user_id
-                JOIN stats s ON s.user_id = u.id
-                JOIN user_progress p ON p.user_id = u.id
-                WHERE ses.session_id=%s
-            """, (session_id,))
-            user = cursor.fetchone()
-            
-            if not user:
-                conn.close()
-                return jsonify({"success": False, "error": "User not found"})
-            
-            user_id = user['id']
-            current_coins = user['coins']
-            inventory = json.loads(user['inventory']) if user['inventory'] else []
+        with db_connection() as conn:
+            if not conn: return jsonify({"success": False})
 
-            success = False
-            new_coins = current_coins
-
-            if action == 'buy':
-                item_id = payload.get('item_id')
-                price = int(payload.get('price', 0))
-                
-                if item_id and item_id not in inventory and current_coins >= price:
-                    new_coins = current_coins - price
-                    inventory.append(item_id)
-                    cursor.execute("UPDATE stats SET coins=%s WHERE user_id=%s", (new_coins, user_id))
-                    cursor.execute("UPDATE user_progress SET inventory=%s WHERE user_id=%s", (json.dumps(inventory), user_id))
-                    success = True
-
-            elif action == 'set_theme':
-                theme = payload.get('theme')
-                if theme:
-                    cursor.execute("UPDATE user_progress SET active_theme=%s WHERE user_id=%s", (theme, user_id))
-                    success = True
-
-            elif action == 'change_name':
-                new_name = payload.get('name')
-                price = int(payload.get('price', 0))
-                
-                if new_name and len(new_name) >= 3:
-                    if price > 0:
-                        if current_coins >= price:
-                            new_coins = current_coins - price
-                            cursor.execute("UPDATE stats SET coins=%s WHERE user_id=%s", (new_coins, user_id))
-                            cursor.execute("UPDATE user_progress SET display_name=%s, has_changed_name=TRUE WHERE user_id=%s", (new_name, user_id))
-                            success = True
-                    else:
-                        if not user['has_changed_name']:
-                            cursor.execute("UPDATE user_progress SET display_name=%s, has_changed_name=TRUE WHERE user_id=%s", (new_name, user_id))
-                            success = True
+            with conn.cursor() as cursor:
+                identity = resolve_session(cursor, session_id)
+                if not identity:
+                    return jsonify({"success": False, "error": "User not found"})
 
-            conn.commit()
-            return jsonify({"success": success, "coins": new_coins})
+                try:
+                    statement, params = shop_statement(action, identity['user_id'], payload)
+                except (AttributeError, TypeError, ValueError):
+                    return jsonify({"success": False})
+                cursor.execute(statement, params)
+                row = cursor.fetchone()
+                response = shop_response(action, row)
+                if row and row[0]:
+                    publish_user_event(cursor, identity['user_id'], shop_event(action, payload, response), session_id)
+                    if action == 'change_name':
+                        publish_invalidation(cursor, "identities", [identity['tg_id']])
+                    conn.commit()
+                    if action == 'change_name':
+                        IDENTITY_CACHE.invalidate(identity['tg_id'])
+                else:
+                    conn.rollback()
+                return jsonify(response)
 
     except Exception as e:
         print(f"Update API Error: {e}")
         return jsonify({"success": False})
 
-if __name__ == "__main__":
+def telegram_webhook():
+    if not webhook_secret_ok(request.headers.get("X-Telegram-Bot-Api-Secret-Token")):
+        return jsonify({"success": False}), 403
+    try:
+        update = types.Update.de_json(request.get_data(as_text=True))
+    except Exception as e:
+        print(f"Webhook parse error: {e}")
+        return jsonify({"success": False}), 400
+    # Полная очередь -> 503: Telegram повторит доставку позже
+    if not BOT_DISPATCHER.submit(update, block=False):
+        return jsonify({"success": False, "error": "Busy"}), 503
+    return jsonify({"success": True})
+
+# В режиме polling маршрута нет: апдейты приходят только от самого Telegram
+if BOT_MODE == "webhook":
+    app.post(BOT_WEBHOOK_PATH)(telegram_webhook)
+
+@app.get("/api/ready")
+def readiness_api():
+    version = None
+    try:
+        with db_connection() as conn:
+            if conn:
+                with conn.cursor() as cursor:
+                    version = current_schema_version(cursor)
+    except Exception as e:
+        print(f"Readiness Error: {e}")
+    payload, status = readiness_payload(version)
+    return jsonify(payload), status
+
+@app.get("/api/admin/analytics")
+def analytics_api():
+    if not admin_allowed(request.headers.get("Authorization")):
+        return jsonify({"success": False, "error": "Forbidden"}), 403
+    try:
+        days = min(max(1, int(request.args.get("days", 7))), ANALYTICS_DAYS_MAX)
+    except ValueError:
+        return jsonify({"success": False, "error": "Invalid days"}), 400
+    game_id = request.args.get("game_id")
+
+    try:
+        with db_connection() as conn:
+            if not conn: return jsonify({"success": False, "error": "DB Error"}), 500
+            with conn.cursor() as cursor:
+                cursor.execute(ANALYTICS_SQL, (days, game_id, game_id))
+                rows = [analytics_row(r) for r in cursor.fetchall()]
+        return jsonify({"success": True, "days": rows, "summary": analytics_summary(rows), "rollup": ANALYTICS.last_report})
+    except Exception as e:
+        print(f"Analytics API Error: {e}")
+        return jsonify({"success": False}), 500
+
+@app.get("/api/health/db")
+def db_pool_stats():
+    pool = get_db_pool()
+    if not pool: return jsonify({"success": False, "error": "DB Error"}), 503
+    return jsonify({"success": True, "pool": pool.stats()})
+
+@app.get("/api/health/cache")
+def cache_stats():
+    return jsonify({"success": True, "sessions": SESSION_CACHE.stats(), "identities": IDENTITY_CACHE.stats(), "avatars": AVATARS.stats(), "static": STATIC_ASSETS.stats(),
+                    "listener": LISTENER.stats(), "events": EVENTS.stats()})
+
+@app.get("/api/health/scores")
+def score_buffer_stats():
+    if not SCORE_BUFFER:
+        return jsonify({"success": True, "write_behind": False, "admission": SCORE_GATE.stats()})
+    return jsonify({"success": True, "write_behind": True, "admission": SCORE_GATE.stats(), **SCORE_BUFFER.stats()})
+
+@app.get("/api/health/sessions")
+def session_janitor_stats():
+    return jsonify({"success": True, "last_sweep": SESSION_JANITOR.last_report, "total_reclaimed": SESSION_JANITOR.total_reclaimed})
+
+@app.get("/api/health/bot")
+def bot_dispatcher_stats():
+    return jsonify({"success": True, **BOT_DISPATCHER.stats(), "leader": BOT_LEADER.stats()})
+
+@app.get("/api/health/outbox")
+def outbox_stats():
+    pending = None
+    with db_connection() as conn:
+        if conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT COUNT(*) FROM notification_outbox WHERE sent_at IS NULL AND attempts < %s", (OUTBOX_MAX_ATTEMPTS,))
+                pending = cursor.fetchone()[0]
+    return jsonify({"success": True, "pending": pending, **OUTBOX.stats()})
+
+def start_background_workers():
+    """Миграции (если AUTO_MIGRATE), бот и фоновые воркеры; общие для Flask и асинхронного режима."""
+    if AUTO_MIGRATE:
+        migrate_schema()
+    # Индекс статики (со сжатием brotli-11) строится до готовности, а не на первом запросе
+    STATIC_ASSETS.files()
     if BOT_TOKEN: 
-        threading.Thread(target=run_bot, daemon=True).start()
+        BOT_DISPATCHER.start()
+        BOT_LEADER.start()
+        OUTBOX.start()
+    LISTENER.start()
+    SCORE_MAINTENANCE.start()
+    SESSION_JANITOR.start()
+    ACHIEVEMENTS.start()
+    ANALYTICS.start()
+    WORKERS_STARTED.set()
+
+if __name__ == "__main__":
+    # python server.py migrate — только применить миграции (шаг деплоя), без запуска сервера
+    if sys.argv[1:2] == ["migrate"]:
+        sys.exit(0 if (migrate_schema() or 0) >= SCHEMA_VERSION else 1)
+    start_background_workers()
     app.run(host="0.0.0.0", port=PORT)
@@ -0,0 +1,27 @@
+# Общая настройка тестов: Telegram подменяется заглушкой из benchmark.py, server.py импортируется
+# уже с тестовым окружением. Тесты с БД (test_db.py) пропускаются, если не задан DATABASE_URL.
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmark import BENCH_TOKEN, TelegramStub
+
+TELEGRAM = TelegramStub(latency=0)
+TELEGRAM.start()
+
+# Всё, что server.py читает при импорте, задаётся до первого import server в тестах
+os.environ.update(
+    BOT_TOKEN=BENCH_TOKEN,
+    BOT_MODE="webhook",
+    BOT_WEBHOOK_SECRET="test-webhook-secret",
+    TELEGRAM_API_URL=f"http://127.0.0.1:{TELEGRAM.port}/bot{{0}}/{{1}}",
+    PLAY_TOKEN_SECRET="test-play-token-secret",
+    RATE_LIMIT_BACKEND="memory",
+    SCORE_CHECK_PLAUSIBLE="1",
+    SCORE_REQUIRE_PLAY_TOKEN="0",
+    SCORE_WRITE_BEHIND="0",
+    AVATAR_DIR=tempfile.mkdtemp(prefix="avatar-test-"),
+)
@@ -0,0 +1,161 @@
+import json
+
+import pytest
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INTRANS
+
+import server
+
+
+class Clock:
+    """Подменяет time.monotonic: время идёт только по advance()."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(server.time, "monotonic", clock)
+    return clock
+
+
+class FakeConnection:
+    def __init__(self, status):
+        self.status = status
+        self.commits = 0
+
+    def get_transaction_status(self):
+        return self.status
+
+    def commit(self):
+        self.commits += 1
+
+
+class FakeCursor:
+    """Курсор, который отвечает на любой запрос заданной строкой и запоминает запросы."""
+
+    def __init__(self, row, status=TRANSACTION_STATUS_IDLE):
+        self.row = row
+        self.connection = FakeConnection(status)
+        self.queries = []
+
+    def execute(self, query, params=None):
+        self.queries.append((query, params))
+
+    def fetchone(self):
+        return self.row
+
+
+@pytest.fixture(autouse=True)
+def empty_caches():
+    server.clear_identity_caches()
+    yield
+    server.clear_identity_caches()
+
+
+# =============== TTLCache ===============
+def test_ttl_cache_expires(clock):
+    cache = server.TTLCache(maxsize=10, ttl=5)
+    cache.set("a", 1)
+    clock.advance(4)
+    assert cache.get("a") == 1
+    clock.advance(2)
+    assert cache.get("a") is None
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+def test_ttl_cache_evicts_least_recently_used(clock):
+    cache = server.TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+
+def test_ttl_cache_invalidate_and_clear(clock):
+    cache = server.TTLCache(maxsize=10, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.invalidate("a")
+    assert cache.get("a") is None and cache.get("b") == 2
+    cache.clear()
+    assert cache.stats()["size"] == 0
+
+
+# =============== TokenBuckets ===============
+def test_token_bucket_burst_then_wait(clock):
+    buckets = server.TokenBuckets(rate=2, burst=3, maxsize=100)
+    assert [buckets.take("k") for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert buckets.take("k") == pytest.approx(0.5)
+    # Отказ не списывает токен: через полсекунды запрос проходит
+    clock.advance(0.5)
+    assert buckets.take("k") == 0.0
+
+def test_token_bucket_refills_up_to_burst(clock):
+    buckets = server.TokenBuckets(rate=1, burst=2, maxsize=100)
+    buckets.take("k")
+    buckets.take("k")
+    clock.advance(60)
+    assert [buckets.take("k") for _ in range(3)][:2] == [0.0, 0.0]
+    assert buckets.take("k") > 0
+
+def test_token_buckets_keys_are_independent_and_bounded(clock):
+    buckets = server.TokenBuckets(rate=1, burst=1, maxsize=2)
+    assert buckets.take("a") == 0.0
+    assert buckets.take("a") > 0
+    assert buckets.take("b") == 0.0
+    buckets.take("c")
+    # "a" вытеснен и начинает с полного бакета
+    assert buckets.take("a") == 0.0
+
+
+# =============== resolve_session ===============
+def test_resolve_session_commits_own_transaction():
+    cursor = FakeCursor((7, 700))
+    identity = server.resolve_session(cursor, "s-own")
+    assert (identity["user_id"], identity["tg_id"]) == (7, 700)
+    assert cursor.connection.commits == 1
+
+def test_resolve_session_leaves_callers_transaction_open():
+    cursor = FakeCursor((7, 700), status=TRANSACTION_STATUS_INTRANS)
+    assert server.resolve_session(cursor, "s-caller")["user_id"] == 7
+    assert cursor.connection.commits == 0
+
+def test_resolve_session_uses_cache():
+    server.resolve_session(FakeCursor((7, 700)), "s-cached")
+    cursor = FakeCursor(None)
+    assert server.resolve_session(cursor, "s-cached")["user_id"] == 7
+    assert cursor.queries == []
+
+def test_resolve_session_unknown_is_not_cached():
+    assert server.resolve_session(FakeCursor(None), "s-missing") is None
+    assert server.SESSION_CACHE.get("s-missing") is None
+
+def test_resolve_session_accepts_dict_rows():
+    assert server.resolve_session(FakeCursor({"id": 8, "tg_id": 800}), "s-dict")["tg_id"] == 800
+
+
+# =============== apply_invalidation ===============
+def test_invalidation_by_keys():
+    server.remember_identity(1, 10, "a")
+    server.remember_identity(2, 20, "b")
+    for payload in server.invalidation_payloads("identities", [1]):
+        server.apply_invalidation(payload)
+    assert server.IDENTITY_CACHE.get(1) is None and server.IDENTITY_CACHE.get(2)["user_id"] == 20
+
+def test_invalidation_without_keys_clears_cache():
+    server.remember_identity(1, 10, "a")
+    server.apply_invalidation(json.dumps({"cache": "identities"}))
+    assert server.IDENTITY_CACHE.get(1) is None
+
+def test_invalidation_payloads_are_chunked():
+    payloads = server.invalidation_payloads("sessions", range(server.INVALIDATION_CHUNK + 1))
+    assert [len(json.loads(p)["keys"]) for p in payloads] == [server.INVALIDATION_CHUNK, 1]
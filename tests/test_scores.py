@@ -0,0 +1,171 @@
+import itertools
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+
+SESSIONS = (f"test-session-{i}" for i in itertools.count())
+
+
+@pytest.fixture
+def session_id():
+    # Бакеты лимитов живут весь прогон: у каждого теста своя сессия
+    return next(SESSIONS)
+
+
+@pytest.fixture(autouse=True)
+def fresh_play_tokens(monkeypatch):
+    monkeypatch.setattr(server, "PLAY_TOKENS_USED", server.UsedPlayTokens(server.SCORE_PLAY_MAX_SECONDS, 1000))
+
+
+# =============== plausible_score ===============
+def test_allowance_without_duration():
+    # Snake: запас 10 очков, без длительности больше не засчитывается
+    assert server.plausible_score({"game_id": "2", "score": 10})
+    assert not server.plausible_score({"game_id": "2", "score": 11})
+
+def test_client_duration_extends_limit():
+    assert server.plausible_score({"game_id": "2", "score": 60, "duration": 10})
+    assert not server.plausible_score({"game_id": "2", "score": 61, "duration": 10})
+
+def test_client_duration_is_capped(monkeypatch):
+    monkeypatch.setattr(server, "SCORE_PLAY_MAX_SECONDS", 100)
+    assert server.plausible_score({"game_id": "2", "score": 510, "duration": 10 ** 9})
+    assert not server.plausible_score({"game_id": "2", "score": 511, "duration": 10 ** 9})
+
+def test_required_token_ignores_client_duration(monkeypatch):
+    monkeypatch.setattr(server, "SCORE_REQUIRE_PLAY_TOKEN", True)
+    assert not server.plausible_score({"game_id": "2", "score": 60, "duration": 10})
+
+def test_minesweeper_is_zero_or_one():
+    assert server.plausible_score({"game_id": "6", "score": 1, "duration": 3600})
+    assert not server.plausible_score({"game_id": "6", "score": 2, "duration": 3600})
+
+def test_unknown_game_and_malformed_entries_pass():
+    # Кривые записи отклоняет обработчик, а не проверка правдоподобия
+    assert server.plausible_score({"game_id": "999", "score": 10 ** 9})
+    assert server.plausible_score({"game_id": "2"})
+    assert server.plausible_score({"game_id": "2", "score": "lots"})
+
+def test_check_can_be_disabled(monkeypatch):
+    monkeypatch.setattr(server, "SCORE_CHECK_PLAUSIBLE", False)
+    assert server.plausible_score({"game_id": "6", "score": 5000})
+
+
+# =============== play_token ===============
+def test_play_token_gives_server_duration(monkeypatch, session_id):
+    token = server.issue_play_token(session_id, "2")
+    now = time.time()
+    monkeypatch.setattr(server.time, "time", lambda: now + 10)
+    assert server.plausible_score({"game_id": "2", "score": 55, "play_token": token}, session_id)
+
+def test_play_token_is_single_use(session_id):
+    token = server.issue_play_token(session_id, "2")
+    assert server.play_token_seconds(token, session_id, "2") is not None
+    assert server.play_token_seconds(token, session_id, "2") is None
+
+def test_play_token_bound_to_session_and_game(session_id):
+    token = server.issue_play_token(session_id, "2")
+    assert server.play_token_seconds(token, "other-session", "2") is None
+    assert server.play_token_seconds(token, session_id, "3") is None
+    assert server.play_token_seconds("123.forged", session_id, "2") is None
+    assert server.play_token_seconds("garbage", session_id, "2") is None
+
+def test_play_token_expires(monkeypatch, session_id):
+    token = server.issue_play_token(session_id, "2")
+    now = time.time()
+    monkeypatch.setattr(server.time, "time", lambda: now + server.SCORE_PLAY_MAX_SECONDS + 1)
+    assert server.play_token_seconds(token, session_id, "2") is None
+
+def test_no_secret_no_tokens(monkeypatch, session_id):
+    token = server.issue_play_token(session_id, "2")
+    monkeypatch.setattr(server, "PLAY_TOKEN_SECRET", None)
+    assert server.issue_play_token(session_id, "2") is None
+    assert server.play_token_seconds(token, session_id, "2") is None
+
+
+# =============== admit_scores / split_plausible ===============
+def test_implausible_single_score_rejected_and_gate_released(session_id):
+    inflight = server.SCORE_GATE.stats()["inflight"]
+    payload, status, _ = server.admit_scores({"session": session_id, "game_id": "6", "score": 50})
+    assert status == 400 and payload["error"] == "Implausible score"
+    assert server.SCORE_GATE.stats()["inflight"] == inflight
+
+def test_plausible_single_score_admitted(session_id):
+    assert server.admit_scores({"session": session_id, "game_id": "6", "score": 1}) is None
+    server.SCORE_GATE.leave()
+
+def test_batch_admitted_and_split(session_id):
+    entries = [{"game_id": "6", "score": 1}, {"game_id": "6", "score": 50}, "not a dict", {"game_id": "2", "score": 5}]
+    assert server.admit_scores({"session": session_id, "scores": entries}) is None
+    server.SCORE_GATE.leave()
+    kept, rejected = server.split_plausible(entries, session_id)
+    assert rejected == [1]
+    assert kept == [entries[0], entries[2], entries[3]]
+
+def test_rate_limited_score_keeps_play_token(monkeypatch, session_id):
+    monkeypatch.setattr(server, "SESSION_BUCKETS", server.TokenBuckets(1, 1, 100))
+    token = server.issue_play_token(session_id, "2")
+    assert server.admit_scores({"session": session_id, "game_id": "2", "score": 1}) is None
+    server.SCORE_GATE.leave()
+    _, status, headers = server.admit_scores({"session": session_id, "game_id": "2", "score": 5, "play_token": token})
+    assert status == 429 and "Retry-After" in headers
+    # Отказ по лимиту не гасит токен: клиент отправит партию с ним же
+    assert server.play_token_seconds(token, session_id, "2") is not None
+
+def test_batch_route_drops_only_implausible(monkeypatch, session_id):
+    monkeypatch.setattr(server, "SCORE_BUFFER", object())
+    monkeypatch.setattr(server, "record_scores_buffered", lambda session, rows, coins, xp: (1, 0, []))
+    client = server.app.test_client()
+    response = client.post("/api/game/scores/batch", json={"session": session_id, "scores": [
+        {"game_id": "6", "score": 1}, {"game_id": "6", "score": 50}]})
+    assert response.status_code == 200
+    assert response.get_json()["accepted"] == 1 and response.get_json()["rejected"] == [1]
+    response = client.post("/api/game/scores/batch", json={"session": session_id, "scores": [{"game_id": "6", "score": 50}]})
+    assert response.status_code == 400 and response.get_json()["rejected"] == [0]
+
+
+# =============== parse_score_entries ===============
+def test_parse_score_entries_rewards_and_defaults():
+    now = datetime(2025, 6, 1, 12, tzinfo=timezone.utc)
+    rows, coins, xp = server.parse_score_entries([{"game_id": 2, "score": "40"}, {"game_id": "1", "score": 5}], now)
+    assert rows == [("2", 40, now.isoformat()), ("1", 5, now.isoformat())]
+    assert (coins, xp) == (4 + 1, 20 + 2)
+
+def test_parse_score_entries_clamps_played_at():
+    now = datetime(2025, 6, 1, 12, tzinfo=timezone.utc)
+    rows, _, _ = server.parse_score_entries([
+        {"game_id": "1", "score": 1, "played_at": "2030-01-01T00:00:00Z"},
+        {"game_id": "1", "score": 1, "played_at": "2000-01-01T00:00:00"},
+        {"game_id": "1", "score": 1, "played_at": "2025-06-01T10:00:00+02:00"},
+    ], now)
+    assert rows[0][2] == now.isoformat()
+    assert rows[1][2] == (now - timedelta(days=server.SCORE_LATE_DAYS)).isoformat()
+    assert datetime.fromisoformat(rows[2][2]) == datetime(2025, 6, 1, 8, tzinfo=timezone.utc)
+
+@pytest.mark.parametrize("entry", [{"score": 1}, {"game_id": "1", "score": "x"}, {"game_id": "1", "score": 1, "played_at": "yesterday"}, None])
+def test_parse_score_entries_rejects_malformed(entry):
+    with pytest.raises(ValueError):
+        server.parse_score_entries([entry], datetime.now(timezone.utc))
+
+
+# =============== shop_statement ===============
+@pytest.mark.parametrize("action, payload", [
+    ("buy", {"item_id": "hat", "price": -5}),
+    ("buy", {"item_id": "", "price": 5}),
+    ("buy_many", {"items": [{"item_id": "x", "price": 1}] * (server.SHOP_BULK_MAX + 1)}),
+    ("change_name", {"name": "ab"}),
+    ("set_theme", {}),
+    ("sell", {}),
+])
+def test_shop_statement_rejects_bad_payload(action, payload):
+    with pytest.raises(ValueError):
+        server.shop_statement(action, 1, payload)
+
+def test_shop_statement_deduplicates_items():
+    _, params = server.shop_statement("buy_many", 1, {"items": [
+        {"item_id": "hat", "price": 30}, {"item_id": "cape", "price": 20}, {"item_id": "hat", "price": 30}]})
+    item_ids, total = params[0], params[3]
+    assert item_ids == ["hat", "cape"] and total == 50
@@ -0,0 +1,110 @@
+from types import SimpleNamespace
+
+import pytest
+
+import server
+from conftest import TELEGRAM
+
+
+# =============== WEBHOOK ===============
+def test_webhook_secret_ok(monkeypatch):
+    monkeypatch.setattr(server, "BOT_WEBHOOK_SECRET", "s3cret")
+    assert server.webhook_secret_ok("s3cret")
+    assert not server.webhook_secret_ok("wrong")
+    assert not server.webhook_secret_ok(None)
+    assert not server.webhook_secret_ok("")
+
+def test_webhook_secret_required(monkeypatch):
+    monkeypatch.setattr(server, "BOT_WEBHOOK_SECRET", None)
+    assert not server.webhook_secret_ok(None)
+    assert not server.webhook_secret_ok("")
+
+def webhook_update(text):
+    return {"update_id": 1, "message": {
+        "message_id": 1, "date": 0, "text": text,
+        "chat": {"id": 42, "type": "private"},
+        "from": {"id": 42, "is_bot": False, "first_name": "Test"},
+    }}
+
+def test_webhook_route_checks_secret(monkeypatch):
+    submitted = []
+    monkeypatch.setattr(server.BOT_DISPATCHER, "submit", lambda update, block: submitted.append(update) or True)
+    client = server.app.test_client()
+    response = client.post(server.BOT_WEBHOOK_PATH, json=webhook_update("/start"),
+                           headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+    assert response.status_code == 403 and not submitted
+    response = client.post(server.BOT_WEBHOOK_PATH, json=webhook_update("/start"),
+                           headers={"X-Telegram-Bot-Api-Secret-Token": server.BOT_WEBHOOK_SECRET})
+    assert response.status_code == 200
+    assert [u.message.text for u in submitted] == ["/start"]
+
+def test_webhook_route_busy(monkeypatch):
+    monkeypatch.setattr(server.BOT_DISPATCHER, "submit", lambda update, block: False)
+    response = server.app.test_client().post(server.BOT_WEBHOOK_PATH, json=webhook_update("/stats"),
+                                             headers={"X-Telegram-Bot-Api-Secret-Token": server.BOT_WEBHOOK_SECRET})
+    assert response.status_code == 503
+
+
+# =============== AVATARS ===============
+@pytest.fixture(autouse=True)
+def no_background_refresh(monkeypatch):
+    # avatar_url ставит обновление в фон; в тестах оно не должно ходить в сеть после завершения теста
+    monkeypatch.setattr(server.AvatarStore, "schedule_refresh", lambda self, tg_id: None)
+
+
+class PhotoClient:
+    """Клиент с одной аватаркой; считает обращения, чтобы проверить кэш."""
+
+    def __init__(self, data):
+        self.data = data
+        self.downloads = 0
+
+    def get_user_profile_photos(self, tg_id, limit=None):
+        return SimpleNamespace(total_count=1, photos=[[SimpleNamespace(file_id=f"file-{tg_id}")]])
+
+    def get_file(self, file_id):
+        return SimpleNamespace(file_path=f"photos/{file_id}.jpg")
+
+    def download_file(self, file_path):
+        self.downloads += 1
+        return self.data
+
+def test_avatar_without_photo_via_stub(tmp_path):
+    # Бот ходит в заглушку Bot API из benchmark.py: у пользователей там нет фото
+    store = server.AvatarStore(server.bot, str(tmp_path), ttl=60, memory_items=10)
+    calls = TELEGRAM.calls
+    store.refresh(42)
+    assert TELEGRAM.calls == calls + 1
+    assert store.avatar_url(42) is None
+    assert store.load(42) is None
+
+def test_avatar_cached_on_disk_and_in_memory(tmp_path):
+    client = PhotoClient(b"jpeg-bytes")
+    store = server.AvatarStore(client, str(tmp_path), ttl=60, memory_items=10)
+    store.refresh(7)
+    data, etag = store.load(7)
+    assert data == b"jpeg-bytes"
+    assert store.avatar_url(7) == f"/api/avatar/7?v={etag}"
+    assert (tmp_path / "7.jpg").read_bytes() == b"jpeg-bytes"
+    # Новый экземпляр (перезапуск) подхватывает файл с диска без обращения к Telegram
+    restarted = server.AvatarStore(client, str(tmp_path), ttl=60, memory_items=10)
+    assert restarted.load(7)[0] == b"jpeg-bytes"
+    assert client.downloads == 1
+
+def test_avatar_url_does_not_block_on_telegram(tmp_path, monkeypatch):
+    store = server.AvatarStore(PhotoClient(b"x"), str(tmp_path), ttl=60, memory_items=10)
+    scheduled = []
+    monkeypatch.setattr(store, "schedule_refresh", scheduled.append)
+    assert store.avatar_url(9) is None
+    assert scheduled == [9]
+
+def test_avatar_fetch_error_is_remembered(tmp_path):
+    class BrokenClient(PhotoClient):
+        def get_user_profile_photos(self, tg_id, limit=None):
+            raise RuntimeError("telegram is down")
+
+    store = server.AvatarStore(BrokenClient(b""), str(tmp_path), ttl=60, memory_items=10)
+    store._refresh_safe(5)
+    assert store.fetch_errors == 1
+    assert store.avatar_url(5) is None
+    assert store.stats()["pending"] == 0